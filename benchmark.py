@@ -0,0 +1,513 @@
+"""半自動販売機Botのオフラインベンチマーク
+
+Discordに接続せず、Interaction・チャンネル・ユーザーの代用品を使って
+実際のハンドラー（商品選択・決済リンク入力・商品送信・パネル作成）を実行し、
+スループット・レイテンシ（p50/p99）・ピークメモリをJSONで出力する
+
+使い方:
+    python benchmark.py --purchases 5000 --concurrency 200 --output result.json
+    python benchmark.py --compare result.json   # 前回の結果と比較
+"""
+import argparse
+import asyncio
+import contextlib
+import itertools
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# mainの読み込み前に一時ディレクトリへ保存先を切り替える
+os.environ.setdefault('DATA_DIR', tempfile.mkdtemp(prefix='vending-bench-'))
+os.environ.setdefault('PANEL_REFRESH_DELAY', '0.5')
+# 1つのサーバーに注文を集中させるため、サーバー単位の頻度制限は既定で無効にする
+os.environ.setdefault('ORDER_RATE_PER_GUILD', '0')
+
+import discord
+
+import main
+
+snowflakes = itertools.count(10 ** 17)
+
+def next_id():
+    return next(snowflakes)
+
+# ---- Discordオブジェクトの代用品 ----
+
+class FakeAsset:
+    url = 'https://cdn.discordapp.com/embed/avatars/0.png'
+
+class FakePermissions:
+    administrator = True
+
+class FakeUser:
+    def __init__(self, api, user_id=None, name=None):
+        self.api = api
+        self.id = user_id or next_id()
+        self.name = name or f'user{self.id}'
+        self.display_name = self.name
+        self.mention = f'<@{self.id}>'
+        self.display_avatar = FakeAsset()
+        self.guild_permissions = FakePermissions()
+
+    async def send(self, **kwargs):
+        return await self.api.call('dm', kwargs)
+
+class FakeMessage:
+    def __init__(self, api, channel_id, message_id=None):
+        self.api = api
+        self.channel_id = channel_id
+        self.id = message_id or next_id()
+
+    async def edit(self, **kwargs):
+        return await self.api.call('edit_message', kwargs)
+
+class FakeChannel:
+    def __init__(self, api, channel_id=None, name='channel'):
+        self.api = api
+        self.id = channel_id or next_id()
+        self.name = name
+        self.mention = f'<#{self.id}>'
+
+    async def send(self, **kwargs):
+        await self.api.call('send_message', kwargs)
+        return FakeMessage(self.api, self.id)
+
+    def get_partial_message(self, message_id):
+        return FakeMessage(self.api, self.id, message_id)
+
+class FakeGuild:
+    def __init__(self, guild_id=None):
+        self.id = guild_id or next_id()
+        self.name = f'guild{self.id}'
+
+class FakeCallbackResponse:
+    def __init__(self, message_id):
+        self.message_id = message_id
+
+class FakeResponse:
+    def __init__(self, interaction):
+        self.interaction = interaction
+        self.done = False
+        self.modal = None
+
+    def is_done(self):
+        return self.done
+
+    async def _respond(self, kind, kwargs):
+        if self.done:
+            raise RuntimeError('interaction already responded')
+        self.done = True
+        await self.interaction.api.call(kind, kwargs)
+        return FakeCallbackResponse(next_id())
+
+    async def send_message(self, content=None, **kwargs):
+        return await self._respond('interaction_response', kwargs)
+
+    async def send_modal(self, modal):
+        self.modal = modal
+        return await self._respond('interaction_response', {})
+
+    async def defer(self, **kwargs):
+        return await self._respond('interaction_response', kwargs)
+
+    async def edit_message(self, **kwargs):
+        return await self._respond('interaction_response', kwargs)
+
+class FakeFollowup:
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def send(self, content=None, **kwargs):
+        return await self.interaction.api.call('followup', kwargs)
+
+class FakeInteraction:
+    def __init__(self, api, guild, user, channel, message=None):
+        self.api = api
+        self.id = next_id()
+        self.guild = guild
+        self.user = user
+        self.channel = channel
+        self.message = message
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+
+    def is_expired(self):
+        return False
+
+    async def edit_original_response(self, **kwargs):
+        return await self.api.call('edit_original', kwargs)
+
+class FakeAPI:
+    """REST呼び出しの代わりに一定の遅延を入れて呼び出し回数を数える"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = {}
+        self.channels = {}
+        self.users = {}
+
+    async def call(self, kind, payload):
+        self.calls[kind] = self.calls.get(kind, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def channel(self, channel_id):
+        if channel_id not in self.channels:
+            self.channels[channel_id] = FakeChannel(self, channel_id)
+        return self.channels[channel_id]
+
+    async def fetch_user(self, user_id):
+        await self.call('fetch_user', None)
+        return self.users[user_id]
+
+# ---- 計測 ----
+
+class Recorder:
+    def __init__(self):
+        self.samples = {}
+
+    def record(self, name, seconds):
+        self.samples.setdefault(name, []).append(seconds)
+
+    async def measure(self, name, coro):
+        started_at = time.perf_counter()
+        try:
+            return await coro
+        finally:
+            self.record(name, time.perf_counter() - started_at)
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+def summarize(samples, elapsed):
+    return {
+        'count': len(samples),
+        'throughput': len(samples) / elapsed if elapsed else 0.0,
+        'mean_ms': sum(samples) / len(samples) * 1000 if samples else 0.0,
+        'p50_ms': percentile(samples, 0.50) * 1000,
+        'p99_ms': percentile(samples, 0.99) * 1000,
+        'max_ms': max(samples) * 1000 if samples else 0.0
+    }
+
+# ---- シナリオ ----
+
+def install_fakes(bot, api):
+    """ボットのREST依存部分を代用品に差し替える"""
+    bot.get_channel = api.channel
+    bot.get_partial_messageable = api.channel
+    bot.fetch_user = api.fetch_user
+
+def seed_products(bot, guild_id, products, stock):
+    vending_machine = bot.get_guild_vending_machine(guild_id)
+    for index in range(products):
+        product_id = f'bench{index}'
+        vending_machine['products'][product_id] = {
+            'name': f'ベンチ商品{index}',
+            'price': 100 + index,
+            'description': 'ベンチマーク用の商品',
+            'stock': 0,
+            'reserved': 0,
+            'inventory': bot.open_inventory(guild_id, product_id)
+        }
+        inventory = vending_machine['products'][product_id]['inventory']
+        inventory.extend(f'KEY-{index}-{item:08d}' for item in range(stock))
+        vending_machine['products'][product_id]['stock'] = len(inventory)
+        bot.mark_dirty(guild_id, 'product', product_id)
+    return [f'bench{index}' for index in range(products)]
+
+async def bench_panel(bot, api, guild, admin, recorder, iterations):
+    """パネルの構築（キャッシュなし）と/vending_panelの実行"""
+    for _ in range(iterations):
+        started_at = time.perf_counter()
+        bot.panels.cache.pop(guild.id, None)
+        bot.panels.payload(guild.id)
+        main.VendingMachineView(guild.id)
+        recorder.record('panel_build', time.perf_counter() - started_at)
+
+    channel = api.channel(next_id())
+    admin_channel = api.channel(next_id())
+    for _ in range(iterations):
+        interaction = FakeInteraction(api, guild, admin, channel)
+        await recorder.measure('vending_panel', main.vending_panel_slash.callback(interaction, admin_channel, None))
+    return admin_channel
+
+async def purchase(bot, api, guild, product_id, channel, recorder):
+    """商品選択 → 決済リンク入力までを1人の購入者として実行"""
+    buyer = FakeUser(api)
+    api.users[buyer.id] = buyer
+
+    select = main.ProductSelect(guild.id)
+    select.item._values = [product_id]
+    interaction = FakeInteraction(api, guild, buyer, channel)
+    await recorder.measure('product_select', select.callback(interaction))
+
+    modal = interaction.response.modal
+    if modal is None:
+        return None
+    modal.paypay_link._value = f'https://pay.paypay.ne.jp/{next_id()}'
+    modal_interaction = FakeInteraction(api, guild, buyer, channel)
+    await recorder.measure('paypay_modal_submit', modal.on_submit(modal_interaction))
+    return str(modal.order_id)
+
+async def wait_for_admin_messages(bot, guild_id, order_ids, timeout=60):
+    """管理者通知が送信され、メッセージIDが記録されるまで待つ"""
+    vending_machine = bot.get_guild_vending_machine(guild_id)
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if all(vending_machine['orders'][order_id].get('admin_messages') for order_id in order_ids):
+            return
+        await asyncio.sleep(0.01)
+
+async def approve(bot, api, guild, admin, order_id, recorder, approved_at):
+    vending_machine = bot.get_guild_vending_machine(guild.id)
+    channel_id, message_id = vending_machine['orders'][order_id]['admin_messages'][0]
+    channel = api.channel(channel_id)
+    interaction = FakeInteraction(api, guild, admin, channel, FakeMessage(api, channel_id, message_id))
+    button = main.ApproveOrderButton(guild.id, order_id)
+    approved_at[order_id] = time.perf_counter()
+    await recorder.measure('approve_order', button.callback(interaction))
+
+async def wait_for_deliveries(bot, guild_id, approved_at, recorder, timeout=300):
+    """配送ワーカーの処理完了まで待ち、承認から完了までの時間を記録"""
+    vending_machine = bot.get_guild_vending_machine(guild_id)
+    remaining = set(approved_at)
+    deadline = time.perf_counter() + timeout
+    while remaining and time.perf_counter() < deadline:
+        now = time.perf_counter()
+        for order_id in list(remaining):
+            if vending_machine['orders'][order_id]['status'] in ('completed', 'pending_payment'):
+                if vending_machine['orders'][order_id]['status'] == 'completed':
+                    recorder.record('delivery_end_to_end', now - approved_at[order_id])
+                remaining.discard(order_id)
+        await asyncio.sleep(0.005)
+
+async def run(args):
+    if args.tracemalloc:
+        tracemalloc.start()
+
+    bot = main.bot
+    api = FakeAPI(args.api_latency / 1000)
+    install_fakes(bot, api)
+
+    # setup_hookの代わりに必要なバックグラウンド処理だけを開始
+    bot.storage.open()
+    await bot.replay_journal()
+    bot.flush_task = asyncio.create_task(bot.storage_flush_loop())
+    bot.journal_task = asyncio.create_task(bot.journal.run())
+    bot.delivery.start()
+
+    guild = FakeGuild()
+    admin = FakeUser(api, name='admin')
+    channel = api.channel(next_id())
+    product_ids = seed_products(bot, guild.id, args.products, args.stock)
+    recorder = Recorder()
+    phases = {}
+
+    started_at = time.perf_counter()
+    admin_channel = await bench_panel(bot, api, guild, admin, recorder, args.panel_iterations)
+    phases['panel'] = time.perf_counter() - started_at
+    bot.get_guild_vending_machine(guild.id)['admin_channels'] = {admin_channel.id}
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def limited(coro):
+        async with semaphore:
+            return await coro
+
+    started_at = time.perf_counter()
+    order_ids = await asyncio.gather(*(
+        limited(purchase(bot, api, guild, product_ids[index % len(product_ids)], channel, recorder))
+        for index in range(args.purchases)
+    ))
+    order_ids = [order_id for order_id in order_ids if order_id is not None]
+    await wait_for_admin_messages(bot, guild.id, order_ids)
+    phases['purchase'] = time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
+    approved_at = {}
+    await asyncio.gather(*(
+        limited(approve(bot, api, guild, admin, order_id, recorder, approved_at))
+        for order_id in order_ids
+    ))
+    await wait_for_deliveries(bot, guild.id, approved_at, recorder)
+    phases['approval'] = time.perf_counter() - started_at
+
+    await bot.journal.sync()
+    await bot.flush_storage()
+    bot.delivery.stop()
+    bot.flush_task.cancel()
+    bot.journal_task.cancel()
+
+    phase_of = {
+        'panel_build': 'panel',
+        'vending_panel': 'panel',
+        'product_select': 'purchase',
+        'paypay_modal_submit': 'purchase',
+        'approve_order': 'approval',
+        'delivery_end_to_end': 'approval'
+    }
+    results = {
+        name: summarize(samples, phases[phase_of[name]])
+        for name, samples in recorder.samples.items()
+    }
+
+    journal_replay = bench_journal_replay(args.journal_events) if args.journal_events else None
+
+    if args.tracemalloc:
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    else:
+        # Linuxではru_maxrssはKB単位
+        peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    return {
+        'meta': {
+            'timestamp': time.time(),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'discord_py': discord.__version__,
+            'platform': platform.platform(),
+            'parameters': vars(args)
+        },
+        'phases_seconds': phases,
+        'results': results,
+        'api_calls': api.calls,
+        'completed_orders': sum(
+            1 for order in bot.get_guild_vending_machine(guild.id)['orders'].values()
+            if order['status'] == 'completed'
+        ),
+        'journal': bot.journal.stats(),
+        'journal_replay': journal_replay,
+        'peak_memory_bytes': peak_memory,
+        'peak_memory_source': 'tracemalloc' if args.tracemalloc else 'ru_maxrss'
+    }
+
+def bench_journal_replay(events, guilds=10, transitions=4):
+    """操作ログの再生速度（events件のイベントを書いたセグメントを読み、キーごとに集約する）
+
+    注文ごとにtransitions回の状態変化があるものとして、最後の状態だけを解析するまでを計測する
+    """
+    journal = main.OrderJournal(main.bot)
+    journal.directory = tempfile.mkdtemp(prefix='vending-journal-')
+    statuses = ('pending_payment', 'delivering', 'pending_payment', 'completed')
+    timestamp = time.time()
+    with open(journal.segment_path(journal.directory, 1), 'wb') as segment_file:
+        lines = []
+        for seq in range(1, events + 1):
+            order_index = (seq - 1) // transitions
+            order = {
+                'user_id': str(10 ** 17 + order_index),
+                'product_id': f'bench{order_index % 20}',
+                'status': statuses[(seq - 1) % transitions % len(statuses)],
+                'channel_id': 10 ** 17,
+                'timestamp': timestamp,
+                'processed_by': None,
+                'processed_at': None,
+                'reserved': True
+            }
+            lines.append(main.OrderJournal.format_event(
+                seq, timestamp, 'order', 10 ** 17 + order_index % guilds, str(order_index), json.dumps(order)
+            ))
+            if len(lines) >= 10000:
+                segment_file.write(b''.join(lines))
+                lines = []
+        segment_file.write(b''.join(lines))
+    file_bytes = os.path.getsize(journal.segment_path(journal.directory, 1))
+
+    started_at = time.perf_counter()
+    _, count, latest, _ = journal.replay(0)
+    replay_seconds = time.perf_counter() - started_at
+    started_at = time.perf_counter()
+    for data in latest.values():
+        json.loads(data)
+    parse_seconds = time.perf_counter() - started_at
+    shutil.rmtree(journal.directory, ignore_errors=True)
+
+    return {
+        'events': count,
+        'keys': len(latest),
+        'file_bytes': file_bytes,
+        'replay_seconds': replay_seconds,
+        'parse_seconds': parse_seconds,
+        'events_per_second': count / (replay_seconds + parse_seconds) if count else 0.0
+    }
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except Exception:
+        return None
+
+def compare(baseline, current, threshold):
+    """前回の結果と比較し、しきい値を超えて悪化した項目を返す（比較表は結果のJSONと混ざらないよう標準エラーに出す）"""
+    regressions = []
+    print(f"{'項目':<24}{'p50(ms)':>20}{'p99(ms)':>20}{'throughput/s':>24}", file=sys.stderr)
+    for name, result in current['results'].items():
+        base = baseline.get('results', {}).get(name)
+        if not base:
+            continue
+        cells = []
+        for key, higher_is_worse in (('p50_ms', True), ('p99_ms', True), ('throughput', False)):
+            before, after = base[key], result[key]
+            change = (after - before) / before * 100 if before else 0.0
+            cells.append(f'{after:10.2f} ({change:+6.1f}%)')
+            worse = change > threshold if higher_is_worse else change < -threshold
+            if worse:
+                regressions.append(f'{name}.{key}: {before:.2f} -> {after:.2f} ({change:+.1f}%)')
+        print(f'{name:<24}' + ''.join(f'{cell:>22}' for cell in cells), file=sys.stderr)
+    return regressions
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='半自動販売機Botのオフラインベンチマーク')
+    parser.add_argument('--products', type=int, default=20, help='商品数')
+    parser.add_argument('--stock', type=int, default=1000, help='商品ごとの在庫数')
+    parser.add_argument('--purchases', type=int, default=2000, help='購入数')
+    parser.add_argument('--concurrency', type=int, default=200, help='同時に処理する購入・承認の数')
+    parser.add_argument('--api-latency', type=float, default=0.0, help='疑似REST呼び出しの遅延（ミリ秒）')
+    parser.add_argument('--panel-iterations', type=int, default=100, help='パネル構築の繰り返し回数')
+    parser.add_argument('--journal-events', type=int, default=0, help='操作ログの再生速度を計測するイベント数（例: 1000000、0で計測しない）')
+    parser.add_argument('--tracemalloc', action='store_true', help='tracemallocでピークメモリを計測（低速）')
+    parser.add_argument('--output', help='結果のJSONの出力先（省略時は標準出力）')
+    parser.add_argument('--compare', help='比較する前回の結果のJSON')
+    parser.add_argument('--fail-threshold', type=float, default=20.0, help='比較時に悪化とみなす割合（%%）')
+    return parser.parse_args(argv)
+
+def run_cli(argv=None):
+    args = parse_args(argv)
+    # ボットのログはJSONの出力と混ざらないよう標準エラーに出す
+    with contextlib.redirect_stdout(sys.stderr):
+        result = asyncio.run(run(args))
+    text = json.dumps(result, indent=2, ensure_ascii=False)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            output_file.write(text + '\n')
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as baseline_file:
+            regressions = compare(json.load(baseline_file), result, args.fail_threshold)
+        if regressions:
+            print('悪化した項目:', file=sys.stderr)
+            for regression in regressions:
+                print(f'  {regression}', file=sys.stderr)
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(run_cli())
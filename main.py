@@ -2,12 +2,37 @@ import discord
 from discord.ext import commands
 from discord import app_commands
 import aiohttp
+import yarl
 import asyncio
 import os
+import sys
 import json
 import time
 import random
-from datetime import datetime, timedelta
+import sqlite3
+import threading
+import mmap
+import csv
+import codecs
+import hashlib
+import hmac
+import bisect
+import functools
+import logging
+import logging.handlers
+import queue
+import copy
+import atexit
+import math
+import signal
+import shutil
+import gzip
+import itertools
+import contextlib
+import tempfile
+from array import array
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta, timezone
 
 # ランダムカラー選択用の関数
 def get_random_color():
@@ -17,39 +42,3231 @@ def get_random_color():
 
 BOT_TOKEN = os.getenv('DISCORD_BOT_TOKEN')
 
-class VendingBot(commands.Bot):
+# Discord APIの接続先（負荷試験でmock_discord.pyに向ける場合のみ設定）
+DISCORD_API_BASE = os.getenv('DISCORD_API_BASE')
+DISCORD_GATEWAY_URL = os.getenv('DISCORD_GATEWAY_URL')
+
+# 処理時間ヒストグラムのバケット（秒）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    """事前に確保したバケットによるヒストグラム
+
+    更新はイベントループ上でのみ行うためロックは不要
+    """
+
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+def format_labels(labels):
+    """Prometheusのラベル表記に変換"""
+    if not labels:
+        return ''
+    parts = []
+    for key, value in labels.items():
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{key}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+class Metrics:
+    """Prometheus形式で公開するメトリクス"""
+
+    def __init__(self):
+        self.handlers = {}  # {(kind, name): Histogram}
+        self.handler_errors = {}  # {(kind, name): int}
+        self.orders = {}  # {status: そのステータスになった注文数}
+        self.throttled = {}  # {(action, scope): 頻度制限で拒否した回数}
+
+    def histogram(self, kind, name):
+        key = (kind, name)
+        if key not in self.handlers:
+            self.handlers[key] = Histogram()
+            self.handler_errors[key] = 0
+        return self.handlers[key]
+
+    def order_status(self, status):
+        self.orders[status] = self.orders.get(status, 0) + 1
+
+    def throttle(self, action, scope):
+        key = (action, scope)
+        self.throttled[key] = self.throttled.get(key, 0) + 1
+
+    def render(self, lines):
+        """メトリクスをテキスト形式でlinesに追加"""
+        lines.append('# HELP vending_handler_duration_seconds Interaction handler latency.')
+        lines.append('# TYPE vending_handler_duration_seconds histogram')
+        for (kind, name), histogram in self.handlers.items():
+            cumulative = 0
+            for bound, count in zip(histogram.bounds + (float('inf'),), histogram.counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'vending_handler_duration_seconds_bucket{format_labels({"kind": kind, "handler": name, "le": le})} {cumulative}')
+            labels = format_labels({'kind': kind, 'handler': name})
+            lines.append(f'vending_handler_duration_seconds_sum{labels} {histogram.sum}')
+            lines.append(f'vending_handler_duration_seconds_count{labels} {histogram.count}')
+
+        lines.append('# HELP vending_handler_errors_total Interaction handlers that raised an exception.')
+        lines.append('# TYPE vending_handler_errors_total counter')
+        for (kind, name), count in self.handler_errors.items():
+            lines.append(f'vending_handler_errors_total{format_labels({"kind": kind, "handler": name})} {count}')
+
+        lines.append('# HELP vending_orders_total Orders that entered each status.')
+        lines.append('# TYPE vending_orders_total counter')
+        for status, count in self.orders.items():
+            lines.append(f'vending_orders_total{format_labels({"status": status})} {count}')
+
+        lines.append('# HELP vending_throttled_total Order attempts rejected by the rate limiter.')
+        lines.append('# TYPE vending_throttled_total counter')
+        for (action, scope), count in self.throttled.items():
+            lines.append(f'vending_throttled_total{format_labels({"action": action, "scope": scope})} {count}')
+
+metrics = Metrics()
+
+# イベントループ監視の設定
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', '0.5'))
+SLOW_CALLBACK_THRESHOLD = float(os.getenv('SLOW_CALLBACK_THRESHOLD', '0.1'))
+PROFILE_MAX_SECONDS = float(os.getenv('PROFILE_MAX_SECONDS', '30'))
+DEBUG_TOKEN = os.getenv('DEBUG_TOKEN')
+
+def check_token(request, expected, header):
+    """トークンが必要なエンドポイントへのアクセスを確認（許可する場合はNone、拒否する場合は応答を返す）
+
+    トークンはクエリのtokenかheaderで渡す。expectedが設定されていない場合はエンドポイントが無いものとして扱う
+    """
+    from aiohttp import web
+
+    if not expected:
+        return web.Response(text='Not Found', status=404, content_type='text/plain')
+    token = request.query.get('token') or request.headers.get(header) or ''
+    if not hmac.compare_digest(token.encode('utf-8'), expected.encode('utf-8')):
+        return web.Response(text='Forbidden', status=403, content_type='text/plain')
+    return None
+
+def describe_frame(frame):
+    """実行中のスタックから処理名を取り出す（このファイル内で最も深いフレーム）"""
+    innermost = frame
+    while frame is not None:
+        if frame.f_code.co_filename == __file__:
+            break
+        frame = frame.f_back
+    frame = frame or innermost
+    if frame is None:
+        return 'unknown'
+    code = frame.f_code
+    return f'{getattr(code, "co_qualname", code.co_name)} ({os.path.basename(code.co_filename)}:{frame.f_lineno})'
+
+class LoopMonitor:
+    """イベントループの遅延と処理時間の長いコールバックを記録
+
+    ループ上の心拍タスクがSLOW_CALLBACK_THRESHOLDの半分ごとに時刻を更新し、心拍が途絶えている間は
+    監視スレッドがループのスレッドのスタックから実行中の処理を特定する。心拍が再開した時点の遅れを
+    その処理の所要時間として記録する（asyncioの内部には手を入れない）
+    """
+
+    def __init__(self):
+        self.lag = Histogram()
+        self.lag_last = 0.0
+        self.lag_max = 0.0
+        self.recent_lag = deque(maxlen=120)
+        self.slow_callbacks = deque(maxlen=100)  # 直近の処理時間の長いコールバック
+        self.slow_totals = {}  # {処理名: [回数, 合計秒数, 最大秒数]}
+        self.task = None
+        self.heartbeat_task = None
+        self.heartbeat = 0.0  # 心拍タスクが最後に動いた時刻
+        self.stall_name = None  # 心拍が途絶えている間に監視スレッドが見つけた処理名
+        self.stopping = threading.Event()
+
+    def start(self):
+        self.task = asyncio.create_task(self.sample_lag())
+        if SLOW_CALLBACK_THRESHOLD > 0:
+            self.heartbeat = time.perf_counter()
+            self.heartbeat_task = asyncio.create_task(self.beat())
+            self.stopping.clear()
+            threading.Thread(target=self.watch, args=(threading.get_ident(),), name='loop-watchdog', daemon=True).start()
+
+    def stop(self):
+        for task in (self.task, self.heartbeat_task):
+            if task:
+                task.cancel()
+        self.stopping.set()
+
+    async def sample_lag(self):
+        """一定間隔のsleepが予定よりどれだけ遅れて戻るかを測定"""
+        while True:
+            started_at = time.perf_counter()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            lag = max(time.perf_counter() - started_at - LOOP_LAG_INTERVAL, 0.0)
+            self.lag.observe(lag)
+            self.lag_last = lag
+            self.lag_max = max(self.lag_max, lag)
+            self.recent_lag.append(lag)
+
+    async def beat(self):
+        """心拍を更新し、前回からの遅れがしきい値を超えていれば記録"""
+        interval = SLOW_CALLBACK_THRESHOLD / 2
+        while True:
+            await asyncio.sleep(interval)
+            now = time.perf_counter()
+            stalled = now - self.heartbeat - interval
+            self.heartbeat = now
+            name, self.stall_name = self.stall_name, None
+            if stalled >= SLOW_CALLBACK_THRESHOLD:
+                self.record_slow(name or 'unknown', stalled)
+
+    def watch(self, thread_id):
+        """心拍が途絶えている間にループのスレッドが実行している処理を特定（別スレッドで実行）"""
+        while not self.stopping.wait(SLOW_CALLBACK_THRESHOLD / 4):
+            if self.stall_name is None and time.perf_counter() - self.heartbeat > SLOW_CALLBACK_THRESHOLD:
+                self.stall_name = describe_frame(sys._current_frames().get(thread_id))
+
+    def record_slow(self, name, duration):
+        self.slow_callbacks.append({'name': name, 'duration': duration, 'timestamp': time.time()})
+        totals = self.slow_totals.setdefault(name, [0, 0.0, 0.0])
+        totals[0] += 1
+        totals[1] += duration
+        totals[2] = max(totals[2], duration)
+
+    def stats(self):
+        recent = sorted(self.recent_lag)
+        return {
+            'lag_last': self.lag_last,
+            'lag_max': self.lag_max,
+            'lag_p50': recent[len(recent) // 2] if recent else 0.0,
+            'lag_p99': recent[min(int(len(recent) * 0.99), len(recent) - 1)] if recent else 0.0,
+            'slow_callback_threshold': SLOW_CALLBACK_THRESHOLD,
+            'slow_callbacks': sum(totals[0] for totals in self.slow_totals.values())
+        }
+
+class SamplingProfiler:
+    """イベントループのスレッドのスタックを別スレッドから定期的に採取するプロファイラー"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def run(self, thread_id, seconds, interval=0.005):
+        """seconds秒間スタックを採取し、{折り畳んだスタック: 回数} を返す"""
+        if not self.lock.acquire(blocking=False):
+            raise RuntimeError('プロファイラーは既に実行中です')
+        try:
+            stacks = {}
+            deadline = time.perf_counter() + seconds
+            while time.perf_counter() < deadline:
+                frame = sys._current_frames().get(thread_id)
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                    frame = frame.f_back
+                if frames:
+                    stack = ';'.join(reversed(frames))
+                    stacks[stack] = stacks.get(stack, 0) + 1
+                time.sleep(interval)
+            return stacks
+        finally:
+            self.lock.release()
+
+def timed(kind, name):
+    """ハンドラーの処理時間をメトリクスに記録するデコレーター"""
+    def decorator(func):
+        histogram = metrics.histogram(kind, name)
+        key = (kind, name)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started_at = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                metrics.handler_errors[key] += 1
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - started_at)
+        return wrapper
+    return decorator
+
+# 永続化設定
+DATA_DIR = os.getenv('DATA_DIR', 'data')
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'sqlite')  # sqlite / memory
+STORAGE_FLUSH_INTERVAL = float(os.getenv('STORAGE_FLUSH_INTERVAL', '0.5'))
+
+# 設置済みパネルの更新をまとめるまでの待ち時間（秒）
+PANEL_REFRESH_DELAY = float(os.getenv('PANEL_REFRESH_DELAY', '3'))
+
+# パネルの1ページに表示する商品数（Embedのフィールドは25個までで、1つは実績チャンネルの表示に使う）
+PANEL_PAGE_SIZE = min(int(os.getenv('PANEL_PAGE_SIZE', 10)), 24)
+# Embed全体の文字数の上限（商品の説明が長い場合は1ページの商品数を減らす）
+EMBED_MAX_CHARS = 6000
+
+# チャンネル送信キューの再試行設定
+OUTBOUND_MAX_RETRIES = int(os.getenv('OUTBOUND_MAX_RETRIES', 5))
+OUTBOUND_RETRY_BASE = float(os.getenv('OUTBOUND_RETRY_BASE', '1.0'))
+
+# 商品DM配送ワーカーの設定
+DELIVERY_WORKERS = int(os.getenv('DELIVERY_WORKERS', 4))
+DELIVERY_QUEUE_SIZE = int(os.getenv('DELIVERY_QUEUE_SIZE', 1000))
+DELIVERY_MAX_RETRIES = int(os.getenv('DELIVERY_MAX_RETRIES', 3))
+DELIVERY_HISTORY_LIMIT = 50  # 送信済みか確かめるときに遡る購入者とのDMのメッセージ数
+
+# ユーザー情報キャッシュの設定
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 10000))
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', 600))
+
+# ファイルからの在庫一括追加の設定
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', 5000))
+IMPORT_PROGRESS_INTERVAL = float(os.getenv('IMPORT_PROGRESS_INTERVAL', '2'))
+
+# 決済確認待ちの注文を自動で期限切れにするまでの秒数
+ORDER_EXPIRY_SECONDS = int(os.getenv('ORDER_EXPIRY_SECONDS', 86400))
+
+# 完了・キャンセル・期限切れの注文をメモリから圧縮ファイルに移すまでの秒数
+ORDER_ARCHIVE_AGE = int(os.getenv('ORDER_ARCHIVE_AGE', 7 * 86400))
+ORDER_ARCHIVE_INTERVAL = float(os.getenv('ORDER_ARCHIVE_INTERVAL', 600))
+ORDER_ARCHIVE_BATCH = int(os.getenv('ORDER_ARCHIVE_BATCH', 5000))
+ORDER_LOOKUP_LIMIT = 10  # /order_lookupで表示する注文数
+TERMINAL_ORDER_STATUSES = ('completed', 'cancelled', 'expired')
+
+# 売上レポートの日付の区切りに使うUTCからの時差（時間）
+SALES_UTC_OFFSET = int(os.getenv('SALES_UTC_OFFSET', 9))
+SALES_REPORT_MAX_DAYS = 366
+SALES_API_TOKEN = os.getenv('SALES_API_TOKEN')  # /salesエンドポイントのトークン（未設定の場合は公開しない）
+
+# 読み込み済みサーバーデータのメモリ管理
+# 一定時間アクセスの無いサーバーと、合計が予算を超えた分の古いサーバーをメモリから外す
+# （次のアクセス時にストレージから読み込み直す）
+GUILD_MEMORY_BUDGET = int(os.getenv('GUILD_MEMORY_BUDGET', 128 * 1024 * 1024))
+GUILD_IDLE_SECONDS = float(os.getenv('GUILD_IDLE_SECONDS', 1800))
+GUILD_EVICT_MIN_IDLE = float(os.getenv('GUILD_EVICT_MIN_IDLE', 60))  # 予算超過時でもこれより最近使ったサーバーは外さない
+GUILD_EVICT_INTERVAL = float(os.getenv('GUILD_EVICT_INTERVAL', 30))
+GUILD_SIZE_SAMPLE = 32  # サイズ推定で実測する商品数・注文数
+
+# 決済リンクの使い回し検出（サーバーごとのBloomフィルターの初期容量と誤検出率）
+PAYMENT_LINK_BLOOM_CAPACITY = int(os.getenv('PAYMENT_LINK_BLOOM_CAPACITY', 10000))
+PAYMENT_LINK_BLOOM_ERROR = float(os.getenv('PAYMENT_LINK_BLOOM_ERROR', '0.001'))
+
+# 一括承認で1回に指定できる注文数
+BULK_APPROVAL_MAX = int(os.getenv('BULK_APPROVAL_MAX', 500))
+
+# 注文作成の頻度制限（1秒あたりの回数と連続で許可する回数、回数が0以下なら制限しない）
+ORDER_RATE_PER_USER = float(os.getenv('ORDER_RATE_PER_USER', '0.2'))
+ORDER_BURST_PER_USER = int(os.getenv('ORDER_BURST_PER_USER', 3))
+ORDER_RATE_PER_GUILD = float(os.getenv('ORDER_RATE_PER_GUILD', '2'))
+ORDER_BURST_PER_GUILD = int(os.getenv('ORDER_BURST_PER_GUILD', 60))
+THROTTLE_PRUNE_INTERVAL = float(os.getenv('THROTTLE_PRUNE_INTERVAL', 60))
+
+# シャーディング・クラスター構成
+# SHARD_COUNT未設定の場合はDiscordの推奨シャード数を使う。CLUSTER_COUNTが2以上の場合は
+# シャードを分割して子プロセス（クラスター）で実行し、親プロセスがWebエンドポイントを集約する
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', 0)) or None
+CLUSTER_COUNT = int(os.getenv('CLUSTER_COUNT', 1))
+CLUSTER_ID = os.getenv('CLUSTER_ID')  # クラスターの子プロセスでのみ設定される
+SHARD_IDS = os.getenv('SHARD_IDS')  # 担当するシャードID（カンマ区切り）
+IPC_DIR = os.getenv('IPC_DIR') or os.path.join(DATA_DIR, 'ipc')
+CLUSTER_RESTART_DELAY = float(os.getenv('CLUSTER_RESTART_DELAY', '5'))
+
+# 注文・在庫の操作ログ（ジャーナル、クラスターごとに別ディレクトリ）
+# 永続化ストレージへの書き込みより短い間隔でfsyncし、起動時にストレージに未反映の分を再生する
+JOURNAL_ENABLED = os.getenv('JOURNAL_ENABLED', '1') != '0'
+JOURNAL_DIR = os.getenv('JOURNAL_DIR') or os.path.join(
+    DATA_DIR, f'journal-cluster{CLUSTER_ID}' if CLUSTER_ID is not None else 'journal'
+)
+JOURNAL_FSYNC_INTERVAL = float(os.getenv('JOURNAL_FSYNC_INTERVAL', '0.05'))
+JOURNAL_SEGMENT_BYTES = int(os.getenv('JOURNAL_SEGMENT_BYTES', 64 * 1024 * 1024))
+
+# ログ設定
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+# 大量に発生するイベントを記録する割合（例: "order_created=0.1,inventory_added=0.5"）
+LOG_SAMPLE_RATES = {
+    event.strip(): float(rate)
+    for event, _, rate in (item.partition('=') for item in os.getenv('LOG_SAMPLE_RATES', '').split(',') if item.strip())
+}
+# 注文ステータス変更の監査ログ（クラスターごとに別ファイル）
+AUDIT_LOG_PATH = os.getenv('AUDIT_LOG_PATH') or os.path.join(
+    DATA_DIR, f'audit-cluster{CLUSTER_ID}.log' if CLUSTER_ID is not None else 'audit.log'
+)
+AUDIT_LOG_MAX_BYTES = int(os.getenv('AUDIT_LOG_MAX_BYTES', 10 * 1024 * 1024))
+AUDIT_LOG_BACKUPS = int(os.getenv('AUDIT_LOG_BACKUPS', 5))
+
+logger = logging.getLogger('vending')
+audit_logger = logging.getLogger('vending.audit')
+
+def log_event(event, message, level=logging.INFO, exc_info=None, **fields):
+    """構造化ログを出力
+
+    event: イベント名（集計・サンプリングのキー）
+    fields: guild_id・order_id・user_idなどの相関用の項目
+    """
+    logger.log(level, message, exc_info=exc_info, extra={'event': event, 'fields': fields})
+
+def audit_order(guild_id, order_id, order, previous_status):
+    """注文のステータス変更を監査ログに記録"""
+    audit_logger.info(
+        f'注文 #{order_id}: {previous_status} -> {order["status"]}',
+        extra={'event': 'order_transition', 'fields': {
+            'guild_id': guild_id,
+            'order_id': str(order_id),
+            'user_id': order.get('user_id'),
+            'product_id': order.get('product_id'),
+            'from_status': previous_status,
+            'to_status': order['status'],
+            'processed_by': order.get('processed_by')
+        }}
+    )
+
+class JsonFormatter(logging.Formatter):
+    """1行1レコードのJSON形式"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name
+        }
+        if CLUSTER_ID is not None:
+            entry['cluster'] = int(CLUSTER_ID)
+        event = getattr(record, 'event', None)
+        if event:
+            entry['event'] = event
+        entry['message'] = record.getMessage()
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class SamplingFilter(logging.Filter):
+    """LOG_SAMPLE_RATESで指定したイベントを一定の割合だけ通す（警告以上は常に通す）"""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self.sampled_out = {}  # {event: 間引いた件数}
+
+    def filter(self, record):
+        event = getattr(record, 'event', None)
+        rate = self.rates.get(event)
+        if rate is None or record.levelno >= logging.WARNING or random.random() < rate:
+            return True
+        self.sampled_out[event] = self.sampled_out.get(event, 0) + 1
+        return False
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """ログをキューに入れるだけのハンドラー
+
+    整形と書き込みはQueueListenerのスレッドで行い、イベントループを止めない。
+    キューが満杯の場合は待たずに破棄して件数を数える（上限の無いキューでは破棄しない）
+    """
+
+    def __init__(self, log_queue, rates=LOG_SAMPLE_RATES):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self.sampling = SamplingFilter(rates)
+        self.addFilter(self.sampling)
+
+    def prepare(self, record):
+        # 整形は書き込みスレッドで行うため、引数の展開と例外の文字列化だけ済ませる
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue.qsize(),
+            'dropped': self.dropped,
+            'sampled_out': dict(self.sampling.sampled_out)
+        }
+
+def setup_logging():
+    """全ロガー（discord.pyを含む）の出力をキュー経由でバックグラウンドスレッドから書き込む"""
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter())
+
+    queue_handler = LogQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+
+    listener = logging.handlers.QueueListener(queue_handler.queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    # 終了時にキューに残ったログを書き出す
+    atexit.register(listener.stop)
+
+    # 監査ログは専用の上限の無いキューとスレッドでファイルに書き、破棄も間引きもしない
+    # （標準出力にはほかのログと同じ経路でも流れる）
+    audit_error = None
+    try:
+        os.makedirs(os.path.dirname(AUDIT_LOG_PATH) or '.', exist_ok=True)
+        audit_handler = logging.handlers.RotatingFileHandler(
+            AUDIT_LOG_PATH, maxBytes=AUDIT_LOG_MAX_BYTES, backupCount=AUDIT_LOG_BACKUPS, encoding='utf-8'
+        )
+        audit_handler.setFormatter(JsonFormatter())
+        audit_queue_handler = LogQueueHandler(queue.Queue(), rates={})
+        audit_logger.handlers = [audit_queue_handler]
+        audit_logger.setLevel(logging.INFO)
+        audit_listener = logging.handlers.QueueListener(audit_queue_handler.queue, audit_handler)
+        audit_listener.start()
+        atexit.register(audit_listener.stop)
+    except OSError as e:
+        audit_error = e
+
+    if audit_error is not None:
+        log_event('audit_log_unavailable', f'監査ログファイルを開けませんでした: {audit_error}', logging.WARNING, path=AUDIT_LOG_PATH)
+    return queue_handler
+
+# 在庫ファイルの先頭側がこの件数を超えて消費されたら詰め直す
+INVENTORY_COMPACT_MIN = 65536
+
+def write_durable(path, payload):
+    """ファイルを書き込んでfsyncする"""
+    with open(path, 'wb') as target_file:
+        target_file.write(payload)
+        target_file.flush()
+        os.fsync(target_file.fileno())
+
+def fsync_path(path):
+    """ファイルの内容やディレクトリのエントリ（作成・名前変更）をディスクに反映する"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+class InventoryQueue:
+    """在庫アイテムのキュー（追記専用ファイル＋オフセットインデックス）
+
+    .dat: アイテム本文（UTF-8）を順に追記
+    .idx: 各アイテムの終了オフセット（8バイト）を順に追記
+    先頭の取り出しはheadを進めるだけで、本文はmmap経由で読み込む
+
+    消費済みの先頭部分を詰め直すときは新しい世代のファイルを書き、.genファイル（世代の先頭が
+    通し番号で何件目か）の置き換えで切り替える。保存するheadは通し番号なので、詰め直した後に
+    headの保存前に終了しても、読み込み時に今の世代のファイル上の位置に直せる
+    """
+
+    def __init__(self, path, head=0, front=None, reset=False):
+        self.path = path
+        self.generation_path = path + '.gen'
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.base = 0  # ファイル先頭のアイテムの通し番号
+        if os.path.exists(self.generation_path):
+            with open(self.generation_path, 'rb') as generation_file:
+                self.base = int(generation_file.read().strip() or 0)
+        self.data_path, self.index_path = self._paths(self.base)
+        if reset:
+            for file_path in (self.data_path, self.index_path):
+                open(file_path, 'wb').close()
+
+        self.head = head
+        self.front = deque(front or [])  # 先頭に戻されたアイテム
+        self.data_map = None
+        self.index_map = None
+        self.unsynced = False  # 追記した本文がまだfsyncされていないか
+        self.holds = 0  # 開いているスナップショット・書き込み中の追記の数（その間は詰め直さない）
+        self.append_lock = None  # 追記を1つずつ行うためのロック（最初の追記で作る）
+
+        # 書き込み途中で終了した場合の端数は無視する
+        index_size = os.path.getsize(self.index_path) if os.path.exists(self.index_path) else 0
+        self.count = index_size // 8
+        self.end_offset = self._read_end(self.count - 1) if self.count else 0
+        self.head = min(max(self.head - self.base, 0), self.count)
+
+    def _paths(self, base):
+        """世代のファイルパス（最初の世代は従来どおりの名前）"""
+        prefix = self.path if base == 0 else f'{self.path}.{base}'
+        return prefix + '.dat', prefix + '.idx'
+
+    def __len__(self):
+        return len(self.front) + self.count - self.head
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __iter__(self):
+        yield from list(self.front)
+        for position in range(self.head, self.count):
+            yield self._read(position)
+
+    def _remap(self):
+        """ファイルの伸長に合わせてmmapを作り直す"""
+        self.close()
+        if self.count == 0:
+            return
+        with open(self.index_path, 'rb') as index_file:
+            self.index_map = mmap.mmap(index_file.fileno(), self.count * 8, access=mmap.ACCESS_READ)
+        if self.end_offset:
+            with open(self.data_path, 'rb') as data_file:
+                self.data_map = mmap.mmap(data_file.fileno(), self.end_offset, access=mmap.ACCESS_READ)
+
+    def _read_end(self, position):
+        if self.index_map is None or len(self.index_map) < (position + 1) * 8:
+            with open(self.index_path, 'rb') as index_file:
+                index_file.seek(position * 8)
+                return int.from_bytes(index_file.read(8), 'little')
+        return int.from_bytes(self.index_map[position * 8:(position + 1) * 8], 'little')
+
+    def _read(self, position):
+        if self.index_map is None or len(self.index_map) < self.count * 8:
+            self._remap()
+        start = self._read_end(position - 1) if position > 0 else 0
+        end = self._read_end(position)
+        return self.data_map[start:end].decode('utf-8')
+
+    def extend(self, items):
+        """在庫アイテムを末尾に追加（起動時の移行など、他の操作と並行しない場合に使う）"""
+        self._commit(*self._write(items, self.data_path, self.index_path, self.end_offset, self.count))
+
+    async def extend_async(self, items):
+        """在庫アイテムを末尾に追加（ファイルへの書き込みはスレッドで行う）
+
+        書き込み中は詰め直しを止め、件数は書き込みが終わってからイベントループで進める。
+        書き込み中も既存のアイテムは取り出せる（追記は末尾より後ろにしか書かない）
+        """
+        items = list(items)
+        if self.append_lock is None:
+            self.append_lock = asyncio.Lock()
+        async with self.append_lock:
+            self.holds += 1
+            try:
+                written = await asyncio.to_thread(self._write, items, self.data_path, self.index_path, self.end_offset, self.count)
+            finally:
+                self.holds -= 1
+            self._commit(*written)
+            self._maintain()
+
+    @classmethod
+    def _write(cls, items, data_path, index_path, end_offset, count):
+        """アイテムをファイルの末尾に書き込む（書き込んだ分の終了オフセットの配列を返す）"""
+        ends = array('Q')
+        chunks = []
+        offset = end_offset
+        for item in items:
+            encoded = item.encode('utf-8')
+            chunks.append(encoded)
+            offset += len(encoded)
+            ends.append(offset)
+        if not chunks:
+            return ends, end_offset
+
+        # 本文を先に書き、インデックスの追記で確定させる
+        with open(data_path, 'r+b' if os.path.exists(data_path) else 'wb') as data_file:
+            data_file.seek(end_offset)
+            data_file.write(b''.join(chunks))
+            data_file.truncate()
+        with open(index_path, 'r+b' if os.path.exists(index_path) else 'wb') as index_file:
+            index_file.seek(count * 8)
+            index_file.write(cls._pack(ends))
+            index_file.truncate()
+        return ends, offset
+
+    def _commit(self, ends, offset):
+        if not ends:
+            return
+        self.count += len(ends)
+        self.end_offset = offset
+        self.unsynced = True
+
+    def take_unsynced(self):
+        """fsyncが必要なファイル（本文、インデックスの順）を返し、同期済みとして扱う"""
+        if not self.unsynced:
+            return []
+        self.unsynced = False
+        return [self.data_path, self.index_path]
+
+    @contextlib.contextmanager
+    def snapshot(self):
+        """現在の在庫を読み込むイテレータを返すコンテキストマネージャー
+
+        イテレータは独自にファイルを開くため別スレッドで読める。開いている間は詰め直し・切り詰めを
+        止め、読んでいる世代のファイルが置き換わらないようにする（出入りはイベントループで行う）
+        """
+        front = list(self.front)
+        head, count = self.head, self.count
+        index_path, data_path = self.index_path, self.data_path
+
+        def iterate():
+            yield from front
+            if head >= count:
+                return
+            with open(index_path, 'rb') as index_file, open(data_path, 'rb') as data_file:
+                ends = array('Q')
+                index_file.seek(head * 8)
+                ends.frombytes(index_file.read((count - head) * 8))
+                if sys.byteorder != 'little':
+                    ends.byteswap()
+                start = 0
+                if head > 0:
+                    index_file.seek((head - 1) * 8)
+                    start = int.from_bytes(index_file.read(8), 'little')
+                data_file.seek(start)
+                for end in ends:
+                    yield data_file.read(end - start).decode('utf-8')
+                    start = end
+
+        self.holds += 1
+        try:
+            yield iterate()
+        finally:
+            self.holds -= 1
+            self._maintain()
+
+    @staticmethod
+    def _pack(ends):
+        """オフセット配列をリトルエンディアンのバイト列に変換"""
+        if sys.byteorder != 'little':
+            ends = array('Q', ends)
+            ends.byteswap()
+        return ends.tobytes()
+
+    def append(self, item):
+        self.extend([item])
+
+    def popleft(self):
+        """先頭の在庫アイテムを取り出す"""
+        if self.front:
+            return self.front.popleft()
+        if self.head >= self.count:
+            raise IndexError('pop from empty inventory')
+
+        item = self._read(self.head)
+        self.head += 1
+        self._maintain()
+        return item
+
+    def _maintain(self):
+        """消費済みの先頭部分が溜まっていればファイルを詰め直す（スナップショット・追記の間は後回し）"""
+        if self.holds or self.head == 0:
+            return
+        if self.head == self.count:
+            # 空になったらファイルを切り詰める
+            self._truncate()
+        elif self.head >= INVENTORY_COMPACT_MIN and self.head * 2 >= self.count:
+            self.compact()
+
+    def appendleft(self, item):
+        """取り出した在庫アイテムを先頭に戻す"""
+        if not self.front and self.head > 0 and self._read(self.head - 1) == item:
+            self.head -= 1
+        else:
+            self.front.appendleft(item)
+
+    def _truncate(self):
+        self._rewrite(self.count, b'', array('Q'))
+        self.head = 0
+        self.count = 0
+        self.end_offset = 0
+
+    def _rewrite(self, dropped, data, ends):
+        """先頭のdropped件を除いた新しい世代のファイルに切り替える
+
+        新しい世代の.dat/.idxをfsyncしてから.genを置き換える（ここが切り替えの確定点）
+        """
+        base = self.base + dropped
+        data_path, index_path = self._paths(base)
+        write_durable(data_path, data)
+        write_durable(index_path, self._pack(ends))
+        write_durable(self.generation_path + '.tmp', str(base).encode('ascii'))
+        os.replace(self.generation_path + '.tmp', self.generation_path)
+        fsync_path(os.path.dirname(self.path) or '.')
+
+        self.close()
+        for file_path in (self.data_path, self.index_path):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(file_path)
+        self.base = base
+        self.data_path, self.index_path = data_path, index_path
+        self.unsynced = False
+
+    def compact(self):
+        """消費済みの先頭部分をファイルから取り除く"""
+        if self.head == 0:
+            return
+        if self.index_map is None or len(self.index_map) < self.count * 8:
+            self._remap()
+
+        base = self._read_end(self.head - 1)
+        data = self.data_map[base:self.end_offset]
+        ends = array('Q')
+        ends.frombytes(self.index_map[self.head * 8:self.count * 8])
+        if sys.byteorder != 'little':
+            ends.byteswap()
+        ends = array('Q', [end - base for end in ends])
+
+        self._rewrite(self.head, data, ends)
+        self.count -= self.head
+        self.end_offset -= base
+        self.head = 0
+
+    def close(self):
+        for file_map in (self.data_map, self.index_map):
+            if file_map is not None:
+                file_map.close()
+        self.data_map = None
+        self.index_map = None
+
+    def to_state(self):
+        """保存用の状態（本文はファイル側にある、headは通し番号）"""
+        return {'head': self.base + self.head, 'front': list(self.front)}
+
+class StorageBackend:
+    """永続化バックエンドの基底クラス（何も保存しないメモリのみの実装）"""
+
+    # 保存したデータを読み込み直せるか（Falseの場合はサーバーデータをメモリから外さない）
+    persistent = False
+
+    def open(self):
+        pass
+
+    def close(self):
+        # 在庫ファイル用の一時ディレクトリを片付ける
+        if hasattr(self, 'temp_dir'):
+            shutil.rmtree(self.temp_dir, ignore_errors=True)
+            del self.temp_dir
+
+    def load_guild(self, guild_id):
+        """サーバーの保存データを読み込む（存在しない場合はNone）"""
+        return None
+
+    def inventory_dir(self, guild_id):
+        """サーバーの在庫ファイルを置くディレクトリ"""
+        if not hasattr(self, 'temp_dir'):
+            self.temp_dir = tempfile.mkdtemp(prefix='vending-inventory-')
+        return os.path.join(self.temp_dir, str(guild_id))
+
+    def archive_dir(self, guild_id):
+        """サーバーのアーカイブ済み注文を置くディレクトリ"""
+        return os.path.join(os.path.dirname(self.inventory_dir(guild_id)), 'archive', str(guild_id))
+
+    def archive_orders(self, guild_id, orders):
+        """注文をgzipファイル（JSON Lines）に書き出す orders: [(order_id, order)]
+
+        1回分ごとに新しいファイルへ書いてから名前を変えるため、書き込み途中で落ちても
+        読めないファイルは残らない（ファイル名は orders-日付-時刻ns.jsonl.gz で名前順が書き込み順）
+        """
+        directory = self.archive_dir(guild_id)
+        os.makedirs(directory, exist_ok=True)
+        name = f'orders-{datetime.now(timezone.utc):%Y%m%d}-{time.time_ns()}.jsonl.gz'
+        path = os.path.join(directory, name)
+        lines = ''.join(json.dumps(dict(order, order_id=order_id), ensure_ascii=False) + '\n' for order_id, order in orders)
+        write_durable(path + '.tmp', gzip.compress(lines.encode('utf-8')))
+        os.replace(path + '.tmp', path)
+        fsync_path(directory)
+        return name
+
+    def archive_files(self, guild_id, order_id=None, user_id=None):
+        """条件に合う注文を含むアーカイブファイル名（索引が無い場合はNoneで、すべてのファイルを読む）"""
+        return None
+
+    def archived_orders(self, guild_id, files=None):
+        """アーカイブ済みの注文を古い順に読み込むイテレータ（filesを指定した場合はそのファイルだけ読む）"""
+        directory = self.archive_dir(guild_id)
+        if not os.path.isdir(directory):
+            return
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith('.jsonl.gz') or (files is not None and name not in files):
+                continue
+            try:
+                with gzip.open(os.path.join(directory, name), 'rt', encoding='utf-8') as archive_file:
+                    for line in archive_file:
+                        if line.strip():
+                            yield json.loads(line)
+            except (EOFError, gzip.BadGzipFile, json.JSONDecodeError) as e:
+                # 旧形式（日ごとのファイルに追記）で書き込み途中に落ちたファイルは読めた所までを使う
+                log_event('order_archive_truncated', f'アーカイブファイルの末尾が壊れています ({name}): {e}', logging.WARNING, guild_id=guild_id, file=name, error=str(e))
+
+    def write_batch(self, ops):
+        """書き込み操作をまとめて反映する
+
+        ops: [(kind, guild_id, key, data)] kindは 'guild' / 'product' / 'order' / 'sale' / 'payment_link' / 'archived_order' / 'meta' / 'delete_guild'
+        dataがNoneの場合は削除（'sale'のdataは売上集計への加算分 (units, revenue)、
+        'payment_link'のkeyはリンクのハッシュ値でdataは最初に使われた注文ID、
+        'archived_order'のkeyは (注文ID, 購入者ID, アーカイブファイル名) でdataは使わない、'meta'はget_metaで読める値）
+        """
+        pass
+
+    def orders_with_status(self, status):
+        """全サーバーから指定ステータスの注文を取得 [(guild_id, order_id, timestamp)]"""
+        return []
+
+    def sales_by_day(self, guild_id, since_hour, offset_hours, product_id=None):
+        """売上集計を商品・日ごとに合計 [(product_id, day, units, revenue)]
+
+        dayはoffset_hoursだけずらした時刻での1970-01-01からの日数
+        """
+        return []
+
+    def payment_link_order(self, guild_id, digest):
+        """決済リンクのハッシュ値を最初に使った注文ID（未使用の場合はNone）"""
+        return None
+
+    def product_names(self, guild_id):
+        """保存済みの商品名 {product_id: name}"""
+        return {}
+
+    def payment_link_digests(self, guild_id):
+        """サーバーで使われた決済リンクのハッシュ値をすべて返すイテレータ"""
+        return iter(())
+
+    def get_meta(self, key, default=None):
+        return default
+
+    def set_meta(self, key, value):
+        pass
+
+class SQLiteStorage(StorageBackend):
+    """SQLite（WALモード）による永続化"""
+
+    persistent = True
+
+    def __init__(self, path):
+        self.path = path
+        self.write_conn = None
+        self.write_lock = threading.Lock()
+        # 読み込みはスレッドごとの接続で行う（to_threadのワーカーから同時に読んでも接続を共有しない）
+        self.local = threading.local()
+        self.read_conns = []  # 開いた読み込み用接続（close用）
+        self.read_conns_lock = threading.Lock()
+        self.opened = 0  # open()の回数（閉じた後に古い接続を使わないため）
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA busy_timeout=5000')
+        return conn
+
+    @property
+    def read_conn(self):
+        """呼び出したスレッドの読み込み用接続（初回に開く）"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.opened != self.opened:
+            conn = self._connect()
+            self.local.conn = conn
+            self.local.opened = self.opened
+            with self.read_conns_lock:
+                self.read_conns.append(conn)
+        return conn
+
+    def open(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        # 書き込み用（ワーカースレッド）と読み込み用（スレッドごと）で接続を分ける
+        self.opened += 1
+        self.write_conn = self._connect()
+        self.write_conn.executescript("""
+            CREATE TABLE IF NOT EXISTS guilds (
+                guild_id INTEGER PRIMARY KEY,
+                data TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS products (
+                guild_id INTEGER NOT NULL,
+                product_id TEXT NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (guild_id, product_id)
+            );
+            CREATE TABLE IF NOT EXISTS orders (
+                guild_id INTEGER NOT NULL,
+                order_id TEXT NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (guild_id, order_id)
+            );
+            CREATE TABLE IF NOT EXISTS sales (
+                guild_id INTEGER NOT NULL,
+                product_id TEXT NOT NULL,
+                hour INTEGER NOT NULL,
+                units INTEGER NOT NULL,
+                revenue INTEGER NOT NULL,
+                PRIMARY KEY (guild_id, hour, product_id)
+            );
+            CREATE TABLE IF NOT EXISTS payment_links (
+                guild_id INTEGER NOT NULL,
+                digest INTEGER NOT NULL,
+                order_id TEXT NOT NULL,
+                PRIMARY KEY (guild_id, digest)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS archived_orders (
+                guild_id INTEGER NOT NULL,
+                order_id TEXT NOT NULL,
+                user_id TEXT,
+                file TEXT NOT NULL,
+                PRIMARY KEY (guild_id, order_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS archived_orders_user ON archived_orders (guild_id, user_id);
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+        """)
+
+    def inventory_dir(self, guild_id):
+        return os.path.join(os.path.dirname(self.path), 'inventory', str(guild_id))
+
+    def archive_dir(self, guild_id):
+        return os.path.join(os.path.dirname(self.path), 'archive', str(guild_id))
+
+    def close(self):
+        with self.read_conns_lock:
+            conns, self.read_conns = self.read_conns, []
+        for conn in conns + [self.write_conn]:
+            if conn:
+                conn.close()
+        self.write_conn = None
+        self.opened += 1
+
+    def load_guild(self, guild_id):
+        row = self.read_conn.execute('SELECT data FROM guilds WHERE guild_id = ?', (guild_id,)).fetchone()
+        if row is None:
+            return None
+
+        data = json.loads(row[0])
+        data['products'] = {
+            product_id: json.loads(product_data)
+            for product_id, product_data in self.read_conn.execute(
+                'SELECT product_id, data FROM products WHERE guild_id = ?', (guild_id,)
+            )
+        }
+        data['orders'] = {
+            order_id: json.loads(order_data)
+            for order_id, order_data in self.read_conn.execute(
+                'SELECT order_id, data FROM orders WHERE guild_id = ?', (guild_id,)
+            )
+        }
+        return data
+
+    def write_batch(self, ops):
+        with self.write_lock:
+            conn = self.write_conn
+            conn.execute('BEGIN')
+            try:
+                for kind, guild_id, key, data in ops:
+                    if kind == 'guild':
+                        if data is None:
+                            conn.execute('DELETE FROM guilds WHERE guild_id = ?', (guild_id,))
+                        else:
+                            conn.execute('INSERT OR REPLACE INTO guilds (guild_id, data) VALUES (?, ?)', (guild_id, data))
+                    elif kind == 'product':
+                        if data is None:
+                            conn.execute('DELETE FROM products WHERE guild_id = ? AND product_id = ?', (guild_id, key))
+                        else:
+                            conn.execute('INSERT OR REPLACE INTO products (guild_id, product_id, data) VALUES (?, ?, ?)', (guild_id, key, data))
+                    elif kind == 'order':
+                        if data is None:
+                            conn.execute('DELETE FROM orders WHERE guild_id = ? AND order_id = ?', (guild_id, key))
+                        else:
+                            conn.execute('INSERT OR REPLACE INTO orders (guild_id, order_id, data) VALUES (?, ?, ?)', (guild_id, key, data))
+                    elif kind == 'sale':
+                        # dataは前回の書き込みからの加算分 (units, revenue)
+                        product_id, hour = key
+                        conn.execute(
+                            'INSERT INTO sales (guild_id, product_id, hour, units, revenue) VALUES (?, ?, ?, ?, ?) '
+                            'ON CONFLICT (guild_id, hour, product_id) DO UPDATE SET '
+                            'units = units + excluded.units, revenue = revenue + excluded.revenue',
+                            (guild_id, product_id, hour, data[0], data[1])
+                        )
+                    elif kind == 'meta':
+                        conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, data))
+                    elif kind == 'payment_link':
+                        # 最初に使われた注文を残す
+                        conn.execute(
+                            'INSERT OR IGNORE INTO payment_links (guild_id, digest, order_id) VALUES (?, ?, ?)',
+                            (guild_id, key, data)
+                        )
+                    elif kind == 'archived_order':
+                        order_id, user_id, file = key
+                        conn.execute(
+                            'INSERT OR REPLACE INTO archived_orders (guild_id, order_id, user_id, file) VALUES (?, ?, ?, ?)',
+                            (guild_id, order_id, user_id, file)
+                        )
+                    elif kind == 'delete_guild':
+                        conn.execute('DELETE FROM guilds WHERE guild_id = ?', (guild_id,))
+                        conn.execute('DELETE FROM products WHERE guild_id = ?', (guild_id,))
+                        conn.execute('DELETE FROM orders WHERE guild_id = ?', (guild_id,))
+                        conn.execute('DELETE FROM sales WHERE guild_id = ?', (guild_id,))
+                        conn.execute('DELETE FROM payment_links WHERE guild_id = ?', (guild_id,))
+                        conn.execute('DELETE FROM archived_orders WHERE guild_id = ?', (guild_id,))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+
+    def orders_with_status(self, status):
+        row_iter = self.read_conn.execute(
+            "SELECT guild_id, order_id, json_extract(data, '$.timestamp') FROM orders "
+            "WHERE json_extract(data, '$.status') = ?",
+            (status,)
+        )
+        return [(guild_id, order_id, timestamp or 0) for guild_id, order_id, timestamp in row_iter]
+
+    def sales_by_day(self, guild_id, since_hour, offset_hours, product_id=None):
+        query = (
+            'SELECT product_id, (hour + ?) / 24 AS day, SUM(units), SUM(revenue) FROM sales '
+            'WHERE guild_id = ? AND hour >= ?'
+        )
+        params = [offset_hours, guild_id, since_hour]
+        if product_id is not None:
+            query += ' AND product_id = ?'
+            params.append(product_id)
+        query += ' GROUP BY product_id, day'
+        return self.read_conn.execute(query, params).fetchall()
+
+    def payment_link_order(self, guild_id, digest):
+        row = self.read_conn.execute(
+            'SELECT order_id FROM payment_links WHERE guild_id = ? AND digest = ?', (guild_id, digest)
+        ).fetchone()
+        return row[0] if row else None
+
+    def product_names(self, guild_id):
+        return dict(self.read_conn.execute(
+            "SELECT product_id, json_extract(data, '$.name') FROM products WHERE guild_id = ?", (guild_id,)
+        ))
+
+    def archive_files(self, guild_id, order_id=None, user_id=None):
+        # 索引の無い旧形式のファイル（日ごとに追記したもの）は常に読む
+        directory = self.archive_dir(guild_id)
+        files = {
+            name for name in (os.listdir(directory) if os.path.isdir(directory) else ())
+            if name.startswith('orders-') and len(name) == len('orders-YYYYMMDD.jsonl.gz') and name.endswith('.jsonl.gz')
+        }
+        query = 'SELECT DISTINCT file FROM archived_orders WHERE guild_id = ?'
+        params = [guild_id]
+        if order_id is not None:
+            query += ' AND order_id = ?'
+            params.append(order_id)
+        if user_id is not None:
+            query += ' AND user_id = ?'
+            params.append(user_id)
+        files.update(file for (file,) in self.read_conn.execute(query, params))
+        return files
+
+    def payment_link_digests(self, guild_id):
+        for (digest,) in self.read_conn.execute('SELECT digest FROM payment_links WHERE guild_id = ?', (guild_id,)):
+            yield digest
+
+    def get_meta(self, key, default=None):
+        row = self.read_conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        with self.write_lock:
+            self.write_conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+def create_storage():
+    """設定に応じて永続化バックエンドを作成"""
+    if STORAGE_BACKEND == 'memory':
+        return StorageBackend()
+    return SQLiteStorage(os.path.join(DATA_DIR, 'vending.db'))
+
+class OrderJournal:
+    """注文・在庫の変更を追記する操作ログ（ジャーナル）
+
+    1行が1イベントで「seq, 時刻, kind, guild_id, key(JSON), データ(JSON)」をタブ区切りで書く。
+    - 'order' / 'product' / 'delete_guild': 変更後の状態（同じループの処理中に何度も変わったキーは1イベントにまとめる）
+    - 'transition': 注文ステータスの遷移 {'from', 'to', ...}（まとめずにすべて残す）
+    - 'sale' / 'payment_link': 売上集計への加算分・決済リンクの初回使用（まとめずにすべて残す）
+    ファイルへの書き込みとfsyncはJOURNAL_FSYNC_INTERVALごとにまとめて行い、商品の状態を書く前に
+    追記された在庫ファイルもfsyncする。永続化ストレージへの書き込みと同じトランザクションで
+    反映済みのseq（スナップショット）を記録し、それ以前のイベントだけのセグメントはarchive/に圧縮して移す。
+    起動時はスナップショットより後のイベントだけを読み、状態はキーごとに最後のものを、加算分は合計を適用する
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.directory = JOURNAL_DIR
+        self.meta_key = f'journal_seq:{CLUSTER_ID}' if CLUSTER_ID is not None else 'journal_seq'
+        self.enabled = False
+        self.seq = 0  # 最後に割り当てたseq
+        self.durable_seq = 0  # fsync済みのseq
+        self.snapshot_seq = 0  # ストレージに反映済みのseq
+        self.changed = {}  # {(kind, guild_id, key): None} このループの処理中に変わったキー
+        self.scheduled = False
+        self.buffer = []  # 未書き込みの行
+        self.files = []  # 次の書き込みの前にfsyncする在庫ファイル
+        self.event = asyncio.Event()
+        self.lock = asyncio.Lock()
+        self.segments = []  # [(先頭のseq, パス)] 古い順
+        self.file = None
+        self.replayed = 0
+        self.archiving = False
+        self.archived = 0
+
+    @staticmethod
+    def segment_path(directory, first_seq):
+        return os.path.join(directory, f'journal-{first_seq:016d}.log')
+
+    def list_segments(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(
+            (int(name[len('journal-'):-len('.log')]), os.path.join(self.directory, name))
+            for name in os.listdir(self.directory)
+            if name.startswith('journal-') and name.endswith('.log')
+        )
+
+    def replay(self, after_seq):
+        """after_seqより後のイベントをキーごとの最後の状態にまとめる（別スレッドで実行）
+
+        戻り値は (最後のseq, 読んだイベント数, {(kind, guild_id, key): 状態のJSON}, 加算分)。
+        加算分は {('sale', guild_id, (product_id, hour)): [units, revenue], ('payment_link', guild_id, digest): order_id,
+        ('archived_order', guild_id, (order_id, user_id, file)): None}。
+        状態のJSONは適用するものだけを後で解析する。書き込み途中で終了した末尾の行は無視する
+        """
+        segments = self.list_segments()
+        last_seq = after_seq
+        count = 0
+        latest = {}
+        deltas = {}
+        for index, (first_seq, path) in enumerate(segments):
+            if index + 1 < len(segments) and segments[index + 1][0] <= after_seq + 1:
+                continue
+            with open(path, 'rb') as segment_file:
+                for line in segment_file:
+                    if not line.endswith(b'\n'):
+                        break
+                    seq, _, kind, guild_id, key, data = line.split(b'\t', 5)
+                    seq = int(seq)
+                    if seq <= after_seq:
+                        continue
+                    last_seq = seq
+                    count += 1
+                    if kind == b'transition':
+                        # 遷移は監査用（状態は'order'のイベントで復元する）
+                        continue
+                    if kind == b'sale':
+                        product_id, hour = json.loads(key)
+                        units, revenue = json.loads(data)
+                        delta = deltas.setdefault(('sale', int(guild_id), (product_id, hour)), [0, 0])
+                        delta[0] += units
+                        delta[1] += revenue
+                        continue
+                    if kind == b'payment_link':
+                        deltas.setdefault(('payment_link', int(guild_id), json.loads(key)), json.loads(data))
+                        continue
+                    if kind == b'archived_order':
+                        deltas[('archived_order', int(guild_id), tuple(json.loads(key)))] = None
+                        continue
+                    if kind == b'delete_guild':
+                        # 退出したサーバーのそれまでのイベントは適用しない
+                        for entry in [entry for entry in latest if entry[1] == guild_id]:
+                            del latest[entry]
+                        for entry in [entry for entry in deltas if entry[1] == int(guild_id)]:
+                            del deltas[entry]
+                    latest[(kind, guild_id, key)] = data
+        return last_seq, count, {
+            (kind.decode(), int(guild_id), json.loads(key)): data
+            for (kind, guild_id, key), data in latest.items()
+        }, deltas
+
+    def open(self, last_seq, snapshot_seq):
+        """新しいセグメントを開いて記録を開始（前回のセグメントの途中の行に続けて書かないよう毎回分ける）"""
+        os.makedirs(self.directory, exist_ok=True)
+        self.seq = self.durable_seq = last_seq
+        self.snapshot_seq = snapshot_seq
+        self.segments = self.list_segments()
+        self.rotate()
+        self.enabled = True
+
+    def rotate(self):
+        """次に書き込むseqから始まるセグメントに切り替える
+
+        同名のファイルがある場合は書き込み途中で終了した行だけなので空にする
+        """
+        if self.file is not None:
+            self.file.close()
+        first_seq = self.durable_seq + 1
+        path = self.segment_path(self.directory, first_seq)
+        self.file = open(path, 'wb')
+        if not self.segments or self.segments[-1][1] != path:
+            self.segments.append((first_seq, path))
+
+    def record(self, kind, guild_id, key):
+        """変更されたキーを記録（状態はループの処理が一区切りしてからまとめて書く）"""
+        if not self.enabled:
+            return
+        self.changed[(kind, guild_id, key)] = None
+        if not self.scheduled:
+            self.scheduled = True
+            asyncio.get_running_loop().call_soon(self.serialize)
+
+    def append(self, kind, guild_id, key, data):
+        """1イベントをそのまま記録（遷移や加算分のようにまとめられないもの）"""
+        if not self.enabled:
+            return
+        self.seq += 1
+        self.buffer.append(self.format_event(self.seq, time.time(), kind, guild_id, key, json.dumps(data, ensure_ascii=False)))
+        self.event.set()
+
+    def serialize(self):
+        """変更されたキーの現在の状態をイベントの行にする"""
+        self.scheduled = False
+        if not self.changed:
+            return
+        changed = self.changed
+        self.changed = {}
+        now = time.time()
+        for kind, guild_id, key in changed:
+            if kind == 'product':
+                # 在庫の件数を記録する前に追記された本文をディスクに反映する
+                inventory = self.bot.inventory_of(guild_id, key)
+                if inventory is not None:
+                    self.files.extend(inventory.take_unsynced())
+            self.seq += 1
+            self.buffer.append(self.format_event(self.seq, now, kind, guild_id, key, self.bot.serialize_entry(kind, guild_id, key)))
+        self.event.set()
+
+    @staticmethod
+    def format_event(seq, timestamp, kind, guild_id, key, data):
+        """イベントの1行（dataは状態のJSON、削除の場合はNone）"""
+        return f'{seq}\t{timestamp:.3f}\t{kind}\t{guild_id}\t{json.dumps(key, ensure_ascii=False)}\t{data or "null"}\n'.encode('utf-8')
+
+    @staticmethod
+    def write(segment_file, lines, files):
+        # 在庫ファイルが詰め直しで消えていた場合は新しい世代が同期済み
+        for path in files:
+            fsync_path(path)
+        segment_file.write(b''.join(lines))
+        segment_file.flush()
+        os.fsync(segment_file.fileno())
+
+    async def sync(self):
+        """未書き込みのイベントを書き込んでfsyncする"""
+        async with self.lock:
+            self.serialize()
+            self.event.clear()
+            if not self.buffer:
+                return
+            lines, files = self.buffer, self.files
+            seq = self.seq
+            self.buffer, self.files = [], []
+            try:
+                await asyncio.to_thread(self.write, self.file, lines, files)
+            except Exception:
+                # 失敗した分は次回に再試行する
+                self.buffer[:0] = lines
+                self.files[:0] = files
+                self.event.set()
+                raise
+            self.durable_seq = seq
+            if self.file.tell() >= JOURNAL_SEGMENT_BYTES:
+                self.rotate()
+
+    async def run(self):
+        """イベントを一定間隔でまとめて書き込むバックグラウンドタスク"""
+        while True:
+            await self.event.wait()
+            await asyncio.sleep(JOURNAL_FSYNC_INTERVAL)
+            try:
+                await self.sync()
+            except Exception as e:
+                log_event('journal_write_failed', f'ジャーナル書き込みエラー: {e}', logging.ERROR, exc_info=True)
+
+    async def compact(self, snapshot_seq):
+        """ストレージに反映済みのイベントだけを含むセグメントをアーカイブに移す"""
+        self.snapshot_seq = max(self.snapshot_seq, snapshot_seq)
+        if self.archiving:
+            return
+        self.archiving = True
+        try:
+            while len(self.segments) > 1 and self.segments[1][0] <= self.snapshot_seq + 1:
+                await asyncio.to_thread(self.archive_segment, self.segments[0][1])
+                self.segments.pop(0)
+                self.archived += 1
+        finally:
+            self.archiving = False
+
+    def archive_segment(self, path):
+        """セグメントをgzipで圧縮してarchive/に移す（監査用に残し、再生には使わない）"""
+        archive_dir = os.path.join(self.directory, 'archive')
+        os.makedirs(archive_dir, exist_ok=True)
+        target = os.path.join(archive_dir, os.path.basename(path) + '.gz')
+        if os.path.exists(path):
+            with open(path, 'rb') as segment_file, open(target + '.tmp', 'wb') as archive_file:
+                with gzip.GzipFile(fileobj=archive_file, mode='wb') as compressed:
+                    shutil.copyfileobj(segment_file, compressed)
+                archive_file.flush()
+                os.fsync(archive_file.fileno())
+            os.replace(target + '.tmp', target)
+            fsync_path(archive_dir)
+            os.remove(path)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.enabled = False
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'seq': self.seq,
+            'durable_seq': self.durable_seq,
+            'snapshot_seq': self.snapshot_seq,
+            'segments': len(self.segments),
+            'archived_segments': self.archived,
+            'buffered': len(self.buffer),
+            'replayed': self.replayed
+        }
+
+class TimingWheel:
+    """ハッシュ化タイミングホイール
+
+    期限をtick単位の時刻に丸めてスロットに振り分ける。登録・取消はO(1)で、
+    1周以上先の期限はスロットに残したまま該当時刻まで持ち越す
+    """
+
+    def __init__(self, tick=1.0, slot_count=4096):
+        self.tick = tick
+        self.slots = [{} for _ in range(slot_count)]  # [{key: 期限tick}]
+        self.entries = {}  # {key: スロット番号}
+        self.current = int(time.time() // tick)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def schedule(self, key, deadline):
+        """keyをdeadline（UNIX時刻）に期限切れとして登録（既存の登録は置き換え）"""
+        self.cancel(key)
+        target = max(int(deadline // self.tick), self.current + 1)
+        slot = target % len(self.slots)
+        self.slots[slot][key] = target
+        self.entries[key] = slot
+
+    def cancel(self, key):
+        slot = self.entries.pop(key, None)
+        if slot is not None:
+            self.slots[slot].pop(key, None)
+
+    def advance(self, now):
+        """nowまで時計を進め、期限切れになったkeyを返す"""
+        now_tick = int(now // self.tick)
+        steps = min(now_tick - self.current, len(self.slots))
+        expired = []
+        for step in range(1, steps + 1):
+            slot = self.slots[(self.current + step) % len(self.slots)]
+            if not slot:
+                continue
+            for key, target in list(slot.items()):
+                if target <= now_tick:
+                    del slot[key]
+                    del self.entries[key]
+                    expired.append(key)
+        self.current = max(self.current, now_tick)
+        return expired
+
+class OrderStore:
+    """サーバーの注文（{order_id: order}）とステータス・購入者の索引
+
+    ステータスの変更は set_status を通して索引を更新する。
+    ステータスごとの索引はそのステータスになった順に並ぶため、古い完了済み注文は先頭から辿れる
+    """
+
+    def __init__(self, orders=None):
+        self.orders = {}
+        self.by_status = {}  # {status: {order_id: そのステータスになった時刻}}
+        self.by_user = {}  # {user_id: {order_id: None}}
+        # 読み込んだ注文は処理時刻順に索引へ入れる
+        for order_id, order in sorted((orders or {}).items(), key=lambda item: self.order_time(item[1])):
+            self[order_id] = order
+
+    @staticmethod
+    def order_time(order):
+        return order.get('processed_at') or order.get('timestamp') or 0
+
+    def __len__(self):
+        return len(self.orders)
+
+    def __contains__(self, order_id):
+        return order_id in self.orders
+
+    def __iter__(self):
+        return iter(self.orders)
+
+    def __getitem__(self, order_id):
+        return self.orders[order_id]
+
+    def __setitem__(self, order_id, order):
+        if order_id in self.orders:
+            self.pop(order_id)
+        self.orders[order_id] = order
+        self.by_status.setdefault(order['status'], {})[order_id] = self.order_time(order)
+        self.by_user.setdefault(order.get('user_id'), {})[order_id] = None
+
+    def get(self, order_id, default=None):
+        return self.orders.get(order_id, default)
+
+    def items(self):
+        return self.orders.items()
+
+    def values(self):
+        return self.orders.values()
+
+    def pop(self, order_id, default=None):
+        order = self.orders.pop(order_id, None)
+        if order is None:
+            return default
+        self._unindex(self.by_status, order['status'], order_id)
+        self._unindex(self.by_user, order.get('user_id'), order_id)
+        return order
+
+    @staticmethod
+    def _unindex(index, key, order_id):
+        entries = index.get(key)
+        if entries is not None:
+            entries.pop(order_id, None)
+            if not entries:
+                del index[key]
+
+    def set_status(self, order_id, status):
+        order = self.orders[order_id]
+        self._unindex(self.by_status, order['status'], order_id)
+        order['status'] = status
+        self.by_status.setdefault(status, {})[order_id] = time.time()
+        return order
+
+    def with_status(self, status):
+        """指定ステータスの注文ID（そのステータスになった順）"""
+        return self.by_status.get(status, {}).keys()
+
+    def for_user(self, user_id):
+        """購入者の注文ID（注文順）"""
+        return self.by_user.get(str(user_id), {}).keys()
+
+    def archivable(self, cutoff, limit):
+        """cutoffより前に完了・キャンセル・期限切れになった注文 [(order_id, order)]"""
+        found = []
+        for status in TERMINAL_ORDER_STATUSES:
+            for order_id, since in self.by_status.get(status, {}).items():
+                if since > cutoff or len(found) >= limit:
+                    break
+                found.append((order_id, self.orders[order_id]))
+        return found
+
+class SalesRollup:
+    """サーバー・商品・1時間ごとの販売個数と売上金額の集計
+
+    販売時に加算分をメモリに溜め、永続化の書き込み（kind='sale'）でまとめてDBに加算する。
+    レポートは集計済みのバケットのみを読み、注文は走査しない
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.pending = {}  # {(guild_id, product_id, hour): [units, revenue]} 未保存の加算分
+
+    def record(self, guild_id, product_id, price, units=1, timestamp=None):
+        hour = int((timestamp or time.time()) // 3600)
+        delta = self.pending.setdefault((guild_id, product_id, hour), [0, 0])
+        delta[0] += units
+        delta[1] += price * units
+        self.bot.mark_dirty(guild_id, 'sale', (product_id, hour))
+        self.bot.journal.append('sale', guild_id, [product_id, hour], [units, price * units])
+
+    def take(self, guild_id, key):
+        """保存する加算分を取り出す（読み込み直せないストレージではメモリに残す）"""
+        if not self.bot.storage.persistent:
+            units, revenue = self.pending.get((guild_id,) + key, (0, 0))
+            return units, revenue
+        units, revenue = self.pending.pop((guild_id,) + key, (0, 0))
+        return units, revenue
+
+    def restore(self, guild_id, key, data):
+        """保存に失敗した加算分を戻す"""
+        if not self.bot.storage.persistent:
+            return
+        delta = self.pending.setdefault((guild_id,) + key, [0, 0])
+        delta[0] += data[0]
+        delta[1] += data[1]
+
+    async def report(self, guild_id, days, product_id=None):
+        """直近days日（今日を含む）の商品別・日別の集計"""
+        today = (int(time.time() // 3600) + SALES_UTC_OFFSET) // 24
+        first_day = today - days + 1
+        since_hour = first_day * 24 - SALES_UTC_OFFSET
+        # 書き込み中の加算分はDBにもメモリにも無いため、書き込みが終わるのを待ってから読む
+        async with self.bot.flush_lock:
+            rows = await asyncio.to_thread(self.bot.storage.sales_by_day, guild_id, since_hour, SALES_UTC_OFFSET, product_id)
+
+        # まだ書き込まれていない加算分も含める
+        rows = list(rows)
+        for (pending_guild_id, pending_product_id, hour), (units, revenue) in self.pending.items():
+            if pending_guild_id != guild_id or hour < since_hour:
+                continue
+            if product_id is not None and pending_product_id != product_id:
+                continue
+            rows.append((pending_product_id, (hour + SALES_UTC_OFFSET) // 24, units, revenue))
+
+        # 商品名だけを読む（読み込まれていないサーバーのデータを作ったり読み込んだりしない）
+        vending_machine = self.bot.vending_machines.get(guild_id)
+        if vending_machine is not None:
+            names = {report_product_id: product['name'] for report_product_id, product in vending_machine['products'].items()}
+        else:
+            names = await asyncio.to_thread(self.bot.storage.product_names, guild_id)
+        by_product = {}
+        by_day = {}
+        for row_product_id, day, units, revenue in rows:
+            entry = by_product.setdefault(row_product_id, {
+                'name': names.get(row_product_id),
+                'units': 0,
+                'revenue': 0
+            })
+            entry['units'] += units
+            entry['revenue'] += revenue
+            totals = by_day.setdefault(day, [0, 0])
+            totals[0] += units
+            totals[1] += revenue
+
+        def day_label(day):
+            return datetime.fromtimestamp(day * 86400, timezone.utc).date().isoformat()
+
+        return {
+            'guild_id': guild_id,
+            'product_id': product_id,
+            'days': days,
+            'from': day_label(first_day),
+            'to': day_label(today),
+            'utc_offset_hours': SALES_UTC_OFFSET,
+            'total': {
+                'units': sum(entry['units'] for entry in by_product.values()),
+                'revenue': sum(entry['revenue'] for entry in by_product.values())
+            },
+            'products': dict(sorted(by_product.items(), key=lambda item: item[1]['revenue'], reverse=True)),
+            'daily': [
+                {'date': day_label(day), 'units': units, 'revenue': revenue}
+                for day, (units, revenue) in sorted(by_day.items())
+            ]
+        }
+
+def normalize_payment_link(text):
+    """決済リンクを比較用に正規化（http(s)のURLでない場合はNone）
+
+    スキーム・ホストの大文字小文字、既定のポート、末尾のスラッシュ、フラグメント、
+    クエリの順序の違いは同じリンクとして扱う
+    """
+    try:
+        url = yarl.URL(text.strip())
+    except ValueError:
+        return None
+    if url.scheme not in ('http', 'https') or not url.host:
+        return None
+    port = url.explicit_port if url.explicit_port not in (80, 443) else None
+    return str(yarl.URL.build(
+        scheme='https',
+        host=url.host,
+        port=port,
+        path=url.path.rstrip('/'),
+        query=sorted(url.query.items())
+    ))
+
+def payment_link_digest(link):
+    """正規化した決済リンクの64ビットハッシュ値（SQLiteのINTEGERに収まるよう符号付き）"""
+    return int.from_bytes(hashlib.blake2b(link.encode('utf-8'), digest_size=8).digest(), 'little', signed=True)
+
+class BloomFilter:
+    """64ビットのハッシュ値を入れるBloomフィルター
+
+    ハッシュ値の上位・下位32ビットからダブルハッシュでk個のビット位置を求める。
+    件数が容量を超えると2倍の容量の層を追加し、層ごとに誤検出率を半分にして全体の誤検出率を保つ
+    """
+
+    def __init__(self, capacity=PAYMENT_LINK_BLOOM_CAPACITY, error_rate=PAYMENT_LINK_BLOOM_ERROR):
+        self.error_rate = error_rate
+        self.layers = []  # [[bits, bit_count, hash_count, capacity, count]]
+        self.add_layer(capacity)
+
+    def add_layer(self, capacity):
+        error_rate = self.error_rate * 0.5 ** (len(self.layers) + 1)
+        bit_count = max(int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)), 8)
+        hash_count = max(int(round(bit_count / capacity * math.log(2))), 1)
+        self.layers.append([bytearray((bit_count + 7) // 8), bit_count, hash_count, capacity, 0])
+
+    @staticmethod
+    def positions(digest, bit_count, hash_count):
+        digest &= 0xFFFFFFFFFFFFFFFF
+        low = digest & 0xFFFFFFFF
+        high = (digest >> 32) | 1
+        return ((low + i * high) % bit_count for i in range(hash_count))
+
+    def __contains__(self, digest):
+        for bits, bit_count, hash_count, _, _ in self.layers:
+            if all(bits[position >> 3] & (1 << (position & 7)) for position in self.positions(digest, bit_count, hash_count)):
+                return True
+        return False
+
+    def add(self, digest):
+        layer = self.layers[-1]
+        if layer[4] >= layer[3]:
+            self.add_layer(layer[3] * 2)
+            layer = self.layers[-1]
+        bits, bit_count, hash_count, _, _ = layer
+        for position in self.positions(digest, bit_count, hash_count):
+            bits[position >> 3] |= 1 << (position & 7)
+        layer[4] += 1
+
+    def __len__(self):
+        return sum(layer[4] for layer in self.layers)
+
+    def memory_bytes(self):
+        return sum(len(layer[0]) for layer in self.layers)
+
+class PaymentLinkIndex:
+    """サーバーごとに使用済みの決済リンクを記録し、使い回しを検出する
+
+    メモリにはBloomフィルターだけを置き、フィルターに当たった場合のみストレージの
+    完全な索引（payment_links）を引く。フィルターはサーバーの初回チェック時に
+    保存済みのハッシュ値から別スレッドで作り、サーバーデータと一緒にメモリから外す
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.filters = {}  # {guild_id: BloomFilter}
+        self.building = {}  # {guild_id: フィルターを作っているFuture}
+        self.pending = {}  # {(guild_id, digest): order_id} 未保存の記録
+
+        # メトリクス
+        self.checks = 0
+        self.exact_lookups = 0
+        self.duplicates = 0
+
+    async def filter(self, guild_id):
+        """サーバーのフィルター（初回は保存済みのハッシュ値から作る、同時の呼び出しは同じ処理を待つ）"""
+        bloom = self.filters.get(guild_id)
+        if bloom is not None:
+            return bloom
+        building = self.building.get(guild_id)
+        if building is None:
+            building = self.building[guild_id] = asyncio.ensure_future(self.build(guild_id))
+        return await asyncio.shield(building)
+
+    async def build(self, guild_id):
+        try:
+            bloom = await asyncio.to_thread(self.load, guild_id)
+            # 読み込み中に記録された分も加える
+            for pending_guild_id, digest in self.pending:
+                if pending_guild_id == guild_id:
+                    bloom.add(digest)
+            self.filters[guild_id] = bloom
+            return bloom
+        finally:
+            self.building.pop(guild_id, None)
+
+    def load(self, guild_id):
+        """保存済みのハッシュ値からフィルターを作る（別スレッドで実行）"""
+        bloom = BloomFilter()
+        for digest in self.bot.storage.payment_link_digests(guild_id):
+            bloom.add(digest)
+        return bloom
+
+    async def lookup(self, guild_id, digest):
+        """ハッシュ値を最初に使った注文ID（未使用の場合はNone）"""
+        if digest not in await self.filter(guild_id):
+            return None
+        self.exact_lookups += 1
+        order_id = self.pending.get((guild_id, digest))
+        if order_id is None:
+            order_id = await asyncio.to_thread(self.bot.storage.payment_link_order, guild_id, digest)
+        return order_id
+
+    async def register(self, guild_id, link, order_id):
+        """正規化済みのリンクを注文で使用済みとして記録し、別の注文で使用済みならその注文IDを返す"""
+        self.checks += 1
+        digest = payment_link_digest(link)
+        first_order_id = await self.lookup(guild_id, digest)
+        bloom = await self.filter(guild_id)
+        # 照会中に同じリンクが別の注文で記録された場合も使い回しとして扱う
+        first_order_id = first_order_id or self.pending.get((guild_id, digest))
+        if first_order_id is not None:
+            if first_order_id == order_id:
+                return None
+            self.duplicates += 1
+            return first_order_id
+
+        bloom.add(digest)
+        self.pending[(guild_id, digest)] = order_id
+        self.bot.mark_dirty(guild_id, 'payment_link', digest)
+        self.bot.journal.append('payment_link', guild_id, digest, order_id)
+        return None
+
+    def take(self, guild_id, digest):
+        """保存する記録を取り出す（読み込み直せないストレージではメモリに残す）"""
+        if not self.bot.storage.persistent:
+            return self.pending.get((guild_id, digest))
+        return self.pending.pop((guild_id, digest), None)
+
+    def restore(self, guild_id, digest, order_id):
+        """保存に失敗した（または操作ログから再生した）記録を戻す"""
+        self.pending.setdefault((guild_id, digest), order_id)
+        bloom = self.filters.get(guild_id)
+        if bloom is not None:
+            bloom.add(digest)
+
+    def drop(self, guild_id):
+        self.filters.pop(guild_id, None)
+
+    def stats(self):
+        return {
+            'checks': self.checks,
+            'exact_lookups': self.exact_lookups,
+            'duplicates': self.duplicates,
+            'filters': len(self.filters),
+            'building': len(self.building),
+            'filter_bytes': sum(bloom.memory_bytes() for bloom in self.filters.values()),
+            'pending': len(self.pending)
+        }
+
+class TokenBuckets:
+    """キーごとのトークンバケット（判定・消費はO(1)）
+
+    バケットは [トークン数, 更新時刻] だけを持ち、経過時間分をまとめて補充する。
+    満タンまで回復したバケットは無いのと同じため、pruneでまとめて削除する
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}  # {key: [tokens, updated]}
+
+    @property
+    def enabled(self):
+        return self.rate > 0 and self.burst > 0
+
+    def tokens(self, key, now):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            return self.burst
+        return min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+
+    def retry_after(self, key, now):
+        """1回分のトークンが貯まるまでの秒数（今すぐ使える場合は0）"""
+        tokens = self.tokens(key, now)
+        return 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+
+    def take(self, key, now):
+        self.buckets[key] = [self.tokens(key, now) - 1, now]
+
+    def prune(self, now):
+        """満タンまで回復したバケットを削除"""
+        full_after = self.burst / self.rate
+        for key in [key for key, (_, updated) in self.buckets.items() if now - updated >= full_after]:
+            del self.buckets[key]
+
+class OrderThrottle:
+    """注文作成の頻度制限（ユーザーごと・サーバーごとのトークンバケット）"""
+
+    def __init__(self):
+        self.scopes = {
+            'user': TokenBuckets(ORDER_RATE_PER_USER, ORDER_BURST_PER_USER),
+            'guild': TokenBuckets(ORDER_RATE_PER_GUILD, ORDER_BURST_PER_GUILD)
+        }
+
+    def check(self, action, guild_id, user_id):
+        """許可する場合はトークンを消費してNone、制限する場合は (scope, 再試行までの秒数) を返す
+
+        どちらかのバケットで拒否した場合はどちらのトークンも消費しない
+        """
+        now = time.monotonic()
+        keys = {'user': (action, user_id), 'guild': (action, guild_id)}
+        for scope, buckets in self.scopes.items():
+            if not buckets.enabled:
+                continue
+            retry_after = buckets.retry_after(keys[scope], now)
+            if retry_after > 0:
+                metrics.throttle(action, scope)
+                return scope, retry_after
+        for scope, buckets in self.scopes.items():
+            if buckets.enabled:
+                buckets.take(keys[scope], now)
+        return None
+
+    def prune(self):
+        now = time.monotonic()
+        for buckets in self.scopes.values():
+            if buckets.enabled:
+                buckets.prune(now)
+
+    def stats(self):
+        return {scope: len(buckets.buckets) for scope, buckets in self.scopes.items()}
+
+def throttle_message(scope, retry_after):
+    """頻度制限で拒否した場合の応答メッセージ"""
+    if scope == 'user':
+        return f"⏳ 操作が多すぎます。{math.ceil(retry_after)}秒後に再度お試しください。"
+    return f"⏳ 現在注文が混み合っています。{math.ceil(retry_after)}秒後に再度お試しください。"
+
+class StockReservations:
+    """注文ごとの在庫引当を管理
+
+    処理はすべてイベントループ上でawaitを挟まずに行うため、
+    商品ごとの引当数（product['reserved']）をロックなしで安全に増減できる
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+
+    @staticmethod
+    def available(product):
+        """引当済みを除いた販売可能な在庫数"""
+        return len(product.get('inventory', [])) - product.get('reserved', 0)
+
+    def reserve(self, guild_id, order_id):
+        """注文に在庫を1つ引き当てる（在庫が無ければFalse）"""
+        vending_machine = self.bot.get_guild_vending_machine(guild_id)
+        order = vending_machine['orders'].get(order_id)
+        if not order:
+            return False
+        if order.get('reserved'):
+            return True
+
+        product = vending_machine['products'].get(order['product_id'])
+        if not product or self.available(product) <= 0:
+            return False
+
+        product['reserved'] = product.get('reserved', 0) + 1
+        order['reserved'] = True
+        self.bot.mark_dirty(guild_id, 'product', order['product_id'])
+        self.bot.mark_dirty(guild_id, 'order', order_id)
+        return True
+
+    def release(self, guild_id, order_id):
+        """注文の引当を解除して在庫を販売可能に戻す"""
+        vending_machine = self.bot.get_guild_vending_machine(guild_id)
+        order = vending_machine['orders'].get(order_id)
+        if not order or not order.get('reserved'):
+            return
+
+        product = vending_machine['products'].get(order['product_id'])
+        if product:
+            product['reserved'] = max(product.get('reserved', 0) - 1, 0)
+            self.bot.mark_dirty(guild_id, 'product', order['product_id'])
+        order['reserved'] = False
+        self.bot.mark_dirty(guild_id, 'order', order_id)
+
+    def commit(self, guild_id, order_id):
+        """引当を確定して在庫アイテムを取り出す（取り出せない場合はNone）"""
+        vending_machine = self.bot.get_guild_vending_machine(guild_id)
+        order = vending_machine['orders'][order_id]
+        product = vending_machine['products'][order['product_id']]
+        inventory = product['inventory']
+
+        # 引当の無い注文（旧データ）は未引当の在庫からのみ取り出せる
+        if not order.get('reserved') and self.available(product) <= 0:
+            return None
+        if not inventory:
+            return None
+
+        item_content = inventory.popleft()
+        product['stock'] = len(inventory)
+        if order.get('reserved'):
+            product['reserved'] = max(product.get('reserved', 0) - 1, 0)
+            order['reserved'] = False
+        self.bot.mark_dirty(guild_id, 'product', order['product_id'])
+        self.bot.mark_dirty(guild_id, 'order', order_id)
+        return item_content
+
+    def rollback(self, guild_id, order_id, item_content):
+        """確定を取り消し、在庫アイテムを先頭に戻して再度引き当てる"""
+        vending_machine = self.bot.get_guild_vending_machine(guild_id)
+        order = vending_machine['orders'][order_id]
+        product = vending_machine['products'][order['product_id']]
+
+        product['inventory'].appendleft(item_content)
+        product['stock'] = len(product['inventory'])
+        product['reserved'] = product.get('reserved', 0) + 1
+        order['reserved'] = True
+        self.bot.mark_dirty(guild_id, 'product', order['product_id'])
+        self.bot.mark_dirty(guild_id, 'order', order_id)
+
+class ProductIndex:
+    """商品IDと商品名の前方一致検索用インデックス（ソート済み配列）
+
+    小文字にしたキーを二分探索し、前方一致する範囲だけを走査する
+    """
+
+    def __init__(self):
+        self.keys = []  # [(キー, product_id)] ソート済み
+
+    def add(self, product_id, name):
+        for key in {product_id.lower(), name.lower()}:
+            bisect.insort(self.keys, (key, product_id))
+
+    def remove(self, product_id, name):
+        for key in {product_id.lower(), name.lower()}:
+            position = bisect.bisect_left(self.keys, (key, product_id))
+            if position < len(self.keys) and self.keys[position] == (key, product_id):
+                del self.keys[position]
+
+    def search(self, prefix, limit):
+        """キーがprefixで始まる商品IDを最大limit個返す"""
+        prefix = prefix.lower()
+        results = []
+        position = bisect.bisect_left(self.keys, (prefix,))
+        while position < len(self.keys) and len(results) < limit:
+            key, product_id = self.keys[position]
+            if not key.startswith(prefix):
+                break
+            if product_id not in results:
+                results.append(product_id)
+            position += 1
+        return results
+
+class GuildCatalog:
+    """サーバーの商品一覧（追加順・カテゴリー別）と検索インデックス"""
+
+    def __init__(self):
+        self.product_ids = []  # 追加順
+        self.categories = {}  # {category: [product_id]} 追加順
+        self.index = ProductIndex()
+
+    def add(self, product_id, product):
+        self.product_ids.append(product_id)
+        category = product.get('category')
+        if category:
+            self.categories.setdefault(category, []).append(product_id)
+        self.index.add(product_id, product['name'])
+
+    def listing(self, category=None):
+        """カテゴリーの商品ID一覧（Noneの場合は全商品）"""
+        if category is None:
+            return self.product_ids
+        return self.categories.get(category, [])
+
+class ProductCatalog:
+    """サーバーごとの商品一覧（商品が増えるたびに差分で更新し、初回アクセス時に構築）"""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.catalogs = {}  # {guild_id: GuildCatalog}
+
+    def get(self, guild_id):
+        catalog = self.catalogs.get(guild_id)
+        if catalog is None:
+            catalog = self.catalogs[guild_id] = GuildCatalog()
+            for product_id, product in self.bot.get_guild_vending_machine(guild_id)['products'].items():
+                catalog.add(product_id, product)
+        return catalog
+
+    def add(self, guild_id, product_id):
+        """追加された商品を一覧とインデックスに反映"""
+        if guild_id in self.catalogs:
+            product = self.bot.get_guild_vending_machine(guild_id)['products'][product_id]
+            self.catalogs[guild_id].add(product_id, product)
+
+    def drop(self, guild_id):
+        self.catalogs.pop(guild_id, None)
+
+    def search(self, guild_id, text, limit=25):
+        """オートコンプリート用に商品IDまたは商品名が前方一致する商品を返す [(product_id, product)]"""
+        catalog = self.get(guild_id)
+        products = self.bot.get_guild_vending_machine(guild_id)['products']
+        if text:
+            product_ids = catalog.index.search(text, limit)
+        else:
+            product_ids = catalog.product_ids[:limit]
+        return [(product_id, products[product_id]) for product_id in product_ids]
+
+class PanelRegistry:
+    """設置済みの販売機パネルとその表示内容のキャッシュ
+
+    商品や在庫が変わるとキャッシュを破棄し、一定時間内の変更をまとめて
+    各パネルを1回だけ編集する。商品は最大PANEL_PAGE_SIZE個ずつ、Embedの文字数の上限に
+    収まる分だけのページに分けて表示する
+    """
+
+    TITLE = "🏪 半自動販売機"
+    DESCRIPTION = ("購入したい商品を選択してください。\n"
+                   "購入後、PayPayリンクを送ってもらって、確認後にDMで商品をお送りします。")
+    # 商品以外の表示（タイトル・説明・実績チャンネル・フッター）に残す文字数
+    RESERVED_CHARS = len(TITLE) + len(DESCRIPTION) + 300
+    STOCK_CHARS = 20  # 在庫表示の最大文字数の見積もり
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.cache = {}  # {guild_id: {(page, category): (embed, options), ('pages', category): [(start, end)]}}
+        self.pending = {}  # {guild_id: 更新タスク}
+
+    @staticmethod
+    def product_field(product, stock_status):
+        return (
+            f"{product['name'][:200]} - ¥{product['price']:,}",
+            f"{product['description'][:200]}\n{stock_status}"
+        )
+
+    def pages(self, guild_id, category=None):
+        """ページごとの商品一覧の範囲 [(start, end)]（キャッシュ済みなら再利用）"""
+        pages = self.cache.setdefault(guild_id, {})
+        if ('pages', category) not in pages:
+            products = self.bot.get_guild_vending_machine(guild_id)['products']
+            listing = self.bot.catalog.get(guild_id).listing(category)
+            budget = EMBED_MAX_CHARS - self.RESERVED_CHARS
+            ranges = []
+            start = 0
+            used = 0
+            for index, product_id in enumerate(listing):
+                name, value = self.product_field(products[product_id], '')
+                size = len(name) + len(value) + self.STOCK_CHARS
+                if index > start and (index - start >= PANEL_PAGE_SIZE or used + size > budget):
+                    ranges.append((start, index))
+                    start = index
+                    used = 0
+                used += size
+            ranges.append((start, len(listing)))
+            pages[('pages', category)] = ranges
+        return pages[('pages', category)]
+
+    def page_count(self, guild_id, category=None):
+        return len(self.pages(guild_id, category))
+
+    def payload(self, guild_id, page=0, category=None):
+        """パネルのページのEmbedとセレクトメニューの選択肢を取得（キャッシュ済みなら再利用）"""
+        pages = self.cache.setdefault(guild_id, {})
+        if (page, category) not in pages:
+            pages[(page, category)] = self.build(guild_id, page, category)
+        return pages[(page, category)]
+
+    def build(self, guild_id, page=0, category=None):
+        vending_machine = self.bot.get_guild_vending_machine(guild_id)
+        products = vending_machine['products']
+        pages = self.pages(guild_id, category)
+        page_count = len(pages)
+        listing = self.bot.catalog.get(guild_id).listing(category)
+        start, end = pages[min(page, page_count - 1)]
+
+        panel_embed = discord.Embed(
+            title=self.TITLE,
+            description=self.DESCRIPTION,
+            color=get_random_color()
+        )
+
+        # Embedの文字数制限に収まるよう、商品ごとにフィールドを分けて長い説明は省略する
+        options = []
+        for product_id in listing[start:end]:
+            product = products[product_id]
+            actual_stock = StockReservations.available(product)
+            stock_status = f"在庫: {actual_stock}個" if actual_stock > 0 else "❌ 在庫切れ"
+            name, value = self.product_field(product, stock_status)
+            panel_embed.add_field(name=name, value=value, inline=False)
+            if actual_stock > 0:
+                options.append(discord.SelectOption(
+                    label=f"{product['name']} - ¥{product['price']:,}"[:100],
+                    value=product_id,
+                    description=product['description'][:100]
+                ))
+        if not listing:
+            panel_embed.add_field(name="📋 商品一覧", value="商品がありません。", inline=False)
+
+        # 実績チャンネルが設定されている場合の表示
+        achievement_channel_id = vending_machine.get('achievement_channel')
+        if achievement_channel_id:
+            panel_embed.add_field(
+                name="📈 実績チャンネル",
+                value=f"購入実績が <#{achievement_channel_id}> に自動送信されるよ！。",
+                inline=False
+            )
+
+        footer = "半自動販売機"
+        if category:
+            footer += f" | カテゴリー: {category}"
+        if page_count > 1:
+            footer += f" | {page + 1}/{page_count}ページ"
+        panel_embed.set_footer(text=footer)
+        return panel_embed, options
+
+    def register(self, guild_id, channel_id, message_id):
+        """設置したパネルを更新対象に登録"""
+        vending_machine = self.bot.get_guild_vending_machine(guild_id)
+        vending_machine.setdefault('panels', []).append([channel_id, message_id])
+        self.bot.mark_dirty(guild_id)
+
+    def invalidate(self, guild_id):
+        """表示内容のキャッシュを破棄し、設置済みパネルの更新を予約"""
+        self.cache.pop(guild_id, None)
+        vending_machine = self.bot.vending_machines.get(guild_id)
+        if not vending_machine or not vending_machine.get('panels'):
+            return
+        if guild_id not in self.pending:
+            self.pending[guild_id] = asyncio.create_task(self.refresh(guild_id))
+
+    async def refresh(self, guild_id):
+        """待ち時間内の変更をまとめて設置済みパネルを更新"""
+        try:
+            await asyncio.sleep(PANEL_REFRESH_DELAY)
+        finally:
+            # 待ち時間後の変更は次回の更新に回す
+            self.pending.pop(guild_id, None)
+
+        vending_machine = self.bot.vending_machines.get(guild_id)
+        if not vending_machine:
+            return
+
+        embed, _ = self.payload(guild_id)
+        for panel in list(vending_machine.get('panels', [])):
+            channel_id, message_id = panel
+            try:
+                message = self.bot.get_partial_messageable(channel_id).get_partial_message(message_id)
+                await message.edit(embed=embed, view=VendingMachineView(guild_id))
+            except discord.NotFound:
+                # 削除されたパネルは登録を解除
+                vending_machine['panels'].remove(panel)
+                self.bot.mark_dirty(guild_id)
+            except Exception as e:
+                log_event('panel_refresh_failed', f'販売機パネル更新エラー (メッセージID: {message_id}): {e}', logging.WARNING, guild_id=guild_id, channel_id=channel_id, message_id=message_id, error=str(e))
+
+def is_retryable_error(error):
+    """再試行で解決する可能性のあるDiscord APIエラーか"""
+    if isinstance(error, discord.HTTPException):
+        return error.status == 429 or error.status >= 500
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError))
+
+class ChannelSendQueue:
+    """チャンネルごとの送信キュー
+
+    同じチャンネルへの送信は同じレート制限バケットに入るため順番に送り、
+    チャンネルが異なる送信は別々のキューで並行して送る
+    """
+
+    IDLE_TIMEOUT = 60
+
+    def __init__(self, bot, channel_id):
+        self.bot = bot
+        self.channel_id = channel_id
+        self.queue = asyncio.Queue()
+        self.worker = None
+
+        # メトリクス
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def put(self, send, idempotent=False):
+        """送信処理（channelを受け取るコルーチン関数）を追加し、結果のFutureを返す
+
+        idempotentは何度実行しても結果が同じ処理（メッセージの編集など）で、これだけを5xx・通信エラーで再試行する。
+        新規投稿は再試行すると重複しうるため、discord.py自身の再試行に任せる
+        """
+        future = asyncio.get_running_loop().create_future()
+        # 失敗はrun()でログに残すため、結果を待たない呼び出し元の分は例外を回収しておく
+        future.add_done_callback(lambda future: future.cancelled() or future.exception())
+        self.queue.put_nowait((send, idempotent, future, time.perf_counter()))
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.create_task(self.run())
+        return future
+
+    async def run(self):
+        while True:
+            try:
+                send, idempotent, future, queued_at = await asyncio.wait_for(self.queue.get(), self.IDLE_TIMEOUT)
+            except asyncio.TimeoutError:
+                # 一定時間送信が無ければワーカーを終了（次の送信で再開）
+                if self.queue.empty():
+                    return
+                continue
+
+            try:
+                result = await self.send_with_retry(send, idempotent)
+                if not future.done():
+                    future.set_result(result)
+                self.sent += 1
+            except Exception as e:
+                self.failed += 1
+                if not future.done():
+                    future.set_exception(e)
+                log_event('channel_send_failed', f'チャンネル送信エラー (チャンネルID: {self.channel_id}): {e}', logging.WARNING, channel_id=self.channel_id, error=str(e))
+            finally:
+                latency = time.perf_counter() - queued_at
+                self.latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
+
+    async def send_with_retry(self, send, idempotent):
+        channel = self.bot.get_channel(self.channel_id) or self.bot.get_partial_messageable(self.channel_id)
+        for attempt in range(OUTBOUND_MAX_RETRIES + 1):
+            try:
+                return await send(channel)
+            except Exception as e:
+                # 429はdiscord.pyが待って再試行済みのため、ここでは重ねない
+                if attempt >= OUTBOUND_MAX_RETRIES or not idempotent or not is_retryable_error(e) or getattr(e, 'status', None) == 429:
+                    raise
+                self.retries += 1
+                await asyncio.sleep(OUTBOUND_RETRY_BASE * (2 ** attempt) + random.uniform(0, OUTBOUND_RETRY_BASE))
+
+    def stats(self):
+        completed = self.sent + self.failed
+        return {
+            'queue_depth': self.queue.qsize(),
+            'sent': self.sent,
+            'failed': self.failed,
+            'retries': self.retries,
+            'avg_latency': self.latency_total / completed if completed else 0.0,
+            'max_latency': self.latency_max
+        }
+
+class OutboundDispatcher:
+    """チャンネル送信キューの集合"""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.queues = {}  # {channel_id: ChannelSendQueue}
+
+    def send(self, channel_id, send, idempotent=False):
+        queue = self.queues.get(channel_id)
+        if queue is None:
+            queue = self.queues[channel_id] = ChannelSendQueue(self.bot, channel_id)
+        return queue.put(send, idempotent)
+
+    def stats(self):
+        return {str(channel_id): queue.stats() for channel_id, queue in self.queues.items()}
+
+class UserResolver:
+    """ユーザー情報の取得
+
+    クライアントのキャッシュ → TTL付きLRUキャッシュ → REST の順に探し、
+    同じユーザーへの同時のREST呼び出しは1回にまとめる
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.cache = OrderedDict()  # {user_id: (user, 期限)}
+        self.inflight = {}  # {user_id: 取得タスク}
+
+        # メトリクス
+        self.client_hits = 0
+        self.cache_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def resolve(self, user_id):
+        """ユーザーを取得（見つからない場合はdiscord.NotFound）"""
+        user_id = int(user_id)
+        user = self.bot.get_user(user_id)
+        if user is not None:
+            self.client_hits += 1
+            return user
+
+        entry = self.cache.get(user_id)
+        if entry is not None:
+            if entry[1] > time.monotonic():
+                self.cache.move_to_end(user_id)
+                self.cache_hits += 1
+                return entry[0]
+            del self.cache[user_id]
+
+        task = self.inflight.get(user_id)
+        if task is None:
+            self.misses += 1
+            task = self.inflight[user_id] = asyncio.create_task(self.fetch(user_id))
+        else:
+            self.coalesced += 1
+        # 呼び出し元がキャンセルされても他の待機者のために取得は続ける
+        return await asyncio.shield(task)
+
+    async def fetch(self, user_id):
+        try:
+            user = await self.bot.fetch_user(user_id)
+            self.cache[user_id] = (user, time.monotonic() + USER_CACHE_TTL)
+            self.cache.move_to_end(user_id)
+            while len(self.cache) > USER_CACHE_SIZE:
+                self.cache.popitem(last=False)
+            return user
+        finally:
+            self.inflight.pop(user_id, None)
+
+    def stats(self):
+        lookups = self.client_hits + self.cache_hits + self.misses + self.coalesced
+        return {
+            'client_hits': self.client_hits,
+            'cache_hits': self.cache_hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'hit_ratio': (lookups - self.misses) / lookups if lookups else 0.0,
+            'cached': len(self.cache)
+        }
+
+class DeliveryPipeline:
+    """商品DM配送のジョブキューとワーカー
+
+    承認時に在庫を確定して注文を 'delivering' にし、DM送信はワーカーが行う。
+    管理者メッセージの更新・実績通知はチャンネルの送信キューに任せ、ワーカーは待たない。
+    ジョブは注文IDごとに1つだけ受け付け、DM送信済みの記録（delivered_at）があればDMを再送しない。
+    DM送信の前に送信開始の記録（dm_started_at）を操作ログに書いておき、送信開始後に終了した注文や
+    失敗の応答が返った送信は、購入者とのDMの履歴に商品が届いているかを確かめてから再送する。
+    履歴を確かめられない場合は再送せずに完了とし、管理者に受け取りの確認を依頼する
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.queue = asyncio.Queue(maxsize=DELIVERY_QUEUE_SIZE)
+        self.workers = []
+        self.jobs = {}  # {(guild_id, order_id): job} 受付済み・処理中のジョブ
+        self.resume_task = None
+
+        # メトリクス
+        self.completed = 0
+        self.failed = 0
+        self.retries = 0
+
+    def start(self):
+        for _ in range(DELIVERY_WORKERS):
+            self.workers.append(asyncio.create_task(self.worker()))
+
+    def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        self.workers = []
+        if self.resume_task:
+            self.resume_task.cancel()
+
+    def submit(self, guild_id, order_id, processor_id, interaction=None):
+        """配送ジョブを追加（同じ注文のジョブが既にある・キューが満杯の場合はFalse）"""
+        key = (guild_id, order_id)
+        if key in self.jobs:
+            return False
+
+        job = {
+            'guild_id': guild_id,
+            'order_id': order_id,
+            'processor_id': processor_id,
+            'interaction': interaction
+        }
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            return False
+        self.jobs[key] = job
+        return True
+
+    def prepare(self, guild_id, order_id, processor_id, admin_message=None, require_reserved=False):
+        """承認された注文の在庫を確定して配送中にする（できない場合は理由を返す）
+
+        awaitを挟まずに状態を変えるため、同じ注文が二重に承認されることはない。
+        require_reservedの場合は在庫を引き当てていない（決済リンクが送信されていない）注文を拒否する
+        （承認ボタンは決済リンクの送信後にしか表示されないが、一括承認では任意の注文IDを指定できるため）
+        """
+        vending_machine = self.bot.get_guild_vending_machine(guild_id)
+        order = vending_machine['orders'].get(order_id)
+        if not order:
+            return "注文が見つかりません。"
+        if order['status'] != 'pending_payment':
+            return "この注文は既に処理済みです。"
+        if order['product_id'] not in vending_machine['products']:
+            return "商品が見つかりません。"
+        if require_reserved and not order.get('reserved'):
+            return "決済リンク未送信"
+
+        # 引き当てた在庫を確定して取り出す
+        item_content = self.bot.reservations.commit(guild_id, order_id)
+        if item_content is None:
+            return "この商品の在庫がありません。"
+
+        order['processed_by'] = str(processor_id)
+        order['delivery_item'] = item_content
+        if admin_message is not None and admin_message not in order.setdefault('admin_messages', []):
+            order['admin_messages'].append(admin_message)
+        self.bot.set_order_status(guild_id, order_id, 'delivering')
+        return None
+
+    def abort(self, guild_id, order_id):
+        """配送中の注文を決済確認待ちに戻し、在庫を引当に戻す"""
+        order = self.bot.get_guild_vending_machine(guild_id)['orders'][order_id]
+        order.pop('dm_started_at', None)
+        self.bot.set_order_status(guild_id, order_id, 'pending_payment')
+        self.bot.reservations.rollback(guild_id, order_id, order.pop('delivery_item'))
+
+    async def approve_batch(self, guild_id, order_ids, processor_id):
+        """複数の注文をまとめて承認し、すべての配送が終わるまで待つ
+
+        DM送信はワーカーが並行して行い、管理者メッセージの更新はチャンネルの送信キューに任せ、
+        実績チャンネルへの通知は最後にまとめて送る。戻り値は {order_id: 失敗理由（成功はNone）}
+        """
+        # remainingは投入中に全件が終わって完了扱いにならないよう1から数える
+        batch = {'results': {}, 'achievements': [], 'remaining': 1, 'done': asyncio.Event()}
+        for order_id in order_ids:
+            error = self.prepare(guild_id, order_id, processor_id, require_reserved=True)
+            if error:
+                batch['results'][order_id] = error
+                continue
+
+            job = {
+                'guild_id': guild_id,
+                'order_id': order_id,
+                'processor_id': str(processor_id),
+                'interaction': None,
+                'batch': batch
+            }
+            self.jobs[(guild_id, order_id)] = job
+            batch['remaining'] += 1
+            # キューが満杯の場合は空くまで待つ
+            await self.queue.put(job)
+
+        self.finish_batch_job(batch)
+        await batch['done'].wait()
+        self.send_achievement_batch(guild_id, batch['achievements'], str(processor_id))
+        return batch['results']
+
+    @staticmethod
+    def finish_batch_job(batch):
+        batch['remaining'] -= 1
+        if batch['remaining'] == 0:
+            batch['done'].set()
+
+    async def resume(self, orders):
+        """再起動前に配送途中だった注文のジョブを再投入 orders: [(guild_id, order_id)]
+
+        キューが満杯の場合は空くまで待つ（取りこぼした注文が配送中のまま残らないように）
+        """
+        for guild_id, order_id in orders:
+            order = self.bot.get_guild_vending_machine(guild_id)['orders'].get(order_id)
+            if not order or order['status'] != 'delivering' or (guild_id, order_id) in self.jobs:
+                continue
+            job = {
+                'guild_id': guild_id,
+                'order_id': order_id,
+                'processor_id': order.get('processed_by'),
+                'interaction': None
+            }
+            self.jobs[(guild_id, order_id)] = job
+            await self.queue.put(job)
+        log_event('delivery_resumed', f'{len(orders)}件の配送途中の注文を再開しました', orders=len(orders))
+
+    async def worker(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                await self.deliver(job)
+            except Exception as e:
+                log_event('delivery_worker_error', f'商品配送ワーカーエラー (注文 #{job["order_id"]}): {e}', logging.ERROR, exc_info=True, guild_id=job['guild_id'], order_id=job['order_id'])
+            finally:
+                self.jobs.pop((job['guild_id'], job['order_id']), None)
+                batch = job.get('batch')
+                if batch is not None:
+                    batch['results'].setdefault(job['order_id'], "配送処理中にエラーが発生しました。")
+                    self.finish_batch_job(batch)
+
+    async def deliver(self, job):
+        """購入者にDMで商品を送信し、結果を管理者メッセージに反映"""
+        guild_id = job['guild_id']
+        order_id = job['order_id']
+        vending_machine = self.bot.get_guild_vending_machine(guild_id)
+        order = vending_machine['orders'].get(order_id)
+        if not order or order['status'] != 'delivering':
+            return
+        product = vending_machine['products'].get(order['product_id'])
+
+        try:
+            user = await self.with_retry(lambda: self.bot.user_resolver.resolve(order['user_id']))
+
+            if not order.get('delivered_at'):
+                sent = False
+                if order.get('dm_started_at'):
+                    # 送信開始後に終了した注文は、届いているかを確かめてから送る
+                    sent = await self.find_delivery_dm(user, order_id, order)
+                if sent is False:
+                    sent = await self.send_delivery_dm(user, guild_id, order_id, order, product)
+                if sent is None:
+                    order['delivery_unconfirmed'] = True
+                    log_event('delivery_unconfirmed', f'注文 #{order_id} のDMが送信済みか確認できないため再送しません', logging.WARNING, guild_id=guild_id, order_id=order_id, user_id=order['user_id'])
+
+                # DM送信済みを記録（以降の再試行ではDMを再送しない）
+                order['delivered_at'] = time.time()
+                self.bot.mark_dirty(guild_id, 'order', order_id)
+        except Exception as e:
+            self.failed += 1
+            await self.fail(job, order, e)
+            return
+
+        # 注文を完了状態にする（DMは送信済みのため、ここから先で失敗しても配送中には戻さない）
+        order['processed_at'] = time.time()
+        order.pop('delivery_item', None)
+        self.bot.set_order_status(guild_id, order_id, 'completed')
+        self.completed += 1
+        batch = job.get('batch')
+        if batch is not None:
+            batch['results'][order_id] = None
+
+        try:
+            # 売上は注文時の価格で集計する（価格が変更されていても変わらない）
+            self.bot.sales.record(guild_id, order['product_id'], order.get('price', product['price']), timestamp=order['processed_at'])
+            self.bot.order_expiry.cancel((guild_id, order_id))
+
+            # 管理者メッセージを更新
+            if order.get('delivery_unconfirmed'):
+                success_embed = discord.Embed(
+                    title="⚠️ 商品送信未確認",
+                    description=f"注文 #{order_id} は再起動前に商品の送信を開始しましたが、送信済みか確認できませんでした。\n"
+                               "二重に送らないよう再送していません。購入者に受け取りを確認してください。\n"
+                               f"実行者: <@{job['processor_id']}>",
+                    color=0xFFA500,
+                    timestamp=discord.utils.utcnow()
+                )
+            else:
+                success_embed = discord.Embed(
+                    title="✅ 商品送信完了",
+                    description=f"注文 #{order_id} の商品を送信しました。\n"
+                               f"実行者: <@{job['processor_id']}>\n"
+                               f"残り在庫: {product['stock']}個",
+                    color=get_random_color(),
+                    timestamp=discord.utils.utcnow()
+                )
+            # チャンネルのレート制限を待たずに次の配送に進む
+            self.update_admin_messages(order, embed=success_embed, view=None)
+            log_event('order_delivered', f'注文 #{order_id} の商品を送信しました (残り在庫: {product["stock"]}個)', guild_id=guild_id, order_id=order_id, user_id=order['user_id'], product_id=order['product_id'], stock=product['stock'])
+
+            # 実績チャンネルに通知を送信（一括承認ではまとめて送る）
+            if batch is None:
+                self.send_achievement_notification(guild_id, order_id, user, product, job['processor_id'])
+            else:
+                batch['achievements'].append((order_id, user, product))
+        except Exception as e:
+            log_event('delivery_followup_failed', f'配送完了後の処理エラー (注文 #{order_id}): {e}', logging.ERROR, exc_info=True, guild_id=guild_id, order_id=order_id)
+
+    async def send_delivery_dm(self, user, guild_id, order_id, order, product):
+        """商品をDMで送信（送信した場合はTrue、届いたか確認できない場合はNone）
+
+        送信開始を操作ログに書いてから送る。失敗の応答でも届いている場合があるため、
+        再試行の前に履歴を確かめる
+        """
+        delivery_embed = discord.Embed(
+            title="📦 商品お届け",
+            description="ご注文いただいた商品をお届けします。",
+            color=get_random_color(),
+            timestamp=discord.utils.utcnow()
+        )
+
+        delivery_embed.add_field(name="注文ID", value=f"#{order_id}", inline=True)
+        delivery_embed.add_field(name="商品名", value=product['name'], inline=True)
+        delivery_embed.add_field(name="商品内容", value=order['delivery_item'], inline=False)
+        delivery_embed.set_footer(text="半自動販売機システム")
+
+        order['dm_started_at'] = time.time()
+        self.bot.mark_dirty(guild_id, 'order', order_id)
+        await self.bot.journal.sync()
+
+        for attempt in range(DELIVERY_MAX_RETRIES + 1):
+            try:
+                await user.send(embed=delivery_embed)
+                return True
+            except Exception as e:
+                if attempt >= DELIVERY_MAX_RETRIES or not is_retryable_error(e):
+                    raise
+                self.retries += 1
+                await asyncio.sleep(OUTBOUND_RETRY_BASE * (2 ** attempt) + random.uniform(0, OUTBOUND_RETRY_BASE))
+                sent = await self.find_delivery_dm(user, order_id, order)
+                if sent is not False:
+                    return sent
+
+    async def find_delivery_dm(self, user, order_id, order):
+        """購入者とのDMの直近の履歴にこの注文の商品が届いているか（確認できない場合はNone）
+
+        注文IDはサーバーごとの番号のため、商品内容も一致するものを探す
+        """
+        try:
+            channel = user.dm_channel or await user.create_dm()
+            async for message in channel.history(limit=DELIVERY_HISTORY_LIMIT):
+                if message.author.id != self.bot.user.id:
+                    continue
+                for embed in message.embeds:
+                    fields = {field.name: field.value for field in embed.fields}
+                    if fields.get('注文ID') == f'#{order_id}' and fields.get('商品内容') == order.get('delivery_item'):
+                        return True
+            return False
+        except Exception as e:
+            log_event('delivery_history_failed', f'DM履歴の確認エラー (注文 #{order_id}): {e}', logging.WARNING, order_id=order_id, user_id=order['user_id'], error=str(e))
+            return None
+
+    async def with_retry(self, call):
+        """一時的なAPIエラーをバックオフしながら再試行"""
+        for attempt in range(DELIVERY_MAX_RETRIES + 1):
+            try:
+                return await call()
+            except Exception as e:
+                if attempt >= DELIVERY_MAX_RETRIES or not is_retryable_error(e):
+                    raise
+                self.retries += 1
+                await asyncio.sleep(OUTBOUND_RETRY_BASE * (2 ** attempt) + random.uniform(0, OUTBOUND_RETRY_BASE))
+
+    async def fail(self, job, order, error):
+        """配送失敗時に在庫と注文を元に戻し、管理者に通知"""
+        guild_id = job['guild_id']
+        order_id = job['order_id']
+
+        self.abort(guild_id, order_id)
+        self.bot.schedule_order_expiry(guild_id, order_id, order.get('timestamp', 0))
+
+        if isinstance(error, discord.Forbidden):
+            reason = "購入者にDMを送信できませんでした。"
+            error_embed = discord.Embed(
+                title="❌ DM送信エラー",
+                description=f"注文 #{order_id} の購入者にDMを送信できませんでした。",
+                color=0xFF0000
+            )
+            error_embed.add_field(
+                name="エラー原因",
+                value="• ユーザーがDM受信を無効にしている\n• ボットがブロックされている\n• サーバーでDMが無効",
+                inline=False
+            )
+            error_embed.add_field(
+                name="対処方法",
+                value="1. ユーザーにDM設定の確認を依頼\n2. サーバー内でのメンション通知も検討\n3. 在庫は元に戻されました",
+                inline=False
+            )
+            log_event('delivery_failed', f'DM送信エラー (注文 #{order_id}): {error}', logging.WARNING, guild_id=guild_id, order_id=order_id, user_id=order['user_id'], reason='forbidden', error=str(error))
+        elif isinstance(error, discord.HTTPException):
+            reason = f"Discord APIエラー: {error}"
+            error_embed = discord.Embed(
+                title="❌ Discord APIエラー",
+                description=f"注文 #{order_id}: Discord APIエラーが発生しました:\n```{str(error)}```\n在庫は元に戻されました。",
+                color=0xFF0000
+            )
+            log_event('delivery_failed', f'Discord APIエラー (注文 #{order_id}): {error}', logging.WARNING, guild_id=guild_id, order_id=order_id, user_id=order['user_id'], reason='http', error=str(error))
+        else:
+            reason = f"予期しないエラー: {error}"
+            error_embed = discord.Embed(
+                title="❌ 商品送信エラー",
+                description=f"注文 #{order_id}: 予期しないエラーが発生しました:\n```{str(error)}```\n在庫は元に戻されました。",
+                color=0xFF0000
+            )
+            log_event('delivery_failed', f'商品送信エラー (注文 #{order_id}): {error}', logging.ERROR, guild_id=guild_id, order_id=order_id, user_id=order['user_id'], reason='unexpected', error=str(error))
+
+        # 一括承認の失敗は結果の一覧で通知する
+        batch = job.get('batch')
+        if batch is not None:
+            batch['results'][order_id] = f"{reason}在庫は元に戻されました。"
+            return
+
+        # 承認した管理者に通知（応答トークンが使えない場合はチャンネルに送信）
+        interaction = job.get('interaction')
+        try:
+            if interaction is not None and not interaction.is_expired():
+                await interaction.followup.send(embed=error_embed, ephemeral=True)
+                return
+        except Exception as e:
+            log_event('delivery_failure_notice_failed', f'配送エラー通知の送信エラー (注文 #{order_id}): {e}', logging.WARNING, guild_id=guild_id, order_id=order_id, error=str(e))
+        for channel_id, _ in order.get('admin_messages', [])[:1]:
+            self.bot.outbound.send(channel_id, lambda channel: channel.send(embed=error_embed))
+
+    def update_admin_messages(self, order, **fields):
+        """注文の管理者通知メッセージをすべて更新（チャンネルの送信キューに追加する）"""
+        for channel_id, message_id in order.get('admin_messages', []):
+            self.bot.outbound.send(
+                channel_id,
+                lambda channel, message_id=message_id: channel.get_partial_message(message_id).edit(**fields),
+                idempotent=True
+            )
+
+    def send_achievement_notification(self, guild_id, order_id, buyer, product, processor_id):
+        """実績チャンネルに購入実績を送信（チャンネルの送信キューに追加する）"""
+        try:
+            vending_machine = self.bot.get_guild_vending_machine(guild_id)
+            achievement_channel_id = vending_machine.get('achievement_channel')
+
+            if not achievement_channel_id:
+                return
+
+            achievement_embed = discord.Embed(
+                title="🎉 購入実績",
+                description="商品が購入されました！",
+                color=get_random_color(),
+                timestamp=discord.utils.utcnow()
+            )
+
+            achievement_embed.add_field(
+                name="購入者",
+                value=f"{buyer.mention}\n({buyer.display_name})",
+                inline=True
+            )
+
+            achievement_embed.add_field(
+                name="商品",
+                value=f"**{product['name']}**\n¥{product['price']:,}",
+                inline=True
+            )
+
+            achievement_embed.add_field(
+                name="注文ID",
+                value=f"#{order_id}",
+                inline=True
+            )
+
+            achievement_embed.add_field(
+                name="処理者",
+                value=f"<@{processor_id}>",
+                inline=True
+            )
+
+            achievement_embed.add_field(
+                name="残り在庫",
+                value=f"{product['stock']}個",
+                inline=True
+            )
+
+            achievement_embed.set_thumbnail(url=buyer.display_avatar.url)
+            achievement_embed.set_footer(text="半自動販売機システム")
+
+            self.bot.outbound.send(achievement_channel_id, lambda channel: channel.send(embed=achievement_embed))
+
+        except Exception as e:
+            log_event('achievement_send_failed', f'実績通知送信エラー: {e}', logging.WARNING, guild_id=guild_id, order_id=order_id, error=str(e))
+
+    def send_achievement_batch(self, guild_id, entries, processor_id):
+        """一括承認した注文の購入実績をまとめて送信 entries: [(order_id, buyer, product)]"""
+        if len(entries) == 1:
+            order_id, buyer, product = entries[0]
+            self.send_achievement_notification(guild_id, order_id, buyer, product, processor_id)
+            return
+        if not entries:
+            return
+
+        achievement_channel_id = self.bot.get_guild_vending_machine(guild_id).get('achievement_channel')
+        if not achievement_channel_id:
+            return
+
+        # Embedの説明文の文字数制限に収まる件数ずつ1メッセージにする
+        messages = [[]]
+        length = 0
+        for order_id, buyer, product in entries:
+            line = f"#{order_id} **{product['name']}** ¥{product['price']:,} - {buyer.mention}"
+            if messages[-1] and length + len(line) + 1 > 3800:
+                messages.append([])
+                length = 0
+            messages[-1].append(line)
+            length += len(line) + 1
+
+        for lines in messages:
+            achievement_embed = discord.Embed(
+                title="🎉 購入実績",
+                description=f"{len(lines)}件の商品が購入されました！\n処理者: <@{processor_id}>\n\n" + "\n".join(lines),
+                color=get_random_color(),
+                timestamp=discord.utils.utcnow()
+            )
+            achievement_embed.set_footer(text="半自動販売機システム")
+            self.bot.outbound.send(achievement_channel_id, lambda channel, embed=achievement_embed: channel.send(embed=embed))
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue.qsize(),
+            'in_flight': len(self.jobs),
+            'workers': len(self.workers),
+            'completed': self.completed,
+            'failed': self.failed,
+            'retries': self.retries
+        }
+
+def deep_sizeof(obj):
+    """オブジェクトと中身（dict / list / tuple / set / deque）の合計サイズの概算（バイト）"""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(key) + deep_sizeof(value) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        size += sum(deep_sizeof(item) for item in obj)
+    return size
+
+class GuildCache:
+    """読み込み済みサーバーデータ（bot.vending_machines）のLRU管理とメモリ使用量の推定
+
+    サーバーデータは初回アクセス時にストレージから読み込み、GUILD_IDLE_SECONDS以上
+    使われていないサーバーと、推定サイズの合計がGUILD_MEMORY_BUDGETを超えた分の
+    古いサーバーをメモリから外す。未保存の変更・配送中の注文・処理中の操作がある
+    サーバーは外さない
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.last_used = OrderedDict()  # {guild_id: 最終アクセス時刻} 古い順
+        self.sizes = {}  # {guild_id: 推定バイト数}
+        self.stale = set()  # アクセス後にサイズを測り直していないサーバー
+        self.pins = {}  # {guild_id: 処理中の操作数}
+        self.loading = {}  # {guild_id: スレッドで読み込み中のタスク}
+        self.loads = 0
+        self.sync_loads = 0  # イベントループ上で同期読み込みした回数
+        self.evictions = 0
+
+    def touch(self, guild_id):
+        self.last_used[guild_id] = time.time()
+        self.last_used.move_to_end(guild_id)
+        self.stale.add(guild_id)
+
+    async def load(self, guild_id):
+        """メモリにないサーバーデータをスレッドで読み込む（同じサーバーへの同時の読み込みは1つにまとめる）"""
+        if guild_id is None or guild_id in self.bot.vending_machines or not self.bot.storage.persistent:
+            return
+        task = self.loading.get(guild_id)
+        if task is None:
+            task = asyncio.create_task(self._load(guild_id))
+            self.loading[guild_id] = task
+        await asyncio.shield(task)
+
+    async def _load(self, guild_id):
+        try:
+            data = await asyncio.to_thread(self.bot.read_guild, guild_id)
+        finally:
+            self.loading.pop(guild_id, None)
+        if data is None:
+            return
+        if guild_id in self.bot.vending_machines:
+            # 読み込み中に同期で読み込まれた場合は先にあるものを使う
+            for product in data['products'].values():
+                product['inventory'].close()
+            return
+        self.bot.vending_machines[guild_id] = data
+        self.loads += 1
+        self.touch(guild_id)
+
+    @contextlib.contextmanager
+    def pin(self, guild_id):
+        """処理中はサーバーデータをメモリから外さない"""
+        self.pins[guild_id] = self.pins.get(guild_id, 0) + 1
+        try:
+            yield
+        finally:
+            self.pins[guild_id] -= 1
+            if not self.pins[guild_id]:
+                del self.pins[guild_id]
+
+    def estimate(self, vending_machine):
+        """サーバーデータのメモリ使用量の推定（注文は一部を実測して件数を掛ける）"""
+        size = 0
+        for key, value in vending_machine.items():
+            if key == 'products':
+                sample = list(itertools.islice(value.values(), GUILD_SIZE_SAMPLE))
+                for product in sample:
+                    # 在庫本文はmmapしたファイル側にあるため、メモリ上の部分のみ数える
+                    size += deep_sizeof({field: data for field, data in product.items() if field != 'inventory'}) * len(value) // len(sample)
+                    size += (sys.getsizeof(product['inventory']) + deep_sizeof(product['inventory'].front)) * len(value) // len(sample)
+                size += sys.getsizeof(value)
+            elif key == 'orders':
+                sample = list(itertools.islice(value.values(), GUILD_SIZE_SAMPLE))
+                if sample:
+                    size += sum(deep_sizeof(order) for order in sample) * len(value) // len(sample)
+                size += sys.getsizeof(value.orders)
+                for index in (value.by_status, value.by_user):
+                    size += sys.getsizeof(index) + sum(sys.getsizeof(entries) for entries in index.values())
+            else:
+                size += deep_sizeof(value)
+        return size
+
+    def measure(self):
+        """アクセスのあったサーバーのサイズを測り直す（解放処理の周期でのみ呼ぶ・商品と注文は一部だけ実測）"""
+        for guild_id in self.stale:
+            vending_machine = self.bot.vending_machines.get(guild_id)
+            if vending_machine is not None:
+                self.sizes[guild_id] = self.estimate(vending_machine)
+        self.stale.clear()
+
+    def total(self):
+        return sum(self.sizes.values())
+
+    def evictable(self, guild_id, busy_guilds):
+        return guild_id not in self.pins and guild_id not in busy_guilds
+
+    def busy_guilds(self):
+        """未保存の変更・保存中の変更・配送ジョブ・パネル更新待ちがあるサーバー"""
+        busy = {guild_id for _, guild_id, _ in self.bot.dirty}
+        busy.update(self.bot.flushing)
+        busy.update(guild_id for guild_id, _ in self.bot.delivery.jobs)
+        busy.update(self.bot.panels.pending)
+        return busy
+
+    def evict_cold(self):
+        """使われていないサーバーと予算を超えた分の古いサーバーをメモリから外す"""
+        self.measure()
+        if not self.bot.storage.persistent:
+            return 0
+        now = time.time()
+        total = self.total()
+        busy = self.busy_guilds()
+        evicted = 0
+        for guild_id, last_used in list(self.last_used.items()):
+            idle = now - last_used
+            if idle < GUILD_EVICT_MIN_IDLE:
+                break
+            if idle < GUILD_IDLE_SECONDS and total <= GUILD_MEMORY_BUDGET:
+                break
+            if not self.evictable(guild_id, busy):
+                continue
+            total -= self.sizes.get(guild_id, 0)
+            self.unload(guild_id)
+            evicted += 1
+        self.evictions += evicted
+        return evicted
+
+    def unload(self, guild_id):
+        """サーバーデータと派生キャッシュをメモリから外す"""
+        vending_machine = self.bot.vending_machines.pop(guild_id, None)
+        if vending_machine is not None:
+            for product in vending_machine['products'].values():
+                product['inventory'].close()
+        self.bot.catalog.drop(guild_id)
+        self.bot.panels.cache.pop(guild_id, None)
+        self.bot.payment_links.drop(guild_id)
+        self.last_used.pop(guild_id, None)
+        self.sizes.pop(guild_id, None)
+        self.stale.discard(guild_id)
+
+    def stats(self):
+        # サイズはguild_evict_loopで測った値（最大GUILD_EVICT_INTERVAL秒前）を返す
+        now = time.time()
+        return {
+            'loaded': len(self.bot.vending_machines),
+            'memory_bytes': self.total(),
+            'budget_bytes': GUILD_MEMORY_BUDGET,
+            'loads': self.loads,
+            'sync_loads': self.sync_loads,
+            'evictions': self.evictions,
+            'guilds': {
+                str(guild_id): {
+                    'bytes': size,
+                    'idle_seconds': round(now - self.last_used.get(guild_id, now), 1),
+                    'products': len(self.bot.vending_machines[guild_id]['products']),
+                    'orders': len(self.bot.vending_machines[guild_id]['orders'])
+                }
+                for guild_id, size in sorted(self.sizes.items(), key=lambda item: item[1], reverse=True)
+                if guild_id in self.bot.vending_machines
+            }
+        }
+
+class VendingCommandTree(app_commands.CommandTree):
+    """スラッシュコマンドの処理前にサーバーデータをスレッドで読み込むコマンドツリー"""
+
+    async def interaction_check(self, interaction):
+        await self.client.guild_cache.load(interaction.guild_id)
+        return True
+
+class VendingBot(commands.AutoShardedBot):
     def __init__(self):
         intents = discord.Intents.default()
         intents.message_content = False
         intents.guilds = True
-        super().__init__(command_prefix='!', intents=intents)
+        super().__init__(
+            command_prefix='!',
+            intents=intents,
+            tree_cls=VendingCommandTree,
+            shard_count=SHARD_COUNT,
+            shard_ids=[int(shard_id) for shard_id in SHARD_IDS.split(',')] if SHARD_IDS else None
+        )
 
-        # 半自動販売機システム（サーバーごと）
+        # クラスターの子プロセスとして動いている場合のクラスター番号
+        self.cluster_id = int(CLUSTER_ID) if CLUSTER_ID is not None else None
+
+        # 半自動販売機システム（サーバーごと・アクセスのあったサーバーのみ読み込む）
         self.vending_machines = {}  # {guild_id: {'products': {}, 'orders': {}, 'admin_channels': set(), 'next_order_id': 1}}
+        self.guild_cache = GuildCache(self)
 
-    async def on_ready(self):
+        # 注文ごとの在庫引当
+        self.reservations = StockReservations(self)
+
+        # 売上集計
+        self.sales = SalesRollup(self)
+
+        # 使用済み決済リンクの索引
+        self.payment_links = PaymentLinkIndex(self)
+
+        # 注文作成の頻度制限
+        self.throttle = OrderThrottle()
+        self.throttle_task = None
+
+        # 注文・在庫の操作ログ
+        self.journal = OrderJournal(self)
+        self.journal_task = None
+
+        # 商品一覧と検索インデックス
+        self.catalog = ProductCatalog(self)
+
+        # 設置済みパネルの管理
+        self.panels = PanelRegistry(self)
+
+        # チャンネルごとの送信キュー
+        self.outbound = OutboundDispatcher(self)
+
+        # 商品DM配送
+        self.delivery = DeliveryPipeline(self)
+
+        # ユーザー情報のキャッシュ
+        self.user_resolver = UserResolver(self)
+
+        # イベントループの監視
+        self.loop_monitor = LoopMonitor()
+        self.profiler = SamplingProfiler()
+
+        # 永続化（書き込みはまとめてバックグラウンドで反映）
+        self.storage = create_storage()
+        self.dirty = {}  # {(kind, guild_id, key): None} 挿入順を保った未保存キー
+        self.dirty_event = asyncio.Event()
+        self.flush_lock = asyncio.Lock()  # 書き込みは1つずつ行う（売上集計の読み込みもこれを待つ）
+        self.flushing = set()  # 書き込み中の変更があるサーバー
+        self.flush_task = None
+
+        # 決済確認待ち注文の期限管理（全注文を1つのタスクで処理）
+        self.order_expiry = TimingWheel()
+        self.expiry_task = None
+        self.expiry_notification_tasks = set()  # 送信中の期限切れ通知（完了までタスクの参照を保つ）
+
+        # 古い完了済み注文のアーカイブ
+        self.archive_task = None
+        self.archived_orders = 0
+
+        # 使われていないサーバーデータをメモリから外すタスク
+        self.evict_task = None
+
+        # ログ出力のキュー（main()で設定）
+        self.log_handler = None
+
+        # 起動時に一度だけ行う処理の状態（on_readyは再接続のたびに呼ばれる）
+        self.web_runner = None
+        self.ready_once = False
+
+    async def setup_hook(self):
         # ボット開始時刻を記録
         self.start_time = time.time()
 
-        print(f'{self.user} がログインしました！')
-        print(f'参加しているサーバー: {len(self.guilds)}個')
+        # 永続化ストレージを開き、ストレージに未反映の操作ログを再生してから書き込みタスクを開始
+        self.storage.open()
+        await self.replay_journal()
+        self.flush_task = asyncio.create_task(self.storage_flush_loop())
+        self.journal_task = asyncio.create_task(self.journal.run())
+
+        # イベントループの監視を開始
+        self.loop_monitor.start()
+
+        # パネル・管理者通知のコンポーネントをcustom_idから復元できるよう登録
+        # （メッセージごとの登録やREST呼び出しは不要）
+        self.add_dynamic_items(ProductSelect, CategorySelect, CatalogPageButton, ApproveOrderButton, RejectOrderButton, BulkApprovalSelect)
+
+        # 保存済みの決済確認待ち注文を期限管理に登録（担当シャードのサーバーのみ）
+        for guild_id, order_id, timestamp in await asyncio.to_thread(self.storage.orders_with_status, 'pending_payment'):
+            if self.owns_guild(guild_id):
+                self.schedule_order_expiry(guild_id, order_id, timestamp)
+        self.expiry_task = asyncio.create_task(self.order_expiry_loop())
+        self.archive_task = asyncio.create_task(self.order_archive_loop())
+        self.evict_task = asyncio.create_task(self.guild_evict_loop())
+        self.throttle_task = asyncio.create_task(self.throttle_prune_loop())
+
+        # 商品配送ワーカーを開始し、配送途中で停止した注文を再開
+        self.delivery.start()
+        delivering = [
+            (guild_id, order_id)
+            for guild_id, order_id, _ in await asyncio.to_thread(self.storage.orders_with_status, 'delivering')
+            if self.owns_guild(guild_id)
+        ]
+        if delivering:
+            self.delivery.resume_task = asyncio.create_task(self.delivery.resume(delivering))
+
+        # スラッシュコマンドを同期（定義が変わった場合のみ・クラスター構成では先頭のクラスターのみ）
+        if not self.cluster_id:
+            await self.sync_commands()
 
-        # 参加している全サーバーの情報を表示
-        for guild in self.guilds:
-            print(f'- {guild.name} (ID: {guild.id})')
+        # Webサーバーを開始
+        await self.start_web_server()
+
+    async def close(self):
+        # 終了前に未保存の変更を書き込む
+        for task in (self.flush_task, self.journal_task, self.expiry_task, self.archive_task, self.evict_task, self.throttle_task):
+            if task:
+                task.cancel()
+        self.delivery.stop()
+        self.loop_monitor.stop()
+        try:
+            await self.journal.sync()
+        except Exception as e:
+            log_event('journal_write_failed', f'終了時のジャーナル書き込みエラー: {e}', logging.ERROR, exc_info=True)
+        try:
+            await self.flush_storage()
+        except Exception as e:
+            log_event('storage_flush_failed', f'終了時の保存エラー: {e}', logging.ERROR, exc_info=True)
+        self.journal.close()
+        self.storage.close()
+        if self.web_runner:
+            await self.web_runner.cleanup()
+        await super().close()
+
+    async def on_ready(self):
+        # 再接続時はステータスもIdentifyで引き継がれるため、ログのみ出力
+        if self.ready_once:
+            log_event('reconnected', f'{self.user} がGatewayに再接続しました（サーバー: {len(self.guilds)}個）', guilds=len(self.guilds))
+            return
+        self.ready_once = True
+
+        log_event('ready', f'{self.user} がログインしました！ 参加しているサーバー: {len(self.guilds)}個', user_id=self.user.id, guilds=len(self.guilds))
 
         # プレイ中ステータスを設定
         await self.update_status()
 
-        # スラッシュコマンドを同期
+    def shard_of(self, guild_id):
+        """サーバーを担当するシャードID"""
+        return (guild_id >> 22) % (self.shard_count or 1)
+
+    def owns_guild(self, guild_id):
+        """このプロセスが担当するシャードのサーバーか（シャードを分割していない場合は常にTrue）"""
+        if self.shard_ids is None:
+            return True
+        return self.shard_of(guild_id) in self.shard_ids
+
+    def shard_stats(self):
+        """シャードごとの接続状態とサーバー数"""
+        guild_counts = {}
+        for guild in self.guilds:
+            guild_counts[guild.shard_id] = guild_counts.get(guild.shard_id, 0) + 1
+        loaded_counts = {}
+        for guild_id in self.vending_machines:
+            shard_id = self.shard_of(guild_id)
+            loaded_counts[shard_id] = loaded_counts.get(shard_id, 0) + 1
+        return {
+            str(shard_id): {
+                # Heartbeatの応答を受け取るまではinf/NaN
+                'latency': shard.latency if math.isfinite(shard.latency) else None,
+                'closed': shard.is_closed(),
+                'guilds': guild_counts.get(shard_id, 0),
+                'loaded_guilds': loaded_counts.get(shard_id, 0)
+            }
+            for shard_id, shard in self.shards.items()
+        }
+
+    def command_tree_hash(self):
+        """スラッシュコマンド定義のハッシュ（アプリケーションごと）"""
+        commands_payload = sorted(
+            (command.to_dict(self.tree) for command in self.tree.get_commands()),
+            key=lambda command: command['name']
+        )
+        digest = hashlib.sha256(
+            json.dumps(commands_payload, sort_keys=True, ensure_ascii=False).encode('utf-8')
+        ).hexdigest()
+        return f'{self.application_id}:{digest}'
+
+    async def sync_commands(self):
+        """前回同期した定義から変わっている場合のみスラッシュコマンドを同期"""
+        tree_hash = self.command_tree_hash()
+        if await asyncio.to_thread(self.storage.get_meta, 'command_tree_hash') == tree_hash:
+            log_event('command_sync_skipped', 'スラッシュコマンドに変更がないため同期を省略しました')
+            return
+
         try:
             synced = await self.tree.sync()
-            print(f'{len(synced)}個のスラッシュコマンドを同期しました')
         except Exception as e:
-            print(f'スラッシュコマンドの同期エラー: {e}')
+            log_event('command_sync_failed', f'スラッシュコマンドの同期エラー: {e}', logging.ERROR, error=str(e))
+            return
 
-        # Webサーバーを開始
-        await self.start_web_server()
+        await asyncio.to_thread(self.storage.set_meta, 'command_tree_hash', tree_hash)
+        log_event('command_synced', f'{len(synced)}個のスラッシュコマンドを同期しました', commands=len(synced))
 
     async def update_status(self):
         """プレイ中ステータスを更新"""
@@ -57,40 +3274,394 @@ class VendingBot(commands.Bot):
             guild_count = len(self.guilds)
             activity = discord.Game(name=f"半自動販売機 - {guild_count}サーバーで稼働中")
             await self.change_presence(activity=activity, status=discord.Status.online)
-            print(f'ステータスを更新: 半自動販売機 - {guild_count}サーバーで稼働中')
+            log_event('presence_updated', f'ステータスを更新: 半自動販売機 - {guild_count}サーバーで稼働中', guilds=guild_count)
         except Exception as e:
-            print(f'ステータス更新エラー: {e}')
+            log_event('presence_update_failed', f'ステータス更新エラー: {e}', logging.WARNING, error=str(e))
 
     async def on_guild_join(self, guild):
         """新しいサーバーに参加した時の処理"""
-        print(f'新しいサーバーに参加しました: {guild.name} (ID: {guild.id})')
+        log_event('guild_joined', f'新しいサーバーに参加しました: {guild.name} (ID: {guild.id})', guild_id=guild.id)
 
         # ステータスを更新
         await self.update_status()
 
     async def on_guild_remove(self, guild):
         """サーバーから退出した時の処理"""
-        print(f'サーバーから退出しました: {guild.name} (ID: {guild.id})')
+        log_event('guild_removed', f'サーバーから退出しました: {guild.name} (ID: {guild.id})', guild_id=guild.id)
 
         # 関連データをクリーンアップ
-        if guild.id in self.vending_machines:
-            del self.vending_machines[guild.id]
+        self.guild_cache.unload(guild.id)
+        self.mark_dirty(guild.id, 'delete_guild')
+        await asyncio.to_thread(shutil.rmtree, self.storage.inventory_dir(guild.id), True)
+        await asyncio.to_thread(shutil.rmtree, self.storage.archive_dir(guild.id), True)
 
         # ステータスを更新
         await self.update_status()
 
+    def read_guild(self, guild_id):
+        """保存済みのサーバーデータを読み込んで在庫ファイルを開く（なければNone・スレッドからも呼ぶ）"""
+        data = self.storage.load_guild(guild_id)
+        if data is not None:
+            data['admin_channels'] = set(data.get('admin_channels', []))
+            data.setdefault('panels', [])
+            for product_id, product in data['products'].items():
+                product['inventory'] = self.open_inventory(guild_id, product_id, product.get('inventory'))
+            data['orders'] = OrderStore(data['orders'])
+        return data
+
     def get_guild_vending_machine(self, guild_id):
-        """サーバーの販売機データを取得（存在しない場合は初期化）"""
+        """サーバーの販売機データを取得（存在しない場合は初期化）
+
+        操作の入口（コマンド・ボタン・モーダル）ではGuildCache.loadでスレッドから読み込み済みのため、
+        ここでストレージを同期で読むのは起動時の復元やバックグラウンド処理が外したサーバーに触れた場合のみ
+        """
+        self.guild_cache.touch(guild_id)
         if guild_id not in self.vending_machines:
+            # 保存済みのデータがあれば初回アクセス時（メモリから外した後は次のアクセス時）に読み込む
+            data = self.read_guild(guild_id)
+            if data is not None:
+                self.vending_machines[guild_id] = data
+                self.guild_cache.loads += 1
+                self.guild_cache.sync_loads += 1
+                return data
+
             self.vending_machines[guild_id] = {
-                'products': {},  # {product_id: {'name': str, 'price': int, 'description': str, 'stock': int, 'inventory': [str]}}
-                'orders': {},    # {order_id: {'user_id': str, 'product_id': str, 'status': str, 'channel_id': int}}
+                'products': {},  # {product_id: {'name': str, 'price': int, 'description': str, 'stock': int, 'reserved': int, 'inventory': InventoryQueue}}
+                'orders': OrderStore(),    # {order_id: {'user_id': str, 'product_id': str, 'price': int, 'status': str, 'channel_id': int, 'reserved': bool}}
                 'admin_channels': set(),  # 管理者チャンネルのIDセット
                 'achievement_channel': None,  # 実績チャンネルのID
+                'panels': [],  # 設置済みパネル [[channel_id, message_id]]
                 'next_order_id': 1
             }
+            self.mark_dirty(guild_id)
         return self.vending_machines[guild_id]
 
+    def open_inventory(self, guild_id, product_id, state=None):
+        """商品の在庫キューを開く（stateは保存済みの状態）"""
+        path = os.path.join(self.storage.inventory_dir(guild_id), product_id)
+        if state is None:
+            return InventoryQueue(path, reset=True)
+        if isinstance(state, list):
+            # 旧形式（リストで保存された在庫）を移行
+            inventory = InventoryQueue(path, reset=True)
+            inventory.extend(state)
+            return inventory
+        return InventoryQueue(path, head=state.get('head', 0), front=state.get('front'))
+
+    def set_order_status(self, guild_id, order_id, status):
+        """注文のステータスを変更（ステータスの変更はすべてここを通す）"""
+        orders = self.get_guild_vending_machine(guild_id)['orders']
+        previous_status = orders[order_id]['status']
+        order = orders.set_status(order_id, status)
+        self.mark_dirty(guild_id, 'order', order_id)
+        metrics.order_status(status)
+        self.record_transition(guild_id, order_id, order, previous_status)
+        return order
+
+    def record_transition(self, guild_id, order_id, order, previous_status):
+        """注文ステータスの遷移を監査ログと操作ログに残す"""
+        audit_order(guild_id, order_id, order, previous_status)
+        self.journal.append('transition', guild_id, str(order_id), {
+            'from': previous_status,
+            'to': order['status'],
+            'user_id': order.get('user_id'),
+            'product_id': order.get('product_id'),
+            'processed_by': order.get('processed_by')
+        })
+
+    def inventory_of(self, guild_id, product_id):
+        """読み込み済みの商品の在庫キュー（無い場合はNone）"""
+        product = self.vending_machines.get(guild_id, {}).get('products', {}).get(product_id)
+        return product['inventory'] if product is not None else None
+
+    def mark_dirty(self, guild_id, kind='guild', key=None):
+        """変更されたデータを保存待ちとして記録（実際の書き込みはまとめて行う）"""
+        self.dirty[(kind, guild_id, key)] = None
+        self.dirty_event.set()
+
+        # 注文・在庫の変更は操作ログにも残す
+        if kind in ('order', 'product', 'delete_guild'):
+            self.journal.record(kind, guild_id, key)
+
+        # 商品・在庫の変更はパネルの表示に反映する
+        if kind == 'product':
+            self.panels.invalidate(guild_id)
+
+    def serialize_dirty(self):
+        """保存待ちのデータを書き込み操作に変換"""
+        dirty = self.dirty
+        self.dirty = {}
+        self.dirty_event.clear()
+
+        ops = []
+        for kind, guild_id, key in dirty:
+            if kind == 'delete_guild':
+                ops.append((kind, guild_id, None, None))
+                continue
+            if kind == 'sale':
+                ops.append((kind, guild_id, key, self.sales.take(guild_id, key)))
+                continue
+            if kind == 'payment_link':
+                order_id = self.payment_links.take(guild_id, key)
+                if order_id is not None:
+                    ops.append((kind, guild_id, key, order_id))
+                continue
+
+            ops.append((kind, guild_id, key, self.serialize_entry(kind, guild_id, key)))
+        return ops
+
+    def serialize_entry(self, kind, guild_id, key):
+        """サーバー設定・商品・注文の現在の状態をJSONにする（存在しない場合はNone）"""
+        vending_machine = self.vending_machines.get(guild_id)
+        if vending_machine is None:
+            return None
+        if kind == 'guild':
+            return json.dumps({
+                'admin_channels': list(vending_machine['admin_channels']),
+                'achievement_channel': vending_machine['achievement_channel'],
+                'panels': vending_machine.get('panels', []),
+                'next_order_id': vending_machine['next_order_id']
+            })
+        if kind == 'product':
+            product = vending_machine['products'].get(key)
+            return json.dumps(dict(product, inventory=product['inventory'].to_state())) if product is not None else None
+        if kind == 'order':
+            order = vending_machine['orders'].get(key)
+            return json.dumps(order) if order is not None else None
+        return None
+
+    async def flush_storage(self):
+        """保存待ちのデータを1トランザクションで書き込む（同時に複数の書き込みは行わない）"""
+        async with self.flush_lock:
+            snapshot_seq = await self.write_dirty()
+        if snapshot_seq is not None and self.journal.enabled:
+            try:
+                await self.journal.compact(snapshot_seq)
+            except Exception as e:
+                log_event('journal_archive_failed', f'操作ログのアーカイブエラー: {e}', logging.ERROR, exc_info=True)
+
+    async def write_dirty(self):
+        """保存待ちのデータを書き込み、反映した操作ログのseqを返す（保存待ちが無い場合はNone）"""
+        if not self.dirty:
+            return None
+        # シリアライズはループ上で行い、ディスク書き込みはスレッドに任せる
+        # 操作ログのどこまでを反映したかを同じトランザクションで記録する
+        self.journal.serialize()
+        snapshot_seq = self.journal.seq
+        ops = self.serialize_dirty()
+        if self.journal.enabled:
+            ops.append(('meta', None, self.journal.meta_key, str(snapshot_seq)))
+        # 書き込みが終わるまでは該当サーバーをメモリから外さない（古いデータを読み直さないため）
+        guild_ids = {guild_id for kind, guild_id, _, _ in ops if kind != 'meta'}
+        self.flushing |= guild_ids
+        try:
+            await asyncio.to_thread(self.storage.write_batch, ops)
+        except Exception:
+            # 失敗した分は次回の書き込みで再試行する
+            for kind, guild_id, key, data in ops:
+                if kind == 'meta':
+                    continue
+                if kind == 'sale':
+                    # 加算分は取り出し済みのため戻してから再試行する
+                    self.sales.restore(guild_id, key, data)
+                elif kind == 'payment_link':
+                    self.payment_links.restore(guild_id, key, data)
+                self.dirty.setdefault((kind, guild_id, key), None)
+            self.dirty_event.set()
+            raise
+        finally:
+            self.flushing -= guild_ids
+        return snapshot_seq
+
+    async def replay_journal(self):
+        """前回終了時にストレージへ反映されていなかった操作ログを適用し、記録を開始"""
+        if not JOURNAL_ENABLED or not self.storage.persistent:
+            return
+        snapshot_seq = int(self.storage.get_meta(self.journal.meta_key, 0))
+        started_at = time.perf_counter()
+        last_seq, count, latest, deltas = await asyncio.to_thread(self.journal.replay, snapshot_seq)
+        self.journal.open(last_seq, snapshot_seq)
+        if not latest and not deltas:
+            return
+
+        self.apply_journal(latest, deltas)
+        self.journal.replayed = count
+        await self.flush_storage()
+        log_event(
+            'journal_replayed',
+            f'操作ログから{count}件のイベント（{len(latest) + len(deltas)}件のキー）を再生しました ({time.perf_counter() - started_at:.2f}秒)',
+            events=count, keys=len(latest) + len(deltas), from_seq=snapshot_seq, to_seq=last_seq, seconds=time.perf_counter() - started_at
+        )
+
+    def apply_journal(self, latest, deltas=None):
+        """キーごとの最後の状態と加算分を販売機データに反映 latest: {(kind, guild_id, key): 状態のJSON}
+
+        加算分は操作ログに記録し直さない（保存前に再び終了しても元のイベントから同じ分だけ再生されるため）
+        """
+        for (kind, guild_id, key), data in (deltas or {}).items():
+            if kind == 'sale':
+                self.sales.restore(guild_id, key, data)
+            elif kind == 'payment_link':
+                self.payment_links.restore(guild_id, key, data)
+            self.mark_dirty(guild_id, kind, key)
+        for (kind, guild_id, key), data in latest.items():
+            if kind == 'delete_guild':
+                self.mark_dirty(guild_id, 'delete_guild')
+                continue
+            state = json.loads(data)
+            vending_machine = self.get_guild_vending_machine(guild_id)
+            if kind == 'order':
+                if state is None:
+                    vending_machine['orders'].pop(key)
+                else:
+                    vending_machine['orders'][key] = state
+                    if key.isdigit() and int(key) >= vending_machine['next_order_id']:
+                        vending_machine['next_order_id'] = int(key) + 1
+                        self.mark_dirty(guild_id)
+            elif kind == 'product':
+                previous = vending_machine['products'].pop(key, None)
+                if previous is not None:
+                    previous['inventory'].close()
+                if state is not None:
+                    state['inventory'] = self.open_inventory(guild_id, key, state['inventory'])
+                    vending_machine['products'][key] = state
+                self.catalog.drop(guild_id)
+            self.mark_dirty(guild_id, kind, key)
+
+    async def storage_flush_loop(self):
+        """変更を一定間隔でまとめて保存するバックグラウンドタスク"""
+        while True:
+            await self.dirty_event.wait()
+            # 短時間に発生した変更を1回の書き込みにまとめる
+            await asyncio.sleep(STORAGE_FLUSH_INTERVAL)
+            try:
+                await self.flush_storage()
+            except Exception as e:
+                log_event('storage_flush_failed', f'データ保存エラー: {e}', logging.ERROR, exc_info=True)
+
+    def schedule_order_expiry(self, guild_id, order_id, timestamp):
+        """注文を期限管理に登録"""
+        self.order_expiry.schedule((guild_id, str(order_id)), timestamp + ORDER_EXPIRY_SECONDS)
+
+    async def order_expiry_loop(self):
+        """期限切れの注文を処理するバックグラウンドタスク"""
+        while True:
+            await asyncio.sleep(self.order_expiry.tick)
+            expired = self.order_expiry.advance(time.time())
+            notifications = []
+            for guild_id, order_id in expired:
+                try:
+                    order = self.expire_order(guild_id, order_id)
+                    if order:
+                        notifications.append((order_id, order))
+                except Exception as e:
+                    log_event('order_expiry_failed', f'注文期限切れ処理エラー (注文 #{order_id}): {e}', logging.ERROR, exc_info=True, guild_id=guild_id, order_id=order_id)
+
+            if notifications:
+                task = asyncio.create_task(self.send_expiry_notifications(notifications))
+                self.expiry_notification_tasks.add(task)
+                task.add_done_callback(self.expiry_notification_tasks.discard)
+
+    def expire_order(self, guild_id, order_id):
+        """決済確認待ちの注文を期限切れにして引当を解除
+
+        購入者に通知する注文（決済リンクを送信済みで引当のあった注文）を返す。
+        決済リンクの入力画面で放置された注文は通知せずに期限切れにする
+        """
+        vending_machine = self.get_guild_vending_machine(guild_id)
+        order = vending_machine['orders'].get(order_id)
+        if not order or order['status'] != 'pending_payment':
+            return None
+
+        # 再登録された注文などで期限がまだ先の場合は登録し直す
+        deadline = order.get('timestamp', 0) + ORDER_EXPIRY_SECONDS
+        if deadline > time.time():
+            self.schedule_order_expiry(guild_id, order_id, order.get('timestamp', 0))
+            return None
+
+        reserved = order.get('reserved')
+        order['processed_at'] = time.time()
+        self.set_order_status(guild_id, order_id, 'expired')
+        self.reservations.release(guild_id, order_id)
+        log_event('order_expired', f'注文 #{order_id} (サーバーID: {guild_id}) が期限切れになりました', guild_id=guild_id, order_id=order_id, user_id=order['user_id'], reserved=bool(reserved))
+        return order if reserved else None
+
+    async def order_archive_loop(self):
+        """古い完了・キャンセル・期限切れの注文を定期的にアーカイブするバックグラウンドタスク"""
+        while True:
+            await asyncio.sleep(ORDER_ARCHIVE_INTERVAL)
+            for guild_id in list(self.vending_machines):
+                try:
+                    await self.archive_orders(guild_id)
+                except Exception as e:
+                    log_event('order_archive_failed', f'注文アーカイブエラー (サーバーID: {guild_id}): {e}', logging.ERROR, exc_info=True, guild_id=guild_id)
+
+    async def archive_orders(self, guild_id):
+        """ORDER_ARCHIVE_AGEより前に処理が終わった注文を圧縮ファイルに移し、メモリとDBから削除"""
+        vending_machine = self.vending_machines.get(guild_id)
+        if vending_machine is None:
+            return 0
+        orders = vending_machine['orders'].archivable(time.time() - ORDER_ARCHIVE_AGE, ORDER_ARCHIVE_BATCH)
+        if not orders:
+            return 0
+
+        # ファイルへの書き込みが終わってから削除する（失敗した場合は次回に再試行）
+        with self.guild_cache.pin(guild_id):
+            file = await asyncio.to_thread(self.storage.archive_orders, guild_id, orders)
+        archived = 0
+        for order_id, order in orders:
+            if vending_machine['orders'].get(order_id) is order and order['status'] in TERMINAL_ORDER_STATUSES:
+                vending_machine['orders'].pop(order_id)
+                self.mark_dirty(guild_id, 'order', order_id)
+                # 注文検索で読むファイルを絞れるよう、注文の削除と同じ書き込みで索引に加える
+                index_key = (order_id, order.get('user_id'), file)
+                self.mark_dirty(guild_id, 'archived_order', index_key)
+                self.journal.append('archived_order', guild_id, index_key, None)
+                archived += 1
+        self.archived_orders += archived
+        log_event('orders_archived', f'{archived}件の注文をアーカイブしました (サーバーID: {guild_id})', guild_id=guild_id, archived=archived)
+        return archived
+
+    async def guild_evict_loop(self):
+        """使われていないサーバーデータを定期的にメモリから外すバックグラウンドタスク"""
+        while True:
+            await asyncio.sleep(GUILD_EVICT_INTERVAL)
+            try:
+                evicted = self.guild_cache.evict_cold()
+                if evicted:
+                    log_event('guilds_evicted', f'{evicted}個のサーバーデータをメモリから外しました', evicted=evicted, loaded=len(self.vending_machines), memory_bytes=self.guild_cache.total())
+            except Exception as e:
+                log_event('guild_evict_failed', f'サーバーデータの解放エラー: {e}', logging.ERROR, exc_info=True)
+
+    async def throttle_prune_loop(self):
+        """使われなくなった頻度制限の状態を定期的に削除するバックグラウンドタスク"""
+        while True:
+            await asyncio.sleep(THROTTLE_PRUNE_INTERVAL)
+            self.throttle.prune()
+
+    async def send_expiry_notifications(self, notifications):
+        """期限切れになった注文を購入者と管理者メッセージに通知"""
+        for order_id, order in notifications:
+            admin_embed = discord.Embed(
+                title="⌛ 注文期限切れ",
+                description=f"注文 #{order_id} は決済確認が行われなかったため期限切れになりました。",
+                color=get_random_color()
+            )
+            # 管理者メッセージの編集はチャンネルの送信キューに任せる（失敗は送信キューがログに残す）
+            self.delivery.update_admin_messages(order, embed=admin_embed, view=None)
+
+            try:
+                user = await self.user_resolver.resolve(order['user_id'])
+                expired_embed = discord.Embed(
+                    title="⌛ 注文期限切れ",
+                    description=f"注文 #{order_id} は決済確認が行われなかったため期限切れになりました。\n"
+                               "ご不明な点がございましたら、サーバー管理者にお問い合わせください。",
+                    color=get_random_color()
+                )
+                await user.send(embed=expired_embed)
+            except Exception as e:
+                log_event('expiry_notice_failed', f'期限切れ通知DM送信エラー (注文 #{order_id}): {e}', logging.WARNING, order_id=order_id, user_id=order['user_id'], error=str(e))
+
     async def start_web_server(self):
         from aiohttp import web
 
@@ -101,15 +3672,26 @@ class VendingBot(commands.Bot):
         app.router.add_get('/health', self.handle_health_check)
         app.router.add_get('/ping', self.handle_health_check)
         app.router.add_get('/status', self.handle_status_check)
+        app.router.add_get('/metrics', self.handle_metrics)
+        app.router.add_get('/sales', self.handle_sales)
+        app.router.add_get('/debug/loop', self.handle_debug_loop)
+        app.router.add_get('/debug/profile', self.handle_debug_profile)
 
-        runner = web.AppRunner(app)
+        runner = self.web_runner = web.AppRunner(app)
         await runner.setup()
 
+        # クラスターの子プロセスは親プロセスからのみ問い合わせを受ける
+        if self.cluster_id is not None:
+            path = cluster_socket_path(self.cluster_id)
+            await web.UnixSite(runner, path).start()
+            log_event('ipc_server_started', f'クラスター {self.cluster_id} のIPCサーバーが {path} で開始されました', path=path)
+            return
+
         # Renderではポート10000を使用
         port = int(os.getenv('PORT', 10000))
         site = web.TCPSite(runner, '0.0.0.0', port)
         await site.start()
-        print(f'Webサーバーが http://0.0.0.0:{port} で開始されました')
+        log_event('web_server_started', f'Webサーバーが http://0.0.0.0:{port} で開始されました', port=port)
 
     async def handle_health_check(self, request):
         """ヘルスチェックエンドポイント"""
@@ -135,13 +3717,438 @@ class VendingBot(commands.Bot):
 
         status_data = {
             "status": "online" if self.is_ready() else "offline",
+            "cluster_id": self.cluster_id,
+            "shard_count": self.shard_count,
+            "shards": self.shard_stats(),
             "guilds_count": len(self.guilds),
             "user": {
                 "name": self.user.name if self.user else None,
                 "id": self.user.id if self.user else None
             },
             "uptime": time.time() - getattr(self, 'start_time', time.time()),
-            "timestamp": time.time()
+            "timestamp": time.time(),
+            "outbound": self.outbound.stats(),
+            "delivery": self.delivery.stats(),
+            "orders": {
+                "in_memory": sum(len(vending_machine['orders']) for vending_machine in self.vending_machines.values()),
+                "archived": self.archived_orders
+            },
+            "guild_cache": self.guild_cache.stats(),
+            "payment_links": self.payment_links.stats(),
+            "throttle_buckets": self.throttle.stats(),
+            "journal": self.journal.stats(),
+            "user_cache": self.user_resolver.stats(),
+            "event_loop": self.loop_monitor.stats(),
+            "logging": self.log_handler.stats() if self.log_handler else None
+        }
+
+        return web.Response(
+            text=json.dumps(status_data, indent=2),
+            status=200,
+            content_type='application/json'
+        )
+
+    async def handle_metrics(self, request):
+        """Prometheus形式のメトリクスを返すエンドポイント"""
+        from aiohttp import web
+
+        lines = []
+        metrics.render(lines)
+
+        delivery = self.delivery.stats()
+        lines.append('# HELP vending_deliveries_total Delivery jobs by result.')
+        lines.append('# TYPE vending_deliveries_total counter')
+        lines.append(f'vending_deliveries_total{format_labels({"result": "completed"})} {delivery["completed"]}')
+        lines.append(f'vending_deliveries_total{format_labels({"result": "failed"})} {delivery["failed"]}')
+        lines.append('# TYPE vending_delivery_retries_total counter')
+        lines.append(f'vending_delivery_retries_total {delivery["retries"]}')
+        lines.append('# TYPE vending_delivery_queue_depth gauge')
+        lines.append(f'vending_delivery_queue_depth {delivery["queue_depth"]}')
+
+        lines.append('# HELP vending_orders_archived_total Terminal orders moved to archive segments.')
+        lines.append('# TYPE vending_orders_archived_total counter')
+        lines.append(f'vending_orders_archived_total {self.archived_orders}')
+
+        lines.append('# HELP vending_guilds_loaded Guilds whose state is resident in memory.')
+        lines.append('# TYPE vending_guilds_loaded gauge')
+        lines.append(f'vending_guilds_loaded {len(self.vending_machines)}')
+        lines.append('# HELP vending_guild_memory_bytes Estimated memory used by resident guild state.')
+        lines.append('# TYPE vending_guild_memory_bytes gauge')
+        lines.append(f'vending_guild_memory_bytes {self.guild_cache.total()}')
+        lines.append('# TYPE vending_guild_loads_total counter')
+        lines.append(f'vending_guild_loads_total {self.guild_cache.loads}')
+        lines.append('# HELP vending_guild_sync_loads_total Guild loads that blocked the event loop.')
+        lines.append('# TYPE vending_guild_sync_loads_total counter')
+        lines.append(f'vending_guild_sync_loads_total {self.guild_cache.sync_loads}')
+        lines.append('# TYPE vending_guild_evictions_total counter')
+        lines.append(f'vending_guild_evictions_total {self.guild_cache.evictions}')
+
+        payment_links = self.payment_links.stats()
+        lines.append('# HELP vending_payment_link_duplicates_total Submitted payment links already used by another order.')
+        lines.append('# TYPE vending_payment_link_duplicates_total counter')
+        lines.append(f'vending_payment_link_duplicates_total {payment_links["duplicates"]}')
+        lines.append('# TYPE vending_payment_link_exact_lookups_total counter')
+        lines.append(f'vending_payment_link_exact_lookups_total {payment_links["exact_lookups"]}')
+
+        lines.append('# TYPE vending_outbound_queue_depth gauge')
+        for channel_id, queue_stats in self.outbound.stats().items():
+            lines.append(f'vending_outbound_queue_depth{format_labels({"channel_id": channel_id})} {queue_stats["queue_depth"]}')
+
+        lines.append('# TYPE vending_shard_latency_seconds gauge')
+        lines.append('# TYPE vending_shard_guilds gauge')
+        for shard_id, shard in self.shard_stats().items():
+            labels = format_labels({'shard_id': shard_id})
+            if shard['latency'] is not None:
+                lines.append(f'vending_shard_latency_seconds{labels} {shard["latency"]}')
+            lines.append(f'vending_shard_guilds{labels} {shard["guilds"]}')
+
+        user_cache = self.user_resolver.stats()
+        lines.append('# TYPE vending_user_cache_lookups_total counter')
+        for result in ('client_hits', 'cache_hits', 'misses', 'coalesced'):
+            lines.append(f'vending_user_cache_lookups_total{format_labels({"result": result})} {user_cache[result]}')
+
+        # 在庫数・決済確認待ちの注文数（読み込み済みのサーバーのみ）
+        lines.append('# HELP vending_inventory_items Items in stock per product.')
+        lines.append('# TYPE vending_inventory_items gauge')
+        lines.append('# TYPE vending_reserved_items gauge')
+        lines.append('# TYPE vending_pending_orders gauge')
+        for guild_id, vending_machine in self.vending_machines.items():
+            for product_id, product in vending_machine['products'].items():
+                labels = format_labels({'guild_id': guild_id, 'product_id': product_id})
+                lines.append(f'vending_inventory_items{labels} {len(product["inventory"])}')
+                lines.append(f'vending_reserved_items{labels} {product.get("reserved", 0)}')
+            pending = len(vending_machine['orders'].with_status('pending_payment'))
+            lines.append(f'vending_pending_orders{format_labels({"guild_id": guild_id})} {pending}')
+
+        return web.Response(
+            text='\n'.join(lines) + '\n',
+            status=200,
+            content_type='text/plain',
+            charset='utf-8'
+        )
+
+    async def handle_sales(self, request):
+        """売上集計を返すエンドポイント（?guild_id=&days=&product_id=）"""
+        from aiohttp import web
+
+        denied = check_token(request, SALES_API_TOKEN, 'X-Sales-Token')
+        if denied is not None:
+            return denied
+
+        try:
+            guild_id = int(request.query['guild_id'])
+            days = min(max(int(request.query.get('days', 30)), 1), SALES_REPORT_MAX_DAYS)
+        except (KeyError, ValueError):
+            return web.Response(text='guild_id and days must be integers', status=400, content_type='text/plain')
+        if not self.owns_guild(guild_id):
+            return web.Response(text='guild is not on this cluster', status=404, content_type='text/plain')
+
+        report = await self.sales.report(guild_id, days, request.query.get('product_id'))
+        return web.Response(
+            text=json.dumps(report, indent=2, ensure_ascii=False),
+            status=200,
+            content_type='application/json'
+        )
+
+    def check_debug_token(self, request):
+        """デバッグ用エンドポイントへのアクセスを確認（許可する場合はNone、拒否する場合は応答を返す）"""
+        return check_token(request, DEBUG_TOKEN, 'X-Debug-Token')
+
+    async def handle_debug_loop(self, request):
+        """イベントループの遅延と処理時間の長いコールバックを返すエンドポイント"""
+        from aiohttp import web
+
+        denied = self.check_debug_token(request)
+        if denied is not None:
+            return denied
+
+        monitor = self.loop_monitor
+        slowest = sorted(monitor.slow_totals.items(), key=lambda item: item[1][1], reverse=True)[:20]
+        debug_data = {
+            "event_loop": monitor.stats(),
+            "recent_lag": list(monitor.recent_lag),
+            "slow_callbacks": list(monitor.slow_callbacks),
+            "slow_callback_totals": [
+                {"name": name, "count": count, "total": total, "max": longest}
+                for name, (count, total, longest) in slowest
+            ]
+        }
+
+        return web.Response(
+            text=json.dumps(debug_data, indent=2, ensure_ascii=False),
+            status=200,
+            content_type='application/json'
+        )
+
+    async def handle_debug_profile(self, request):
+        """イベントループのスレッドを指定秒数サンプリングした結果を返すエンドポイント
+
+        format=collapsed でフレームグラフ用の折り畳み形式、それ以外は上位のスタックを返す
+        """
+        from aiohttp import web
+
+        denied = self.check_debug_token(request)
+        if denied is not None:
+            return denied
+
+        try:
+            seconds = min(float(request.query.get('seconds', 5)), PROFILE_MAX_SECONDS)
+        except ValueError:
+            return web.Response(text='invalid seconds', status=400, content_type='text/plain')
+
+        try:
+            stacks = await asyncio.to_thread(self.profiler.run, threading.get_ident(), seconds)
+        except RuntimeError as e:
+            return web.Response(text=str(e), status=409, content_type='text/plain')
+
+        ranked = sorted(stacks.items(), key=lambda item: item[1], reverse=True)
+        if request.query.get('format') == 'collapsed':
+            text = '\n'.join(f'{stack} {count}' for stack, count in ranked)
+        else:
+            total = sum(stacks.values()) or 1
+            text = '\n\n'.join(
+                f'{count / total:.1%} ({count} samples)\n  ' + '\n  '.join(stack.split(';')[-8:])
+                for stack, count in ranked[:20]
+            )
+
+        return web.Response(text=text + '\n', status=200, content_type='text/plain', charset='utf-8')
+
+def cluster_socket_path(cluster_id):
+    """クラスターのIPC用UNIXソケットのパス"""
+    return os.path.join(IPC_DIR, f'cluster-{cluster_id}.sock')
+
+def plan_clusters(shard_count, cluster_count):
+    """シャードを連続した範囲に分けてクラスターに割り当てる [[shard_id]]"""
+    cluster_count = max(min(cluster_count, shard_count), 1)
+    size, extra = divmod(shard_count, cluster_count)
+    clusters = []
+    start = 0
+    for cluster_id in range(cluster_count):
+        end = start + size + (1 if cluster_id < extra else 0)
+        clusters.append(list(range(start, end)))
+        start = end
+    return clusters
+
+def add_metric_label(line, key, value):
+    """Prometheusのサンプル行にラベルを追加"""
+    label = format_labels({key: value})[1:-1]
+    brace = line.find('{')
+    space = line.find(' ')
+    if brace != -1 and brace < space:
+        return line[:brace + 1] + label + ',' + line[brace + 1:]
+    return line[:space] + '{' + label + '}' + line[space:]
+
+def merge_metrics(texts):
+    """クラスターごとのメトリクスをclusterラベルを付けてメトリクス名ごとにまとめる
+
+    texts: {cluster_id: メトリクスのテキスト}
+    """
+    families = {}  # {メトリクス名: [HELP・TYPE行, サンプル行]}
+    for cluster_id, text in texts.items():
+        current = None
+        for line in text.splitlines():
+            if not line:
+                continue
+            if line.startswith('# '):
+                parts = line.split(' ', 3)
+                if len(parts) >= 3 and parts[1] in ('HELP', 'TYPE'):
+                    current = parts[2]
+                    meta, _ = families.setdefault(current, ([], []))
+                    if not any(existing.split(' ', 3)[1] == parts[1] for existing in meta):
+                        meta.append(line)
+                continue
+            _, samples = families.setdefault(current, ([], []))
+            samples.append(add_metric_label(line, 'cluster', cluster_id))
+
+    lines = []
+    for meta, samples in families.values():
+        lines.extend(meta)
+        lines.extend(samples)
+    return lines
+
+class ClusterSupervisor:
+    """クラスター（シャードの一部を担当する子プロセス）の起動・監視
+
+    子プロセスはそれぞれUNIXソケットでWebエンドポイントを公開し、
+    親プロセスはPORTで受けた /status・/metrics などを全クラスターに問い合わせて集約する
+    """
+
+    def __init__(self, token):
+        self.token = token
+        self.shard_count = SHARD_COUNT
+        self.clusters = []  # [[shard_id]] クラスター番号順
+        self.processes = {}  # {cluster_id: asyncio.subprocess.Process}
+        self.restarts = {}  # {cluster_id: 再起動回数}
+        self.sessions = {}  # {cluster_id: aiohttp.ClientSession}
+        self.stopping = False
+        self.web_runner = None
+
+    async def fetch_shard_count(self):
+        """Discordの推奨シャード数を取得"""
+        async with aiohttp.ClientSession() as session:
+            async with session.get(
+                f'{discord.http.Route.BASE}/gateway/bot',
+                headers={'Authorization': f'Bot {self.token}'}
+            ) as response:
+                response.raise_for_status()
+                data = await response.json()
+        return data['shards']
+
+    async def run(self):
+        if self.shard_count is None:
+            self.shard_count = await self.fetch_shard_count()
+        self.clusters = plan_clusters(self.shard_count, CLUSTER_COUNT)
+        os.makedirs(IPC_DIR, exist_ok=True)
+        log_event('cluster_plan', f'{self.shard_count}個のシャードを{len(self.clusters)}個のクラスターで実行します', shard_count=self.shard_count, clusters=self.clusters)
+
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop_event.set)
+
+        await self.start_web_server()
+        supervisors = []
+        try:
+            # Identifyの同時実行数の制限に掛からないよう、前のクラスターの準備完了を待って次を起動
+            for cluster_id, shard_ids in enumerate(self.clusters):
+                supervisors.append(asyncio.create_task(self.supervise(cluster_id, shard_ids)))
+                await self.wait_until_ready(cluster_id, timeout=60 + 10 * len(shard_ids), stop_event=stop_event)
+                if stop_event.is_set():
+                    break
+            await stop_event.wait()
+        finally:
+            self.stopping = True
+            await self.stop_clusters()
+            for task in supervisors:
+                task.cancel()
+            for session in self.sessions.values():
+                await session.close()
+            if self.web_runner:
+                await self.web_runner.cleanup()
+
+    async def supervise(self, cluster_id, shard_ids):
+        """クラスターの子プロセスを起動し、異常終了した場合は再起動"""
+        env = dict(
+            os.environ,
+            CLUSTER_ID=str(cluster_id),
+            SHARD_IDS=','.join(map(str, shard_ids)),
+            SHARD_COUNT=str(self.shard_count),
+            IPC_DIR=IPC_DIR
+        )
+        while not self.stopping:
+            process = self.processes[cluster_id] = await asyncio.create_subprocess_exec(
+                sys.executable, os.path.abspath(__file__), env=env
+            )
+            log_event('cluster_started', f'クラスター {cluster_id} を起動しました (シャード: {shard_ids[0]}-{shard_ids[-1]}, PID: {process.pid})', cluster_id=cluster_id, shard_ids=shard_ids, pid=process.pid)
+            returncode = await process.wait()
+            if self.stopping:
+                return
+            self.restarts[cluster_id] = self.restarts.get(cluster_id, 0) + 1
+            log_event('cluster_exited', f'クラスター {cluster_id} が終了しました（終了コード {returncode}）。{CLUSTER_RESTART_DELAY}秒後に再起動します', logging.WARNING, cluster_id=cluster_id, returncode=returncode)
+            await asyncio.sleep(CLUSTER_RESTART_DELAY)
+
+    async def stop_clusters(self):
+        """子プロセスにSIGINTを送り、未保存の変更を書き込んで終了するのを待つ"""
+        for process in self.processes.values():
+            if process.returncode is None:
+                process.send_signal(signal.SIGINT)
+        for cluster_id, process in self.processes.items():
+            try:
+                await asyncio.wait_for(process.wait(), 30)
+            except asyncio.TimeoutError:
+                log_event('cluster_killed', f'クラスター {cluster_id} が終了しないため強制終了します', logging.WARNING, cluster_id=cluster_id)
+                process.kill()
+                await process.wait()
+
+    async def wait_until_ready(self, cluster_id, timeout, stop_event):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and not stop_event.is_set():
+            response = await self.query(cluster_id, '/health')
+            if response and response[0] == 200:
+                return True
+            await asyncio.sleep(1)
+        log_event('cluster_not_ready', f'クラスター {cluster_id} の準備完了を確認できませんでした', logging.WARNING, cluster_id=cluster_id)
+        return False
+
+    async def query(self, cluster_id, path, params=None, headers=None, timeout=5):
+        """クラスターのエンドポイントに問い合わせる（応答がなければNone）
+
+        戻り値: (ステータスコード, 本文)
+        """
+        session = self.sessions.get(cluster_id)
+        if session is None or session.closed:
+            session = self.sessions[cluster_id] = aiohttp.ClientSession(
+                connector=aiohttp.UnixConnector(path=cluster_socket_path(cluster_id))
+            )
+        try:
+            async with session.get(
+                f'http://cluster-{cluster_id}{path}',
+                params=params,
+                headers=headers,
+                timeout=aiohttp.ClientTimeout(total=timeout)
+            ) as response:
+                return response.status, await response.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError):
+            return None
+
+    async def query_all(self, path):
+        """全クラスターに並行して問い合わせる {cluster_id: (ステータスコード, 本文) または None}"""
+        responses = await asyncio.gather(*(self.query(cluster_id, path) for cluster_id in range(len(self.clusters))))
+        return dict(enumerate(responses))
+
+    async def start_web_server(self):
+        from aiohttp import web
+
+        app = web.Application()
+        app.router.add_get('/', self.handle_health_check)
+        app.router.add_get('/health', self.handle_health_check)
+        app.router.add_get('/ping', self.handle_health_check)
+        app.router.add_get('/status', self.handle_status_check)
+        app.router.add_get('/metrics', self.handle_metrics)
+        app.router.add_get('/sales', self.handle_sales)
+        app.router.add_get('/debug/loop', self.handle_debug)
+        app.router.add_get('/debug/profile', self.handle_debug)
+
+        runner = self.web_runner = web.AppRunner(app)
+        await runner.setup()
+        port = int(os.getenv('PORT', 10000))
+        await web.TCPSite(runner, '0.0.0.0', port).start()
+        log_event('web_server_started', f'Webサーバーが http://0.0.0.0:{port} で開始されました（{len(self.clusters)}クラスターを集約）', port=port, clusters=len(self.clusters))
+
+    async def handle_health_check(self, request):
+        """全クラスターが準備完了の場合のみOK"""
+        from aiohttp import web
+
+        responses = await self.query_all('/health')
+        ready = sum(1 for response in responses.values() if response and response[0] == 200)
+        if ready == len(self.clusters):
+            return web.Response(text="OK - 半自動販売機Bot is online", status=200, content_type='text/plain')
+        return web.Response(
+            text=f"Bot is not ready ({ready}/{len(self.clusters)} clusters)",
+            status=503,
+            content_type='text/plain'
+        )
+
+    async def handle_status_check(self, request):
+        """全クラスターのステータスを集約して返す"""
+        from aiohttp import web
+
+        clusters = {}
+        for cluster_id, response in (await self.query_all('/status')).items():
+            if response and response[0] == 200:
+                clusters[str(cluster_id)] = json.loads(response[1])
+            else:
+                clusters[str(cluster_id)] = {"status": "unreachable"}
+            clusters[str(cluster_id)]["restarts"] = self.restarts.get(cluster_id, 0)
+
+        online = sum(1 for data in clusters.values() if data["status"] == "online")
+        status_data = {
+            "status": "online" if online == len(clusters) else ("degraded" if online else "offline"),
+            "shard_count": self.shard_count,
+            "cluster_count": len(clusters),
+            "guilds_count": sum(data.get("guilds_count", 0) for data in clusters.values()),
+            "timestamp": time.time(),
+            "clusters": clusters
         }
 
         return web.Response(
@@ -150,26 +4157,110 @@ class VendingBot(commands.Bot):
             content_type='application/json'
         )
 
+    async def handle_metrics(self, request):
+        """全クラスターのメトリクスをclusterラベル付きで返す"""
+        from aiohttp import web
+
+        responses = await self.query_all('/metrics')
+        lines = merge_metrics({
+            cluster_id: response[1]
+            for cluster_id, response in responses.items()
+            if response and response[0] == 200
+        })
+        lines.append('# HELP vending_cluster_up Whether the cluster answered the metrics scrape.')
+        lines.append('# TYPE vending_cluster_up gauge')
+        for cluster_id, response in responses.items():
+            up = 1 if response and response[0] == 200 else 0
+            lines.append(f'vending_cluster_up{format_labels({"cluster": cluster_id})} {up}')
+        lines.append('# TYPE vending_cluster_restarts_total counter')
+        for cluster_id in range(len(self.clusters)):
+            lines.append(f'vending_cluster_restarts_total{format_labels({"cluster": cluster_id})} {self.restarts.get(cluster_id, 0)}')
+
+        return web.Response(
+            text='\n'.join(lines) + '\n',
+            status=200,
+            content_type='text/plain',
+            charset='utf-8'
+        )
+
+    async def handle_sales(self, request):
+        """売上集計をサーバーを担当するクラスターに転送"""
+        from aiohttp import web
+
+        try:
+            shard_id = (int(request.query['guild_id']) >> 22) % self.shard_count
+        except (KeyError, ValueError):
+            return web.Response(text='guild_id must be an integer', status=400, content_type='text/plain')
+        cluster_id = next(index for index, shard_ids in enumerate(self.clusters) if shard_id in shard_ids)
+
+        headers = {'X-Sales-Token': request.headers['X-Sales-Token']} if 'X-Sales-Token' in request.headers else None
+        response = await self.query(cluster_id, '/sales', dict(request.query), headers)
+        if response is None:
+            return web.Response(text='cluster unreachable', status=502, content_type='text/plain')
+        status, text = response
+        content_type = 'application/json' if status == 200 else 'text/plain'
+        return web.Response(text=text, status=status, content_type=content_type, charset='utf-8')
+
+    async def handle_debug(self, request):
+        """デバッグエンドポイントをclusterパラメーターで指定したクラスターに転送"""
+        from aiohttp import web
+
+        try:
+            cluster_id = int(request.query.get('cluster', 0))
+        except ValueError:
+            cluster_id = -1
+        if not 0 <= cluster_id < len(self.clusters):
+            return web.Response(text='invalid cluster', status=400, content_type='text/plain')
+
+        params = {key: value for key, value in request.query.items() if key != 'cluster'}
+        headers = {'X-Debug-Token': request.headers['X-Debug-Token']} if 'X-Debug-Token' in request.headers else None
+        response = await self.query(cluster_id, request.path, params, headers, timeout=PROFILE_MAX_SECONDS + 10)
+        if response is None:
+            return web.Response(text='cluster unreachable', status=502, content_type='text/plain')
+        status, text = response
+        content_type = 'application/json' if request.path == '/debug/loop' and status == 200 else 'text/plain'
+        return web.Response(text=text, status=status, content_type=content_type, charset='utf-8')
+
 # ボットインスタンス
 bot = VendingBot()
 
 # スラッシュコマンド
 
 
+async def product_id_autocomplete(interaction: discord.Interaction, current: str):
+    """商品IDの候補（商品IDまたは商品名の前方一致）"""
+    return [
+        app_commands.Choice(name=f"{product['name']} ({product_id})"[:100], value=product_id)
+        for product_id, product in bot.catalog.search(interaction.guild.id, current)
+    ]
+
+async def category_autocomplete(interaction: discord.Interaction, current: str):
+    """登録済みのカテゴリーの候補"""
+    current = current.lower()
+    categories = bot.catalog.get(interaction.guild.id).categories
+    return [
+        app_commands.Choice(name=category, value=category)
+        for category in categories if category.lower().startswith(current)
+    ][:25]
+
 @bot.tree.command(name='add_product', description='販売機に商品を追加します')
 @app_commands.describe(
     product_id='商品ID（英数字）',
     name='商品名',
     price='価格',
-    description='商品説明'
+    description='商品説明',
+    category='カテゴリー（パネルで絞り込みに使用、省略可）'
 )
+@app_commands.autocomplete(category=category_autocomplete)
 @app_commands.default_permissions(administrator=True)
+@timed('command', 'add_product')
 async def add_product_slash(
     interaction: discord.Interaction,
     product_id: str,
     name: str,
     price: int,
-    description: str
+    description: str,
+    category: str = None
 ):
     """販売機に商品を追加"""
     if not product_id.replace('_', '').isalnum():
@@ -179,6 +4270,16 @@ async def add_product_slash(
         )
         return
 
+    # カテゴリーはボタンのcustom_idに埋め込むため長さと文字を制限する
+    if category is not None:
+        category = category.strip() or None
+    if category is not None and (len(category) > 32 or ':' in category or category == CategorySelect.ALL):
+        await interaction.response.send_message(
+            "❌ カテゴリーは32文字以内で、「:」を含まない名前にしてください。",
+            ephemeral=True
+        )
+        return
+
     if price < 0:
         await interaction.response.send_message(
             "❌ 価格は1円以上で設定してください。",
@@ -202,38 +4303,388 @@ async def add_product_slash(
         'price': price,
         'description': description,
         'stock': 0,
-        'inventory': []
+        'reserved': 0,
+        'category': category,
+        'inventory': bot.open_inventory(guild_id, product_id)
     }
+    bot.catalog.add(guild_id, product_id)
+    bot.mark_dirty(guild_id, 'product', product_id)
 
     # 在庫追加パネルを表示
     await interaction.response.send_modal(AddInventoryModal(product_id, name, price, description, guild_id))
-    print(f'{interaction.user.name} が商品「{name}」を販売機に追加しました')
+    log_event('product_added', f'{interaction.user.name} が商品「{name}」を販売機に追加しました', guild_id=guild_id, user_id=interaction.user.id, product_id=product_id)
 
 @bot.tree.command(name='add_inventory', description='商品に在庫アイテムを追加します')
 @app_commands.describe(product_id='商品ID')
+@app_commands.autocomplete(product_id=product_id_autocomplete)
+@app_commands.default_permissions(administrator=True)
+@timed('command', 'add_inventory')
+async def add_inventory_slash(
+    interaction: discord.Interaction,
+    product_id: str
+):
+    """商品に在庫アイテムを追加"""
+    guild_id = interaction.guild.id
+    vending_machine = bot.get_guild_vending_machine(guild_id)
+
+    if product_id not in vending_machine['products']:
+        await interaction.response.send_message(
+            f"❌ 商品ID「{product_id}」が見つかりません。",
+            ephemeral=True
+        )
+        return
+
+    product = vending_machine['products'][product_id]
+
+    # 在庫追加パネルを表示
+    await interaction.response.send_modal(AddInventoryOnlyModal(product_id, product['name'], guild_id))
+    log_event('inventory_modal_opened', f'{interaction.user.name} が商品「{product["name"]}」の在庫追加パネルを開きました', guild_id=guild_id, user_id=interaction.user.id, product_id=product_id)
+
+
+
+def inventory_digest(item):
+    """重複判定用の在庫アイテムのハッシュ（8バイト）"""
+    return hashlib.blake2b(item.encode('utf-8'), digest_size=8).digest()
+
+@bot.tree.command(name='import_inventory', description='ファイルから在庫アイテムを一括追加します')
+@app_commands.describe(
+    product_id='商品ID',
+    file='在庫ファイル（テキスト: 1行に1つ / CSV: 1列目を使用）'
+)
+@app_commands.autocomplete(product_id=product_id_autocomplete)
+@app_commands.default_permissions(administrator=True)
+@timed('command', 'import_inventory')
+async def import_inventory_slash(
+    interaction: discord.Interaction,
+    product_id: str,
+    file: discord.Attachment
+):
+    """ファイルから在庫アイテムを一括追加（既存の在庫と重複するアイテムは除外）"""
+    guild_id = interaction.guild.id
+    vending_machine = bot.get_guild_vending_machine(guild_id)
+    product = vending_machine['products'].get(product_id)
+
+    if not product:
+        await interaction.response.send_message(
+            f"❌ 商品ID「{product_id}」が見つかりません。",
+            ephemeral=True
+        )
+        return
+
+    content_type = (file.content_type or '').split(';')[0]
+    is_csv = file.filename.lower().endswith('.csv') or content_type == 'text/csv'
+    if content_type and not content_type.startswith('text/') and not is_csv:
+        await interaction.response.send_message(
+            "❌ テキストファイルまたはCSVファイルを添付してください。",
+            ephemeral=True
+        )
+        return
+
+    # インポート中はサーバーデータをメモリから外さない
+    with bot.guild_cache.pin(guild_id):
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        log_event('inventory_import_started', f'{interaction.user.name} が商品「{product["name"]}」への在庫インポートを開始しました ({file.filename}, {file.size}バイト)', guild_id=guild_id, user_id=interaction.user.id, product_id=product_id, filename=file.filename, size=file.size)
+
+        # 既存の在庫のハッシュを別スレッドで集計（重複除外用）
+        inventory = product['inventory']
+        with inventory.snapshot() as items:
+            seen = await asyncio.to_thread(lambda: {inventory_digest(item) for item in items})
+
+        started_at = time.perf_counter()
+        last_progress = started_at
+        stats = {'lines': 0, 'added': 0, 'duplicates': 0}
+        batch = []
+
+        async def flush_batch():
+            if not batch:
+                return
+            items = batch[:]
+            batch.clear()
+            await inventory.extend_async(items)
+            product['stock'] = len(inventory)
+            bot.mark_dirty(guild_id, 'product', product_id)
+            stats['added'] += len(items)
+
+        def add_lines(lines):
+            if is_csv:
+                lines = (row[0] if row else '' for row in csv.reader(lines))
+            for line in lines:
+                item = line.strip()
+                if not item:
+                    continue
+                stats['lines'] += 1
+                digest = inventory_digest(item)
+                if digest in seen:
+                    stats['duplicates'] += 1
+                    continue
+                seen.add(digest)
+                batch.append(item)
+
+        def progress_embed(title):
+            elapsed = time.perf_counter() - started_at
+            embed = discord.Embed(
+                title=title,
+                description=f"商品「{product['name']}」に在庫をインポートしています。",
+                color=get_random_color()
+            )
+            embed.add_field(name="読み込み行数", value=f"{stats['lines']:,}行", inline=True)
+            embed.add_field(name="追加", value=f"{stats['added']:,}個", inline=True)
+            embed.add_field(name="重複により除外", value=f"{stats['duplicates']:,}個", inline=True)
+            embed.add_field(name="処理速度", value=f"{stats['lines'] / elapsed if elapsed > 0 else 0:,.0f}行/秒", inline=True)
+            embed.add_field(name="現在の在庫数", value=f"{len(inventory):,}個", inline=True)
+            return embed
+
+        decoder = codecs.getincrementaldecoder('utf-8-sig')(errors='replace')
+        remainder = ''
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(file.url) as response:
+                    response.raise_for_status()
+                    async for chunk in response.content.iter_chunked(65536):
+                        # 行の途中で分かれたチャンクは次のチャンクとつなげる
+                        lines = (remainder + decoder.decode(chunk)).split('\n')
+                        remainder = lines.pop()
+                        add_lines(lines)
+
+                        if len(batch) >= IMPORT_BATCH_SIZE:
+                            await flush_batch()
+
+                        now = time.perf_counter()
+                        if now - last_progress >= IMPORT_PROGRESS_INTERVAL:
+                            last_progress = now
+                            await interaction.edit_original_response(embed=progress_embed("⏳ 在庫インポート中"))
+
+                        # 大きなファイルでも他の処理を止めないよう制御を返す
+                        await asyncio.sleep(0)
+
+            add_lines([remainder + decoder.decode(b'', final=True)])
+            await flush_batch()
+        except Exception as e:
+            await flush_batch()
+            await interaction.edit_original_response(
+                content=f"❌ 在庫インポート中にエラーが発生しました:\n```{str(e)}```\n"
+                        f"それまでに読み込んだ{stats['added']:,}個の在庫は追加されました。",
+                embed=None
+            )
+            log_event('inventory_import_failed', f'在庫インポートエラー (商品: {product_id}): {e}', logging.WARNING, guild_id=guild_id, user_id=interaction.user.id, product_id=product_id, added=stats['added'], error=str(e))
+            return
+
+        await interaction.edit_original_response(embed=progress_embed("✅ 在庫インポート完了"))
+        log_event(
+            'inventory_imported',
+            f'{interaction.user.name} が商品「{product["name"]}」に{stats["added"]}個の在庫アイテムをインポートしました '
+            f'(重複除外: {stats["duplicates"]}個, {time.perf_counter() - started_at:.1f}秒)',
+            guild_id=guild_id, user_id=interaction.user.id, product_id=product_id,
+            added=stats['added'], duplicates=stats['duplicates'], seconds=time.perf_counter() - started_at
+        )
+
+@bot.tree.command(name='sales_report', description='売上レポートを表示します')
+@app_commands.describe(
+    days='集計する日数（今日を含む、省略時は30日）',
+    product_id='商品ID（省略時は全商品）'
+)
+@app_commands.autocomplete(product_id=product_id_autocomplete)
+@app_commands.default_permissions(administrator=True)
+@timed('command', 'sales_report')
+async def sales_report_slash(
+    interaction: discord.Interaction,
+    days: app_commands.Range[int, 1, SALES_REPORT_MAX_DAYS] = 30,
+    product_id: str = None
+):
+    """集計済みの売上を表示（注文は走査しない）"""
+    guild_id = interaction.guild.id
+    report = await bot.sales.report(guild_id, days, product_id)
+
+    report_embed = discord.Embed(
+        title="📊 売上レポート",
+        description=f"{report['from']} 〜 {report['to']}（{days}日間）"
+                   + (f"\n商品ID: {product_id}" if product_id else ""),
+        color=get_random_color()
+    )
+    report_embed.add_field(name="販売数", value=f"{report['total']['units']:,}個", inline=True)
+    report_embed.add_field(name="売上", value=f"¥{report['total']['revenue']:,}", inline=True)
+
+    if report['products']:
+        lines = [
+            f"**{entry['name'] or report_product_id}** - {entry['units']:,}個 / ¥{entry['revenue']:,}"
+            for report_product_id, entry in list(report['products'].items())[:10]
+        ]
+        if len(report['products']) > 10:
+            lines.append(f"... 他{len(report['products']) - 10}商品")
+        report_embed.add_field(name="商品別（売上順）", value="\n".join(lines)[:1024], inline=False)
+
+    if report['daily']:
+        # 直近の日から表示し、フィールドの文字数制限に収まる分だけ載せる
+        lines = []
+        length = 0
+        for entry in reversed(report['daily']):
+            line = f"{entry['date']}: {entry['units']:,}個 / ¥{entry['revenue']:,}"
+            if length + len(line) + 1 > 1024:
+                break
+            lines.append(line)
+            length += len(line) + 1
+        report_embed.add_field(name="日別", value="\n".join(lines), inline=False)
+    else:
+        report_embed.add_field(name="日別", value="この期間の売上はありません。", inline=False)
+
+    report_embed.set_footer(text=f"半自動販売機 | UTC{SALES_UTC_OFFSET:+d}で集計")
+    await interaction.response.send_message(embed=report_embed, ephemeral=True)
+
+def find_archived_orders(guild_id, order_id=None, user_id=None, limit=ORDER_LOOKUP_LIMIT):
+    """アーカイブ済みの注文から条件に合うものを新しい順に最大limit件（ファイルを読むためスレッドから呼ぶ）"""
+    found = deque(maxlen=limit)
+    files = bot.storage.archive_files(guild_id, order_id, user_id)
+    for order in bot.storage.archived_orders(guild_id, files):
+        if (order_id is None or order.get('order_id') == order_id) and (user_id is None or order.get('user_id') == user_id):
+            found.append(order)
+    return list(reversed(found))
+
+@bot.tree.command(name='order_lookup', description='注文を検索します（アーカイブ済みの注文を含む）')
+@app_commands.describe(
+    order_id='注文ID',
+    user='購入者（指定すると購入者の注文を新しい順に表示）'
+)
 @app_commands.default_permissions(administrator=True)
-async def add_inventory_slash(
-    interaction: discord.Interaction,
-    product_id: str
-):
-    """商品に在庫アイテムを追加"""
+@timed('command', 'order_lookup')
+async def order_lookup_slash(interaction: discord.Interaction, order_id: str = None, user: discord.User = None):
+    """メモリ上の注文を探し、足りない分はアーカイブ済みの注文から探す"""
     guild_id = interaction.guild.id
-    vending_machine = bot.get_guild_vending_machine(guild_id)
+    if order_id is None and user is None:
+        await interaction.response.send_message("❌ 注文IDまたは購入者を指定してください。", ephemeral=True)
+        return
+    order_id = order_id.strip().lstrip('#') if order_id is not None else None
+    user_id = str(user.id) if user is not None else None
 
-    if product_id not in vending_machine['products']:
-        await interaction.response.send_message(
-            f"❌ 商品ID「{product_id}」が見つかりません。",
-            ephemeral=True
+    vending_machine = bot.get_guild_vending_machine(guild_id)
+    orders = vending_machine['orders']
+    if order_id is not None:
+        order = orders.get(order_id)
+        found = [dict(order, order_id=order_id)] if order and (user_id is None or order.get('user_id') == user_id) else []
+    else:
+        found = [dict(orders[user_order_id], order_id=user_order_id) for user_order_id in itertools.islice(reversed(orders.for_user(user_id)), ORDER_LOOKUP_LIMIT)]
+
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    if len(found) < ORDER_LOOKUP_LIMIT and (order_id is None or not found):
+        found += await asyncio.to_thread(find_archived_orders, guild_id, order_id, user_id, ORDER_LOOKUP_LIMIT - len(found))
+
+    lookup_embed = discord.Embed(
+        title="🔎 注文検索",
+        description=(f"注文ID: #{order_id}\n" if order_id else "") + (f"購入者: {user.mention}" if user else ""),
+        color=get_random_color()
+    )
+    if not found:
+        lookup_embed.add_field(name="結果", value="該当する注文はありません。", inline=False)
+    for order in found:
+        product = vending_machine['products'].get(order.get('product_id'))
+        price = order.get('price', product['price'] if product else 0)
+        lookup_embed.add_field(
+            name=f"#{order['order_id']} {product['name'] if product else order.get('product_id')}"[:256],
+            value=f"ステータス: `{order.get('status')}`\n価格: ¥{price:,}\n購入者ID: {order.get('user_id')}\n注文日時: <t:{int(order.get('timestamp', 0))}:f>",
+            inline=False
         )
-        return
+    await interaction.edit_original_response(embed=lookup_embed)
+
+def awaiting_approval(guild_id):
+    """決済リンクが送信され承認を待っている注文ID（古い順）"""
+    orders = bot.get_guild_vending_machine(guild_id)['orders']
+    return [order_id for order_id in orders.with_status('pending_payment') if orders[order_id].get('reserved')]
+
+def parse_order_ids(text):
+    """「12, 15 20-30」形式の注文ID指定を展開（不正な指定はValueError）"""
+    order_ids = []
+    for part in text.replace(',', ' ').split():
+        first, _, last = part.lstrip('#').partition('-')
+        first = int(first)
+        last = int(last.lstrip('#')) if last else first
+        if first <= 0 or last < first or len(order_ids) + last - first + 1 > BULK_APPROVAL_MAX:
+            raise ValueError(part)
+        order_ids.extend(str(order_id) for order_id in range(first, last + 1))
+    if not order_ids:
+        raise ValueError(text)
+    return list(dict.fromkeys(order_ids))
+
+async def run_bulk_approval(interaction: discord.Interaction, guild_id, order_ids):
+    """注文をまとめて承認し、結果の一覧を返信"""
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    started_at = time.perf_counter()
+    results = await bot.delivery.approve_batch(guild_id, order_ids, interaction.user.id)
+    elapsed = time.perf_counter() - started_at
+
+    succeeded = [order_id for order_id in order_ids if results.get(order_id, "") is None]
+    failed = [(order_id, results.get(order_id)) for order_id in order_ids if results.get(order_id, "") is not None]
+
+    summary_embed = discord.Embed(
+        title="✅ 一括承認完了" if not failed else "⚠️ 一括承認完了（一部失敗）",
+        color=get_random_color()
+    )
+    summary_embed.add_field(name="送信成功", value=f"{len(succeeded):,}件", inline=True)
+    summary_embed.add_field(name="失敗", value=f"{len(failed):,}件", inline=True)
+    summary_embed.add_field(name="処理時間", value=f"{elapsed:.1f}秒", inline=True)
+
+    if succeeded:
+        value = ", ".join(f"#{order_id}" for order_id in succeeded)
+        if len(value) > 1024:
+            value = value[:1000].rsplit(", ", 1)[0] + " ..."
+        summary_embed.add_field(name="送信した注文", value=value, inline=False)
+    if failed:
+        lines = []
+        length = 0
+        for index, (order_id, reason) in enumerate(failed):
+            line = f"#{order_id}: {reason}"
+            if length + len(line) + 1 > 1000:
+                lines.append(f"... 他{len(failed) - index}件")
+                break
+            lines.append(line)
+            length += len(line) + 1
+        summary_embed.add_field(name="失敗した注文", value="\n".join(lines), inline=False)
+
+    await interaction.edit_original_response(embed=summary_embed)
+    log_event(
+        'orders_bulk_approved',
+        f'{interaction.user.name} が{len(order_ids)}件の注文を一括承認しました (成功: {len(succeeded)}件, 失敗: {len(failed)}件, {elapsed:.1f}秒)',
+        guild_id=guild_id, processed_by=interaction.user.id, requested=len(order_ids),
+        succeeded=len(succeeded), failed=len(failed), seconds=elapsed
+    )
 
-    product = vending_machine['products'][product_id]
+@bot.tree.command(name='approve_orders', description='決済確認待ちの注文をまとめて承認し、商品を送信します')
+@app_commands.describe(order_ids='承認する注文ID（例: 12, 15, 20-30 / all で承認待ちの全注文）。省略すると選択メニューを表示します')
+@app_commands.default_permissions(administrator=True)
+@timed('command', 'approve_orders')
+async def approve_orders_slash(interaction: discord.Interaction, order_ids: str = None):
+    """注文IDの指定または選択メニューから複数の注文を承認"""
+    guild_id = interaction.guild.id
 
-    # 在庫追加パネルを表示
-    await interaction.response.send_modal(AddInventoryOnlyModal(product_id, product['name'], guild_id))
-    print(f'{interaction.user.name} が商品「{product["name"]}」の在庫追加パネルを開きました')
+    if order_ids is not None:
+        if order_ids.strip().lower() == 'all':
+            targets = awaiting_approval(guild_id)[:BULK_APPROVAL_MAX]
+        else:
+            try:
+                targets = parse_order_ids(order_ids)
+            except ValueError:
+                await interaction.response.send_message(
+                    f"❌ 注文IDの指定が正しくありません（例: `12, 15, 20-30`、最大{BULK_APPROVAL_MAX}件）。",
+                    ephemeral=True
+                )
+                return
+        if not targets:
+            await interaction.response.send_message("承認待ちの注文はありません。", ephemeral=True)
+            return
+        await run_bulk_approval(interaction, guild_id, targets)
+        return
 
+    awaiting = awaiting_approval(guild_id)
+    if not awaiting:
+        await interaction.response.send_message("承認待ちの注文はありません。", ephemeral=True)
+        return
 
+    select_embed = discord.Embed(
+        title="📋 注文の一括承認",
+        description=f"承認待ちの注文: {len(awaiting):,}件\n"
+                   "承認する注文を選択してください（古い順に最大25件を表示）。\n"
+                   "すべて承認する場合は `/approve_orders order_ids:all` を使用してください。",
+        color=get_random_color()
+    )
+    await interaction.response.send_message(embed=select_embed, view=BulkApprovalView(guild_id, awaiting[:25]), ephemeral=True)
 
 @bot.tree.command(name='vending_panel', description='販売機パネルを設置します')
 @app_commands.describe(
@@ -241,6 +4692,7 @@ async def add_inventory_slash(
     achievement_channel='実績チャンネル（購入実績を自動送信、省略可）'
 )
 @app_commands.default_permissions(administrator=True)
+@timed('command', 'vending_panel')
 async def vending_panel_slash(
     interaction: discord.Interaction, 
     admin_channel: discord.TextChannel,
@@ -259,76 +4711,60 @@ async def vending_panel_slash(
 
     # 管理者チャンネルを設定
     vending_machine['admin_channels'].add(admin_channel.id)
-    print(f'{interaction.user.name} がチャンネル {admin_channel.name} を販売機管理者チャンネルに設定しました')
+    bot.mark_dirty(guild_id)
+    log_event('admin_channel_set', f'{interaction.user.name} がチャンネル {admin_channel.name} を販売機管理者チャンネルに設定しました', guild_id=guild_id, user_id=interaction.user.id, channel_id=admin_channel.id)
 
     # 実績チャンネルが指定された場合は設定
     if achievement_channel:
         vending_machine['achievement_channel'] = achievement_channel.id
-        print(f'{interaction.user.name} がチャンネル {achievement_channel.name} を実績チャンネルに設定しました')
-
-    panel_embed = discord.Embed(
-        title="🏪 半自動販売機",
-        description="購入したい商品を選択してください。\n"
-                   "購入後、PayPayリンクを送ってもらって、確認後にDMで商品をお送りします。",
-        color=get_random_color()
-    )
-
-    product_list = ""
-    for product_id, product in vending_machine['products'].items():
-        actual_stock = len(product.get('inventory', []))
-        stock_status = f"在庫: {actual_stock}個" if actual_stock > 0 else "❌ 在庫切れ"
-        product_list += f"**{product['name']}** - ¥{product['price']:,}\n{product['description']}\n{stock_status}\n\n"
-
-    panel_embed.add_field(
-        name="📋 商品一覧",
-        value=product_list,
-        inline=False
-    )
+        bot.mark_dirty(guild_id)
+        log_event('achievement_channel_set', f'{interaction.user.name} がチャンネル {achievement_channel.name} を実績チャンネルに設定しました', guild_id=guild_id, user_id=interaction.user.id, channel_id=achievement_channel.id)
 
-    # 実績チャンネルが設定されている場合の表示
-    if achievement_channel:
-        panel_embed.add_field(
-            name="📈 実績チャンネル", 
-            value=f"購入実績が {achievement_channel.mention} に自動送信されるよ！。",
-            inline=False
-        )
+        # 実績チャンネルの表示が変わるためキャッシュを破棄
+        bot.panels.invalidate(guild_id)
 
-    panel_embed.set_footer(text="半自動販売機")
+    panel_embed, _ = bot.panels.payload(guild_id)
 
     view = VendingMachineView(guild_id)
-    await interaction.response.send_message(embed=panel_embed, view=view)
-    print(f'{interaction.user.name} が販売機パネルを設置しました')
+    callback = await interaction.response.send_message(embed=panel_embed, view=view)
+
+    # 在庫変更時に自動更新できるようパネルを登録
+    if callback.message_id:
+        bot.panels.register(guild_id, interaction.channel.id, callback.message_id)
+    log_event('panel_posted', f'{interaction.user.name} が販売機パネルを設置しました', guild_id=guild_id, user_id=interaction.user.id, channel_id=interaction.channel.id)
 
 
 
 # 販売機関連のViewクラス
-class VendingMachineView(discord.ui.View):
-    def __init__(self, guild_id):
-        super().__init__(timeout=None)
+# custom_idにサーバー・注文を埋め込み、再起動後も保存済みデータから処理を復元する
+class GuildDataCheck:
+    """コンポーネント・モーダルの処理前にサーバーデータをスレッドで読み込む（self.guild_idを持つクラスに混ぜる）"""
+
+    async def interaction_check(self, interaction):
+        await bot.guild_cache.load(self.guild_id)
+        return True
+
+class ProductSelect(GuildDataCheck, discord.ui.DynamicItem[discord.ui.Select], template=r'vending:select:(?P<guild_id>[0-9]+)'):
+    """販売機パネルの商品選択メニュー"""
+
+    def __init__(self, guild_id, options=None):
+        super().__init__(discord.ui.Select(
+            placeholder="購入する商品を選択してください...",
+            min_values=1,
+            max_values=1,
+            options=options or [],
+            custom_id=f'vending:select:{guild_id}'
+        ))
         self.guild_id = guild_id
 
-        # 商品選択用のセレクトメニューを作成
-        vending_machine = bot.get_guild_vending_machine(guild_id)
-        options = []
-        for product_id, product in vending_machine['products'].items():
-            actual_stock = len(product.get('inventory', []))
-            if actual_stock > 0:
-                options.append(discord.SelectOption(
-                    label=f"{product['name']} - ¥{product['price']:,}",
-                    value=product_id,
-                    description=product['description'][:100]
-                ))
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Select, match):
+        return cls(int(match['guild_id']))
 
-        if options:
-            self.product_select.options = options
-        else:
-            self.remove_item(self.product_select)
+    @timed('component', 'product_select')
+    async def callback(self, interaction: discord.Interaction):
+        await self.product_select(interaction, self.item)
 
-    @discord.ui.select(
-        placeholder="購入する商品を選択してください...",
-        min_values=1,
-        max_values=1
-    )
     async def product_select(self, interaction: discord.Interaction, select: discord.ui.Select):
         product_id = select.values[0]
         vending_machine = bot.get_guild_vending_machine(self.guild_id)
@@ -341,15 +4777,21 @@ class VendingMachineView(discord.ui.View):
             )
             return
 
-        # 実際の在庫アイテム数をチェック
-        inventory = product.get('inventory', [])
-        if len(inventory) <= 0:
+        # 引当済みを除いた在庫数をチェック
+        if StockReservations.available(product) <= 0:
             await interaction.response.send_message(
                 "❌ この商品は在庫切れです。",
                 ephemeral=True
             )
             return
 
+        # 同じユーザー・サーバーからの短時間の大量注文を制限
+        throttled = bot.throttle.check('order', self.guild_id, interaction.user.id)
+        if throttled:
+            await interaction.response.send_message(throttle_message(*throttled), ephemeral=True)
+            log_event('order_throttled', f'{interaction.user.name} の注文を頻度制限により拒否しました', logging.DEBUG, guild_id=self.guild_id, user_id=interaction.user.id, scope=throttled[0])
+            return
+
         # 注文IDを生成
         order_id = vending_machine['next_order_id']
         vending_machine['next_order_id'] += 1
@@ -358,18 +4800,136 @@ class VendingMachineView(discord.ui.View):
         vending_machine['orders'][str(order_id)] = {
             'user_id': str(interaction.user.id),
             'product_id': product_id,
+            'price': product['price'],
             'status': 'pending_payment',
             'channel_id': interaction.channel.id,
             'timestamp': time.time(),
             'processed_by': None,
-            'processed_at': None
+            'processed_at': None,
+            'reserved': False
         }
+        bot.mark_dirty(self.guild_id)
+        bot.mark_dirty(self.guild_id, 'order', str(order_id))
+        metrics.order_status('pending_payment')
+        bot.record_transition(self.guild_id, order_id, vending_machine['orders'][str(order_id)], None)
+        bot.schedule_order_expiry(self.guild_id, order_id, vending_machine['orders'][str(order_id)]['timestamp'])
 
         # PayPayリンク入力モーダルを表示
         await interaction.response.send_modal(PayPayLinkModal(order_id, product, self.guild_id))
-        print(f'{interaction.user.name} が商品「{product["name"]}」を注文しました (注文ID: {order_id})')
+        log_event('order_created', f'{interaction.user.name} が商品「{product["name"]}」を注文しました (注文ID: {order_id})', guild_id=self.guild_id, order_id=str(order_id), user_id=interaction.user.id, product_id=product_id)
+
+class CategorySelect(GuildDataCheck, discord.ui.DynamicItem[discord.ui.Select], template=r'vending:category:(?P<guild_id>[0-9]+)'):
+    """販売機パネルのカテゴリー絞り込みメニュー"""
+
+    ALL = '*'  # 全商品を表す選択肢の値
+    MORE = '*more:'  # 次のカテゴリーの一覧を表す選択肢の値（後ろに先頭の位置）
+    PAGE_SIZE = 23  # 「すべての商品」「他のカテゴリー」と合わせて選択肢の上限の25個に収める
+
+    def __init__(self, guild_id, categories=(), selected=None, offset=None):
+        categories = list(categories)
+        options = [discord.SelectOption(label='すべての商品', value=self.ALL, default=selected is None)]
+        placeholder = "カテゴリーで絞り込む..."
+        if len(categories) <= self.PAGE_SIZE + 1:
+            shown = categories
+        else:
+            # 選択肢に収まらない分は「他のカテゴリー」で順に切り替えて表示する
+            if offset is None:
+                offset = categories.index(selected) // self.PAGE_SIZE * self.PAGE_SIZE if selected in categories else 0
+            shown = categories[offset:offset + self.PAGE_SIZE]
+            next_offset = offset + self.PAGE_SIZE if offset + self.PAGE_SIZE < len(categories) else 0
+            page = offset // self.PAGE_SIZE + 1
+            page_count = (len(categories) + self.PAGE_SIZE - 1) // self.PAGE_SIZE
+            placeholder = f"カテゴリーで絞り込む...（{page}/{page_count}）"
+            more_option = discord.SelectOption(
+                label=f"他のカテゴリーを表示（{next_offset // self.PAGE_SIZE + 1}/{page_count}）",
+                value=f'{self.MORE}{next_offset}'
+            )
+        options.extend(
+            discord.SelectOption(label=category, value=category, default=category == selected)
+            for category in shown
+        )
+        if len(shown) < len(categories):
+            options.append(more_option)
+        super().__init__(discord.ui.Select(
+            placeholder=placeholder,
+            min_values=1,
+            max_values=1,
+            options=options,
+            custom_id=f'vending:category:{guild_id}'
+        ))
+        self.guild_id = guild_id
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Select, match):
+        return cls(int(match['guild_id']))
+
+    @timed('component', 'category_select')
+    async def callback(self, interaction: discord.Interaction):
+        category = self.item.values[0]
+        if category.startswith(self.MORE):
+            await show_catalog_page(interaction, self.guild_id, 0, None, category_offset=int(category[len(self.MORE):]))
+            return
+        await show_catalog_page(interaction, self.guild_id, 0, None if category == self.ALL else category)
+
+class CatalogPageButton(GuildDataCheck, discord.ui.DynamicItem[discord.ui.Button], template=r'vending:page:(?P<guild_id>[0-9]+):(?P<page>[0-9]+):(?P<category>[^:]*)'):
+    """販売機パネルのページ移動ボタン"""
+
+    def __init__(self, guild_id, page, category=None, label='', disabled=False):
+        super().__init__(discord.ui.Button(
+            label=label,
+            style=discord.ButtonStyle.secondary,
+            disabled=disabled,
+            custom_id=f'vending:page:{guild_id}:{page}:{category or ""}'
+        ))
+        self.guild_id = guild_id
+        self.page = page
+        self.category = category
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Button, match):
+        return cls(int(match['guild_id']), int(match['page']), match['category'] or None)
+
+    @timed('component', 'catalog_page')
+    async def callback(self, interaction: discord.Interaction):
+        await show_catalog_page(interaction, self.guild_id, self.page, self.category)
+
+async def show_catalog_page(interaction: discord.Interaction, guild_id, page, category, category_offset=None):
+    """パネルの指定ページを操作したユーザーにだけ表示
+
+    設置済みのパネルは全員で共有するため編集せず、エフェメラルメッセージで表示する
+    （エフェメラルメッセージ上の操作はそのメッセージを書き換える）
+    """
+    page = min(max(page, 0), bot.panels.page_count(guild_id, category) - 1)
+    embed, _ = bot.panels.payload(guild_id, page, category)
+    view = VendingMachineView(guild_id, page, category, category_offset)
+    if interaction.message is not None and interaction.message.flags.ephemeral:
+        await interaction.response.edit_message(embed=embed, view=view)
+    else:
+        await interaction.response.send_message(embed=embed, view=view, ephemeral=True)
+
+class VendingMachineView(discord.ui.View):
+    def __init__(self, guild_id, page=0, category=None, category_offset=None):
+        super().__init__(timeout=None)
+        self.guild_id = guild_id
+
+        # 商品選択用のセレクトメニューを作成（キャッシュ済みの選択肢を使用）
+        _, options = bot.panels.payload(guild_id, page, category)
+
+        if options:
+            self.add_item(ProductSelect(guild_id, list(options)))
+
+        categories = bot.catalog.get(guild_id).categories
+        if categories:
+            self.add_item(CategorySelect(guild_id, categories, category, category_offset))
 
-class AddInventoryOnlyModal(discord.ui.Modal, title='在庫アイテム一括追加'):
+        page_count = bot.panels.page_count(guild_id, category)
+        if page_count > 1:
+            self.add_item(CatalogPageButton(guild_id, max(page - 1, 0), category, '◀ 前へ', disabled=page == 0))
+            self.add_item(CatalogPageButton(
+                guild_id, min(page + 1, page_count - 1), category, '次へ ▶', disabled=page >= page_count - 1
+            ))
+
+class AddInventoryOnlyModal(GuildDataCheck, discord.ui.Modal, title='在庫アイテム一括追加'):
     def __init__(self, product_id, product_name, guild_id):
         super().__init__()
         self.product_id = product_id
@@ -384,6 +4944,7 @@ class AddInventoryOnlyModal(discord.ui.Modal, title='在庫アイテム一括追
         max_length=4000
     )
 
+    @timed('modal', 'add_inventory')
     async def on_submit(self, interaction: discord.Interaction):
         vending_machine = bot.get_guild_vending_machine(self.guild_id)
         product = vending_machine['products'].get(self.product_id)
@@ -408,10 +4969,11 @@ class AddInventoryOnlyModal(discord.ui.Modal, title='在庫アイテム一括追
 
         # 在庫アイテムを追加
         if 'inventory' not in product:
-            product['inventory'] = []
+            product['inventory'] = bot.open_inventory(self.guild_id, self.product_id)
         
-        product['inventory'].extend(inventory_lines)
+        await product['inventory'].extend_async(inventory_lines)
         product['stock'] = len(product['inventory'])
+        bot.mark_dirty(self.guild_id, 'product', self.product_id)
 
         inventory_embed = discord.Embed(
             title="✅ 在庫追加完了",
@@ -434,9 +4996,9 @@ class AddInventoryOnlyModal(discord.ui.Modal, title='在庫アイテム一括追
         )
 
         await interaction.response.send_message(embed=inventory_embed)
-        print(f'{interaction.user.name} が商品「{self.product_name}」に{len(inventory_lines)}個の在庫アイテムを追加しました')
+        log_event('inventory_added', f'{interaction.user.name} が商品「{self.product_name}」に{len(inventory_lines)}個の在庫アイテムを追加しました', guild_id=self.guild_id, user_id=interaction.user.id, product_id=self.product_id, added=len(inventory_lines))
 
-class AddInventoryModal(discord.ui.Modal, title='在庫アイテム一括追加'):
+class AddInventoryModal(GuildDataCheck, discord.ui.Modal, title='在庫アイテム一括追加'):
     def __init__(self, product_id, product_name, price, description, guild_id):
         super().__init__()
         self.product_id = product_id
@@ -453,6 +5015,7 @@ class AddInventoryModal(discord.ui.Modal, title='在庫アイテム一括追加'
         max_length=4000
     )
 
+    @timed('modal', 'add_product_inventory')
     async def on_submit(self, interaction: discord.Interaction):
         vending_machine = bot.get_guild_vending_machine(self.guild_id)
         product = vending_machine['products'].get(self.product_id)
@@ -476,8 +5039,9 @@ class AddInventoryModal(discord.ui.Modal, title='在庫アイテム一括追加'
             return
 
         # 在庫アイテムを追加
-        product['inventory'].extend(inventory_lines)
+        await product['inventory'].extend_async(inventory_lines)
         product['stock'] = len(product['inventory'])
+        bot.mark_dirty(self.guild_id, 'product', self.product_id)
 
         product_embed = discord.Embed(
             title="✅ 商品追加・在庫登録完了",
@@ -502,9 +5066,9 @@ class AddInventoryModal(discord.ui.Modal, title='在庫アイテム一括追加'
         )
 
         await interaction.response.send_message(embed=product_embed)
-        print(f'{interaction.user.name} が商品「{self.product_name}」に{len(inventory_lines)}個の在庫アイテムを追加しました')
+        log_event('inventory_added', f'{interaction.user.name} が商品「{self.product_name}」に{len(inventory_lines)}個の在庫アイテムを追加しました', guild_id=self.guild_id, user_id=interaction.user.id, product_id=self.product_id, added=len(inventory_lines))
 
-class PayPayLinkModal(discord.ui.Modal, title='決済リンク入力'):
+class PayPayLinkModal(GuildDataCheck, discord.ui.Modal, title='決済リンク入力'):
     def __init__(self, order_id, product, guild_id):
         super().__init__()
         self.order_id = order_id
@@ -519,28 +5083,39 @@ class PayPayLinkModal(discord.ui.Modal, title='決済リンク入力'):
         max_length=500
     )
 
+    @timed('modal', 'paypay_link')
     async def on_submit(self, interaction: discord.Interaction):
         paypay_link = self.paypay_link.value.strip()
 
-        # 基本的なリンク形式の検証（URLの形式のみチェック）
-        if not paypay_link.startswith(('a','b','c','d','e','f','g','h','i','j','k','l','m','n','o','p','q','r','s','t','u','v','w','x','y','z',)):
+        # リンク形式の検証（0円の商品はリンク不要のため任意の文字列を受け付ける）
+        normalized_link = normalize_payment_link(paypay_link)
+        if normalized_link is None and self.product['price'] > 0:
             await interaction.response.send_message(
                 "❌ 無効なリンクです。正しいURLを入力してください。",
                 ephemeral=True
             )
             return
 
-        # 管理者チャンネルに通知を送信
+        # 注文に在庫を引き当てる（同じ在庫への重複注文を防ぐ）
         vending_machine = bot.get_guild_vending_machine(self.guild_id)
-        for admin_channel_id in vending_machine['admin_channels']:
-            try:
-                admin_channel = bot.get_channel(admin_channel_id)
-                if admin_channel:
-                    await self.send_admin_notification(admin_channel, self.order_id, interaction.user, self.product, paypay_link)
-            except Exception as e:
-                print(f"管理者チャンネル通知エラー: {e}")
+        order = vending_machine['orders'].get(str(self.order_id))
+        if not order or order['status'] != 'pending_payment':
+            await interaction.response.send_message(
+                "❌ この注文は既に無効です。もう一度商品を選択してください。",
+                ephemeral=True
+            )
+            return
+
+        if not bot.reservations.reserve(self.guild_id, str(self.order_id)):
+            bot.set_order_status(self.guild_id, str(self.order_id), 'cancelled')
+            bot.order_expiry.cancel((self.guild_id, str(self.order_id)))
+            await interaction.response.send_message(
+                "❌ 申し訳ありません。この商品は在庫切れになりました。",
+                ephemeral=True
+            )
+            return
 
-        # ユーザーに確認メッセージを送信
+        # ユーザーに確認メッセージを送信（応答期限に間に合うよう先に応答する）
         purchase_embed = discord.Embed(
             title="🛒 商品注文完了",
             description=f"**{self.product['name']}** の注文を受け付けました。\n"
@@ -554,8 +5129,24 @@ class PayPayLinkModal(discord.ui.Modal, title='決済リンク入力'):
 
         await interaction.response.send_message(embed=purchase_embed, ephemeral=True)
 
-    async def send_admin_notification(self, channel, order_id, user, product, paypay_link):
-        """管理者チャンネルに通知を送信"""
+        # 別の注文で使用済みのリンクか確認（管理者通知で警告する、初回の索引の読み込みは応答の後に行う）
+        duplicate_of = None
+        if normalized_link is not None:
+            duplicate_of = await bot.payment_links.register(self.guild_id, normalized_link, str(self.order_id))
+            if duplicate_of is not None:
+                log_event('payment_link_reused', f'注文 #{self.order_id} の決済リンクは注文 #{duplicate_of} で使用済みです', logging.WARNING, guild_id=self.guild_id, order_id=self.order_id, user_id=interaction.user.id, first_order_id=duplicate_of)
+
+        # 管理者チャンネルへの通知はチャンネルごとの送信キューで並行して送る
+        user = interaction.user
+        for admin_channel_id in vending_machine['admin_channels']:
+            if bot.get_channel(admin_channel_id):
+                bot.outbound.send(
+                    admin_channel_id,
+                    lambda channel: self.send_admin_notification(channel, self.order_id, user, self.product, paypay_link, duplicate_of)
+                )
+
+    async def send_admin_notification(self, channel, order_id, user, product, paypay_link, duplicate_of=None):
+        """管理者チャンネルに通知を送信（duplicate_ofは同じ決済リンクを先に使った注文ID）"""
         admin_embed = discord.Embed(
             title="💰 新規注文通知",
             description="新しい商品注文が入りました。",
@@ -568,18 +5159,117 @@ class PayPayLinkModal(discord.ui.Modal, title='決済リンク入力'):
         admin_embed.add_field(name="商品", value=product['name'], inline=True)
         admin_embed.add_field(name="金額", value=f"¥{product['price']:,}", inline=True)
         admin_embed.add_field(name="決済リンク", value=f"[決済リンク]({paypay_link})", inline=False)
+        if duplicate_of is not None:
+            admin_embed.add_field(
+                name="⚠️ 決済リンクの使い回し",
+                value=f"このリンクは注文 #{duplicate_of} で既に使用されています。決済内容を確認してください。",
+                inline=False
+            )
 
         admin_embed.set_thumbnail(url=user.display_avatar.url)
 
-        view = AdminApprovalView(order_id)
-        await channel.send(embed=admin_embed, view=view)
+        view = AdminApprovalView(self.guild_id, order_id)
+        message = await channel.send(embed=admin_embed, view=view)
+
+        # 期限切れ時などに更新できるよう管理者メッセージを記録
+        vending_machine = bot.get_guild_vending_machine(self.guild_id)
+        order = vending_machine['orders'].get(str(order_id))
+        if order is not None:
+            order.setdefault('admin_messages', []).append([channel.id, message.id])
+            bot.mark_dirty(self.guild_id, 'order', str(order_id))
+
+class ApproveOrderButton(GuildDataCheck, discord.ui.DynamicItem[discord.ui.Button], template=r'vending:approve:(?P<guild_id>[0-9]+):(?P<order_id>[0-9]+)'):
+    """管理者通知の商品送信ボタン"""
+
+    def __init__(self, guild_id, order_id):
+        super().__init__(discord.ui.Button(
+            label='商品送信',
+            style=discord.ButtonStyle.success,
+            custom_id=f'vending:approve:{guild_id}:{order_id}'
+        ))
+        self.guild_id = guild_id
+        self.order_id = str(order_id)
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Button, match):
+        return cls(int(match['guild_id']), match['order_id'])
+
+    @timed('component', 'approve_order')
+    async def callback(self, interaction: discord.Interaction):
+        await AdminApprovalView(self.guild_id, self.order_id).approve_order(interaction, self.item)
+
+class RejectOrderButton(GuildDataCheck, discord.ui.DynamicItem[discord.ui.Button], template=r'vending:reject:(?P<guild_id>[0-9]+):(?P<order_id>[0-9]+)'):
+    """管理者通知の注文キャンセルボタン"""
+
+    def __init__(self, guild_id, order_id):
+        super().__init__(discord.ui.Button(
+            label='注文キャンセル',
+            style=discord.ButtonStyle.danger,
+            custom_id=f'vending:reject:{guild_id}:{order_id}'
+        ))
+        self.guild_id = guild_id
+        self.order_id = str(order_id)
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Button, match):
+        return cls(int(match['guild_id']), match['order_id'])
+
+    @timed('component', 'reject_order')
+    async def callback(self, interaction: discord.Interaction):
+        await AdminApprovalView(self.guild_id, self.order_id).reject_order(interaction, self.item)
+
+class BulkApprovalSelect(GuildDataCheck, discord.ui.DynamicItem[discord.ui.Select], template=r'vending:bulk:(?P<guild_id>[0-9]+)'):
+    """一括承認する注文の選択メニュー（選択した注文の値は注文ID）"""
+
+    def __init__(self, guild_id, order_ids=()):
+        options = []
+        if order_ids:
+            vending_machine = bot.get_guild_vending_machine(guild_id)
+            for order_id in order_ids:
+                order = vending_machine['orders'][order_id]
+                product = vending_machine['products'].get(order['product_id'])
+                options.append(discord.SelectOption(
+                    label=f"#{order_id} {product['name'] if product else order['product_id']}"[:100],
+                    description=f"¥{product['price']:,} / 購入者ID: {order['user_id']}" if product else f"購入者ID: {order['user_id']}",
+                    value=order_id
+                ))
+        super().__init__(discord.ui.Select(
+            custom_id=f'vending:bulk:{guild_id}',
+            placeholder='承認する注文を選択してください',
+            min_values=1,
+            max_values=max(len(options), 1),
+            options=options
+        ))
+        self.guild_id = guild_id
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Select, match):
+        return cls(int(match['guild_id']))
+
+    @timed('component', 'bulk_approve')
+    async def callback(self, interaction: discord.Interaction):
+        if not interaction.user.guild_permissions.administrator:
+            await interaction.response.send_message(
+                "❌ この操作は管理者のみ実行できます。",
+                ephemeral=True
+            )
+            return
+        await run_bulk_approval(interaction, self.guild_id, list(self.item.values))
+
+class BulkApprovalView(discord.ui.View):
+    def __init__(self, guild_id, order_ids):
+        super().__init__(timeout=None)
+        self.add_item(BulkApprovalSelect(guild_id, order_ids))
 
 class AdminApprovalView(discord.ui.View):
-    def __init__(self, order_id):
-        super().__init__(timeout=3600)
+    def __init__(self, guild_id, order_id):
+        super().__init__(timeout=None)
+        self.guild_id = guild_id
         self.order_id = str(order_id)
 
-    @discord.ui.button(label='商品送信', style=discord.ButtonStyle.success)
+        self.add_item(ApproveOrderButton(guild_id, order_id))
+        self.add_item(RejectOrderButton(guild_id, order_id))
+
     async def approve_order(self, interaction: discord.Interaction, button: discord.ui.Button):
         """注文を承認して商品を送信"""
         if not interaction.user.guild_permissions.administrator:
@@ -610,7 +5300,6 @@ class AdminApprovalView(discord.ui.View):
         # 商品送信処理を直接実行
         await self.process_delivery(interaction, self.order_id)
 
-    @discord.ui.button(label='注文キャンセル', style=discord.ButtonStyle.danger)
     async def reject_order(self, interaction: discord.Interaction, button: discord.ui.Button):
         """注文をキャンセル"""
         if not interaction.user.guild_permissions.administrator:
@@ -631,12 +5320,21 @@ class AdminApprovalView(discord.ui.View):
             )
             return
 
-        # 注文をキャンセル状態に
-        order['status'] = 'cancelled'
+        if order['status'] != 'pending_payment':
+            await interaction.response.send_message(
+                "❌ この注文は既に処理済みです。",
+                ephemeral=True
+            )
+            return
+
+        # 注文をキャンセル状態にして引当を解除
+        bot.set_order_status(guild_id, self.order_id, 'cancelled')
+        bot.reservations.release(guild_id, self.order_id)
+        bot.order_expiry.cancel((guild_id, self.order_id))
 
         # 購入者にDM送信
         try:
-            user = await bot.fetch_user(int(order['user_id']))
+            user = await bot.user_resolver.resolve(order['user_id'])
             if user:
                 cancel_embed = discord.Embed(
                     title="❌ 注文キャンセル",
@@ -646,7 +5344,7 @@ class AdminApprovalView(discord.ui.View):
                 )
                 await user.send(embed=cancel_embed)
         except Exception as e:
-            print(f"キャンセル通知DM送信エラー: {e}")
+            log_event('cancel_notice_failed', f'キャンセル通知DM送信エラー: {e}', logging.WARNING, guild_id=guild_id, order_id=self.order_id, user_id=order['user_id'], error=str(e))
 
         # 管理者メッセージを更新
         cancel_embed = discord.Embed(
@@ -656,207 +5354,61 @@ class AdminApprovalView(discord.ui.View):
         )
 
         await interaction.response.edit_message(embed=cancel_embed, view=None)
-        print(f'{interaction.user.name} が注文 #{self.order_id} をキャンセルしました')
+        log_event('order_cancelled', f'{interaction.user.name} が注文 #{self.order_id} をキャンセルしました', guild_id=guild_id, order_id=self.order_id, user_id=order['user_id'], processed_by=interaction.user.id)
 
     async def process_delivery(self, interaction: discord.Interaction, order_id: str):
         """商品配送処理"""
         guild_id = interaction.guild.id
-        vending_machine = bot.get_guild_vending_machine(guild_id)
-        order = vending_machine['orders'].get(order_id)
-
-        if not order:
-            await interaction.response.send_message(
-                "❌ 注文が見つかりません。",
-                ephemeral=True
-            )
-            return
-
-        product_id = order['product_id']
-        product = vending_machine['products'].get(product_id)
-
-        if not product:
-            await interaction.response.send_message(
-                "❌ 商品が見つかりません。",
-                ephemeral=True
-            )
-            return
 
-        # 在庫から1つ取り出す
-        inventory = product.get('inventory', [])
-        if not inventory:
-            await interaction.response.send_message(
-                "❌ この商品の在庫がありません。",
-                ephemeral=True
-            )
+        # 在庫を確定して配送中の状態にする（awaitを挟まないため二重承認は起きない）
+        admin_message = [interaction.channel.id, interaction.message.id]
+        error = bot.delivery.prepare(guild_id, order_id, interaction.user.id, admin_message)
+        if error:
+            await interaction.response.send_message(f"❌ {error}", ephemeral=True)
             return
+        order = bot.get_guild_vending_machine(guild_id)['orders'][order_id]
 
-        # 最初の在庫アイテムを取り出し、在庫から削除
-        item_content = inventory.pop(0)
-        product['stock'] = len(inventory)
-
-        # 注文を完了状態に
-        order['status'] = 'completed'
-        order['processed_by'] = str(interaction.user.id)
-        order['processed_at'] = time.time()
-
-        # 購入者にDMで商品を送信
+        # 応答期限に間に合うよう先に応答し、DM送信はワーカーに任せる
         try:
-            user = await bot.fetch_user(int(order['user_id']))
-            
-            # 事前チェック: ユーザーが存在するか
-            if not user:
-                await interaction.response.send_message(
-                    "❌ 購入者のユーザー情報を取得できませんでした。",
-                    ephemeral=True
-                )
-                return
-
-            delivery_embed = discord.Embed(
-                title="📦 商品お届け",
-                description="ご注文いただいた商品をお届けします。",
-                color=get_random_color(),
-                timestamp=discord.utils.utcnow()
-            )
-
-            delivery_embed.add_field(name="注文ID", value=f"#{order_id}", inline=True)
-            delivery_embed.add_field(name="商品名", value=product['name'], inline=True)
-            delivery_embed.add_field(name="商品内容", value=item_content, inline=False)
-            delivery_embed.set_footer(text="半自動販売機システム")
-
-            await user.send(embed=delivery_embed)
-
-            # 管理者メッセージを更新
-            success_embed = discord.Embed(
-                title="✅ 商品送信完了",
-                description=f"注文 #{order_id} の商品を送信しました。\n"
-                           f"実行者: {interaction.user.mention}\n"
-                           f"残り在庫: {product['stock']}個",
-                color=get_random_color(),
-                timestamp=discord.utils.utcnow()
-            )
-
-            await interaction.response.edit_message(embed=success_embed, view=None)
-            print(f'{interaction.user.name} が注文 #{order_id} の商品を送信しました (残り在庫: {product["stock"]}個)')
-
-            # 実績チャンネルに通知を送信
-            await self.send_achievement_notification(guild_id, order_id, user, product, interaction.user)
-
-        except discord.Forbidden as e:
-            # 送信失敗時は在庫を戻す
-            inventory.insert(0, item_content)
-            product['stock'] = len(inventory)
-            order['status'] = 'pending_payment'
-
-            error_embed = discord.Embed(
-                title="❌ DM送信エラー",
-                description="購入者にDMを送信できませんでした。",
-                color=0xFF0000
-            )
-            error_embed.add_field(
-                name="エラー原因",
-                value="• ユーザーがDM受信を無効にしている\n• ボットがブロックされている\n• サーバーでDMが無効",
-                inline=False
-            )
-            error_embed.add_field(
-                name="対処方法",
-                value="1. ユーザーにDM設定の確認を依頼\n2. サーバー内でのメンション通知も検討\n3. 在庫は元に戻されました",
-                inline=False
-            )
-            
-            await interaction.response.send_message(embed=error_embed, ephemeral=True)
-            print(f"DM送信エラー (注文 #{order_id}): {e}")
-            
+            await interaction.response.defer()
         except discord.HTTPException as e:
-            # 送信失敗時は在庫を戻す
-            inventory.insert(0, item_content)
-            product['stock'] = len(inventory)
-            order['status'] = 'pending_payment'
-
-            await interaction.response.send_message(
-                f"❌ Discord APIエラーが発生しました:\n```{str(e)}```\n在庫は元に戻されました。",
-                ephemeral=True
-            )
-            print(f"Discord APIエラー (注文 #{order_id}): {e}")
-            
-        except Exception as e:
-            # 送信失敗時は在庫を戻す
-            inventory.insert(0, item_content)
-            product['stock'] = len(inventory)
-            order['status'] = 'pending_payment'
+            log_event('approve_response_failed', f'商品送信の応答エラー (注文 #{order_id}): {e}', logging.WARNING, guild_id=guild_id, order_id=order_id, error=str(e))
 
-            await interaction.response.send_message(
-                f"❌ 予期しないエラーが発生しました:\n```{str(e)}```\n在庫は元に戻されました。",
+        if not bot.delivery.submit(guild_id, order_id, str(interaction.user.id), interaction):
+            bot.delivery.abort(guild_id, order_id)
+            await interaction.followup.send(
+                "❌ 配送処理が混み合っています。しばらくしてから再度お試しください。",
                 ephemeral=True
             )
-            print(f"商品送信エラー (注文 #{order_id}): {e}")
-
-    async def send_achievement_notification(self, guild_id, order_id, buyer, product, processor):
-        """実績チャンネルに購入実績を送信"""
-        try:
-            vending_machine = bot.get_guild_vending_machine(guild_id)
-            achievement_channel_id = vending_machine.get('achievement_channel')
-
-            if not achievement_channel_id:
-                return
-
-            achievement_channel = bot.get_channel(achievement_channel_id)
-            if not achievement_channel:
-                return
-
-            achievement_embed = discord.Embed(
-                title="🎉 購入実績",
-                description="商品が購入されました！",
-                color=get_random_color(),
-                timestamp=discord.utils.utcnow()
-            )
-
-            achievement_embed.add_field(
-                name="購入者",
-                value=f"{buyer.mention}\n({buyer.display_name})",
-                inline=True
-            )
-
-            achievement_embed.add_field(
-                name="商品",
-                value=f"**{product['name']}**\n¥{product['price']:,}",
-                inline=True
-            )
-
-            achievement_embed.add_field(
-                name="注文ID",
-                value=f"#{order_id}",
-                inline=True
-            )
+            return
 
-            achievement_embed.add_field(
-                name="処理者",
-                value=f"{processor.mention}",
-                inline=True
-            )
+        log_event('order_approved', f'{interaction.user.name} が注文 #{order_id} の商品送信を開始しました', guild_id=guild_id, order_id=order_id, user_id=order['user_id'], processed_by=interaction.user.id)
 
-            achievement_embed.add_field(
-                name="残り在庫",
-                value=f"{product['stock']}個",
-                inline=True
-            )
+def main():
+    bot.log_handler = setup_logging()
 
-            achievement_embed.set_thumbnail(url=buyer.display_avatar.url)
-            achievement_embed.set_footer(text="半自動販売機システム")
+    if not BOT_TOKEN:
+        log_event('startup_failed', '❌ DISCORD_BOT_TOKEN環境変数が設定されていません', logging.ERROR)
+        return
 
-            await achievement_channel.send(embed=achievement_embed)
+    if DISCORD_API_BASE:
+        discord.http.Route.BASE = DISCORD_API_BASE.rstrip('/')
+    if DISCORD_GATEWAY_URL:
+        discord.gateway.DiscordWebSocket.DEFAULT_GATEWAY = yarl.URL(DISCORD_GATEWAY_URL)
 
+    # クラスター構成では親プロセスは子プロセスの監視とWebエンドポイントの集約のみ行う
+    if CLUSTER_COUNT > 1 and CLUSTER_ID is None:
+        try:
+            asyncio.run(ClusterSupervisor(BOT_TOKEN).run())
         except Exception as e:
-            print(f"実績通知送信エラー: {e}")
-
-def main():
-    if not BOT_TOKEN:
-        print("❌ DISCORD_BOT_TOKEN環境変数が設定されていません")
+            log_event('startup_failed', f'❌ クラスターの起動に失敗しました: {e}', logging.ERROR, exc_info=True)
         return
 
     try:
-        bot.run(BOT_TOKEN)
+        # discord.pyのログも同じキュー経由で出力する
+        bot.run(BOT_TOKEN, log_handler=None)
     except Exception as e:
-        print(f"❌ ボットの起動に失敗しました: {e}")
+        log_event('startup_failed', f'❌ ボットの起動に失敗しました: {e}', logging.ERROR, exc_info=True)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,1059 @@
+"""Discord REST API・Gatewayのローカルモック（エンドツーエンドの負荷試験用）
+
+ボットが使うREST APIの一部とGatewayを1プロセスで再現する。ルートごとの
+レート制限ヘッダー（X-RateLimit-*）を返し、遅延・429・5xxを注入できる。
+負荷試験ではパネル設置 → 商品選択 → 決済リンク入力 → 管理者承認 → DM送信 →
+実績送信までをINTERACTION_CREATEで実際のボットに流し、REST呼び出しの傾向を集計する
+
+使い方:
+    # モックを起動し、ボットを子プロセスとして接続させて負荷試験を実行
+    python mock_discord.py --spawn-bot --buyers 5000 --concurrency 300 --output result.json
+
+    # モックだけを起動し、別のターミナルでボットを接続させる
+    python mock_discord.py --port 8787 --latency 40 --jitter 20 --rate-429 0.01
+    DISCORD_BOT_TOKEN=mock DISCORD_API_BASE=http://127.0.0.1:8787/api/v10 \\
+        DISCORD_GATEWAY_URL=ws://127.0.0.1:8787/gateway PORT=10001 python main.py
+    curl -X POST 'http://127.0.0.1:8787/_mock/load?buyers=2000&concurrency=200'
+    curl http://127.0.0.1:8787/_mock/stats
+"""
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import itertools
+import json
+import os
+import random
+import re
+import secrets
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+
+from aiohttp import web, WSMsgType
+
+API_PREFIX = '/api/v10'
+DISCORD_EPOCH = 1420070400000
+HEARTBEAT_INTERVAL_MS = 41250
+HEARTBEAT_ACK_DELAY = 0.05
+ADMINISTRATOR = str(1 << 3)
+ALL_PERMISSIONS = str((1 << 53) - 1)
+
+# ルートごとのレート制限（回数, 秒）。実際のDiscordのおおよその値
+ROUTE_LIMITS = {
+    ('POST', '/channels/{channel_id}/messages'): (5, 5.0),
+    ('PATCH', '/channels/{channel_id}/messages/{message_id}'): (5, 5.0),
+    ('DELETE', '/channels/{channel_id}/messages/{message_id}'): (5, 1.0),
+    ('POST', '/users/@me/channels'): (10, 10.0),
+    ('GET', '/users/{user_id}'): (30, 1.0),
+    ('PUT', '/applications/{application_id}/commands'): (2, 60.0),
+    ('PUT', '/applications/{application_id}/guilds/{guild_id}/commands'): (2, 60.0),
+    ('POST', '/webhooks/{webhook_id}/{webhook_token}'): (5, 2.0),
+    ('PATCH', '/webhooks/{webhook_id}/{webhook_token}/messages/{message_id}'): (5, 2.0),
+}
+DEFAULT_LIMIT = (50, 1.0)
+GLOBAL_LIMIT = 50  # 1秒あたり（インタラクションへの応答は対象外）
+UNLIMITED_ROUTES = {('POST', '/interactions/{interaction_id}/{interaction_token}/callback')}
+MENTION_PATTERN = re.compile(r'<@!?([0-9]+)>')
+# バケットを分ける大きなパラメーター
+MAJOR_PARAMETERS = ('channel_id', 'guild_id', 'webhook_id')
+
+def now_iso():
+    return datetime.now(timezone.utc).isoformat()
+
+def json_response(data, status=200, headers=None):
+    # discord.pyはContent-Typeがapplication/jsonと完全一致する場合のみJSONとして読む
+    return web.Response(
+        body=json.dumps(data, ensure_ascii=False).encode(),
+        status=status,
+        headers=dict(headers or {}, **{'Content-Type': 'application/json'})
+    )
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def summarize(samples):
+    return {
+        'count': len(samples),
+        'p50_ms': round(percentile(samples, 0.50) * 1000, 3),
+        'p99_ms': round(percentile(samples, 0.99) * 1000, 3),
+        'max_ms': round(max(samples, default=0.0) * 1000, 3)
+    }
+
+class RateLimiter:
+    """ルート・大きなパラメーターごとの固定ウィンドウ方式のレート制限"""
+
+    def __init__(self):
+        self.buckets = {}  # {(route, major): [リセット時刻, 残り回数]}
+        self.global_window = [0.0, GLOBAL_LIMIT]
+
+    def check(self, route, major):
+        """(許可するか, レスポンスヘッダー, retry_after, グローバル制限か) を返す"""
+        limit, window = ROUTE_LIMITS.get(route, DEFAULT_LIMIT)
+        now = time.time()
+
+        bucket = self.buckets.get((route, major))
+        if bucket is None or bucket[0] <= now:
+            bucket = self.buckets[(route, major)] = [now + window, limit]
+
+        headers = {
+            'X-RateLimit-Limit': str(limit),
+            'X-RateLimit-Reset': f'{bucket[0]:.3f}',
+            'X-RateLimit-Reset-After': f'{bucket[0] - now:.3f}',
+            'X-RateLimit-Bucket': hashlib.sha1(' '.join(route).encode()).hexdigest()[:16]
+        }
+
+        if self.global_window[0] <= now:
+            self.global_window = [now + 1.0, GLOBAL_LIMIT]
+        if self.global_window[1] <= 0:
+            headers['X-RateLimit-Remaining'] = str(bucket[1])
+            headers['X-RateLimit-Global'] = 'true'
+            return False, headers, self.global_window[0] - now, True
+
+        if bucket[1] <= 0:
+            headers['X-RateLimit-Remaining'] = '0'
+            return False, headers, bucket[0] - now, False
+
+        bucket[1] -= 1
+        self.global_window[1] -= 1
+        headers['X-RateLimit-Remaining'] = str(bucket[1])
+        return True, headers, 0.0, False
+
+class PendingInteraction:
+    """ボットの応答を待っているインタラクション"""
+
+    def __init__(self, interaction_id, token, interaction_type, guild_id, channel_id, user):
+        self.id = interaction_id
+        self.token = token
+        self.type = interaction_type
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.user = user
+        self.response = asyncio.get_running_loop().create_future()
+        self.original_message = None
+        self.followups = []
+
+class GatewaySession:
+    """Gatewayの1接続（シャード）"""
+
+    def __init__(self, ws, session_id):
+        self.ws = ws
+        self.session_id = session_id
+        self.sequence = 0
+        self.shard = (0, 1)
+        self.identified = False
+        self.presence_set = False
+
+    def owns(self, guild_id):
+        shard_id, shard_count = self.shard
+        return (guild_id >> 22) % shard_count == shard_id
+
+    async def send(self, op, data, event=None):
+        payload = {'op': op, 'd': data, 's': None, 't': event}
+        if op == 0:
+            self.sequence += 1
+            payload['s'] = self.sequence
+        await self.ws.send_str(json.dumps(payload, ensure_ascii=False))
+
+class MockDiscord:
+    def __init__(self, args):
+        self.args = args
+        self.counter = itertools.count()
+        self.limiter = RateLimiter()
+        self.base_url = f'http://{args.host}:{args.port}'
+
+        self.application_id = self.next_id()
+        self.bot_user = self.make_user('VendingBot', bot=True)
+        self.admin = self.make_user('admin')
+        self.users = {int(self.bot_user['id']): self.bot_user, int(self.admin['id']): self.admin}
+
+        self.guilds = {}
+        for index in range(args.guilds):
+            guild_id = self.next_id()
+            self.guilds[guild_id] = {
+                'id': str(guild_id),
+                'name': f'mock-guild-{index}',
+                'channels': {
+                    name: self.make_channel(guild_id, name, position)
+                    for position, name in enumerate(('vending', 'admin', 'achievements'))
+                }
+            }
+        self.channel_guild = {
+            int(channel['id']): guild_id
+            for guild_id, guild in self.guilds.items()
+            for channel in guild['channels'].values()
+        }
+
+        self.messages = {}  # {message_id: payload}
+        self.dm_channels = {}  # {channel_id: user_id}
+        self.dm_by_user = {}  # {user_id: channel_id}
+        self.commands = []
+        self.interactions = {}  # {interaction_id: PendingInteraction}
+        self.interactions_by_token = {}
+        self.sessions = []
+
+        # 負荷試験で観測するイベント
+        self.ready = asyncio.Event()
+        self.approval_queue = asyncio.Queue()
+        self.dm_waiters = {}  # {user_id: Future}
+        self.achievements = 0
+
+        self.route_stats = defaultdict(Counter)
+        self.gateway_events = Counter()
+
+    # ---- ペイロードの生成 ----
+
+    def next_id(self):
+        return ((int(time.time() * 1000) - DISCORD_EPOCH) << 22) | (next(self.counter) & 0x3FFFFF)
+
+    def make_user(self, name, bot=False):
+        user_id = self.next_id()
+        return {
+            'id': str(user_id),
+            'username': name,
+            'discriminator': '0',
+            'global_name': name,
+            'avatar': None,
+            'bot': bot,
+            'public_flags': 0
+        }
+
+    def make_channel(self, guild_id, name, position):
+        return {
+            'id': str(self.next_id()),
+            'type': 0,
+            'guild_id': str(guild_id),
+            'name': name,
+            'position': position,
+            'permission_overwrites': [],
+            'nsfw': False,
+            'parent_id': None,
+            'topic': None,
+            'last_message_id': None,
+            'rate_limit_per_user': 0
+        }
+
+    def make_member(self, user, permissions=None):
+        member = {
+            'user': user,
+            'roles': [],
+            'joined_at': now_iso(),
+            'deaf': False,
+            'mute': False,
+            'flags': 0
+        }
+        if permissions is not None:
+            member['permissions'] = permissions
+        return member
+
+    def guild_create_payload(self, guild_id):
+        guild = self.guilds[guild_id]
+        return {
+            'id': guild['id'],
+            'name': guild['name'],
+            'icon': None,
+            'owner_id': self.admin['id'],
+            'roles': [{
+                'id': guild['id'], 'name': '@everyone', 'permissions': '0', 'position': 0,
+                'color': 0, 'hoist': False, 'managed': False, 'mentionable': False, 'flags': 0
+            }],
+            'emojis': [],
+            'stickers': [],
+            'features': [],
+            'channels': list(guild['channels'].values()),
+            'threads': [],
+            'members': [self.make_member(self.bot_user), self.make_member(self.admin)],
+            'member_count': 2,
+            'large': False,
+            'unavailable': False,
+            'joined_at': now_iso(),
+            'voice_states': [],
+            'presences': [],
+            'stage_instances': [],
+            'guild_scheduled_events': [],
+            'soundboard_sounds': [],
+            'premium_tier': 0,
+            'preferred_locale': 'ja',
+            'verification_level': 0,
+            'default_message_notifications': 0,
+            'explicit_content_filter': 0,
+            'mfa_level': 0,
+            'nsfw_level': 0,
+            'system_channel_flags': 0,
+            'afk_timeout': 300
+        }
+
+    def message_payload(self, channel_id, body, author=None, message_type=0, interaction=None):
+        message_id = self.next_id()
+        message = {
+            'id': str(message_id),
+            'channel_id': str(channel_id),
+            'author': author or self.bot_user,
+            'content': body.get('content') or '',
+            'timestamp': now_iso(),
+            'edited_timestamp': None,
+            'tts': False,
+            'mention_everyone': False,
+            'mentions': [],
+            'mention_roles': [],
+            'attachments': [],
+            'embeds': body.get('embeds') or [],
+            'components': body.get('components') or [],
+            'pinned': False,
+            'type': message_type,
+            'flags': body.get('flags') or 0
+        }
+        guild_id = self.channel_guild.get(int(channel_id))
+        if guild_id:
+            message['guild_id'] = str(guild_id)
+        if interaction is not None:
+            message['webhook_id'] = str(self.application_id)
+            message['application_id'] = str(self.application_id)
+        self.messages[message_id] = message
+        return message
+
+    def edit_message(self, message, body):
+        for key in ('content', 'embeds', 'components', 'flags'):
+            if key in body:
+                message[key] = body[key] if body[key] is not None else ([] if key != 'content' else '')
+        message['edited_timestamp'] = now_iso()
+        return message
+
+    # ---- RESTの共通処理 ----
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        if not request.path.startswith(API_PREFIX):
+            return await handler(request)
+
+        resource = request.match_info.route.resource
+        template = resource.canonical[len(API_PREFIX):] if resource is not None else request.path
+        route = (request.method, template)
+        stats = self.route_stats[' '.join(route)]
+        stats['requests'] += 1
+
+        if not request.headers.get('Authorization') and not template.startswith(('/webhooks', '/interactions')):
+            stats['401'] += 1
+            return json_response({'message': '401: Unauthorized', 'code': 0}, status=401)
+
+        # 遅延の注入
+        latency = self.args.latency + random.uniform(0, self.args.jitter)
+        if latency > 0:
+            await asyncio.sleep(latency / 1000)
+
+        if route in UNLIMITED_ROUTES:
+            headers = {}
+        else:
+            major = next((request.match_info[key] for key in MAJOR_PARAMETERS if key in request.match_info), None)
+            allowed, headers, retry_after, is_global = self.limiter.check(route, major)
+            if not allowed:
+                stats['429'] += 1
+                return self.rate_limited(headers, retry_after, is_global, 'global' if is_global else 'user')
+
+            # 429・5xxの注入（共有リソースの制限やDiscord側の障害を想定）
+            roll = random.random()
+            if roll < self.args.rate_429:
+                stats['429_injected'] += 1
+                return self.rate_limited(headers, random.uniform(0.05, 1.0), False, 'shared')
+            if roll < self.args.rate_429 + self.args.rate_5xx:
+                stats['5xx_injected'] += 1
+                return json_response({'message': '502: Bad Gateway', 'code': 0}, status=502)
+
+        response = await handler(request)
+        response.headers.update(headers)
+        stats[str(response.status)] += 1
+        return response
+
+    def rate_limited(self, headers, retry_after, is_global, scope):
+        headers = dict(headers, **{
+            'Retry-After': str(max(1, round(retry_after))),
+            'X-RateLimit-Scope': scope
+        })
+        return json_response(
+            {'message': 'You are being rate limited.', 'retry_after': round(retry_after, 3), 'global': is_global},
+            status=429,
+            headers=headers
+        )
+
+    async def read_body(self, request):
+        if not request.can_read_body:
+            return {}
+        if request.content_type.startswith('multipart/'):
+            form = await request.post()
+            return json.loads(form.get('payload_json') or '{}')
+        return await request.json()
+
+    def not_found(self, message='Unknown Message', code=10008):
+        return json_response({'message': message, 'code': code}, status=404)
+
+    # ---- REST: ユーザー・アプリケーション ----
+
+    async def get_current_user(self, request):
+        return json_response(self.bot_user)
+
+    async def get_application(self, request):
+        return json_response({
+            'id': str(self.application_id),
+            'name': self.bot_user['username'],
+            'icon': None,
+            'description': '',
+            'rpc_origins': [],
+            'bot_public': False,
+            'bot_require_code_grant': False,
+            'owner': self.admin,
+            'team': None,
+            'verify_key': secrets.token_hex(32),
+            'flags': 0,
+            'bot': self.bot_user
+        })
+
+    async def get_gateway(self, request):
+        return json_response({
+            'url': f'ws://{self.args.host}:{self.args.port}/gateway',
+            'shards': self.args.recommended_shards,
+            'session_start_limit': {'total': 1000, 'remaining': 1000, 'reset_after': 86400000, 'max_concurrency': 1}
+        })
+
+    async def get_user(self, request):
+        user = self.users.get(int(request.match_info['user_id']))
+        if user is None:
+            return self.not_found('Unknown User', 10013)
+        return json_response(user)
+
+    async def put_commands(self, request):
+        body = await self.read_body(request)
+        self.commands = [
+            dict(command,
+                 id=str(self.next_id()),
+                 application_id=str(self.application_id),
+                 version=str(self.next_id()),
+                 default_member_permissions=command.get('default_member_permissions'),
+                 dm_permission=command.get('dm_permission', True),
+                 nsfw=command.get('nsfw', False))
+            for command in body
+        ]
+        return json_response(self.commands)
+
+    async def get_commands(self, request):
+        return json_response(self.commands)
+
+    # ---- REST: メッセージ ----
+
+    async def create_message(self, request):
+        channel_id = int(request.match_info['channel_id'])
+        if channel_id not in self.channel_guild and channel_id not in self.dm_channels:
+            return self.not_found('Unknown Channel', 10003)
+
+        message = self.message_payload(channel_id, await self.read_body(request))
+        self.observe_message(channel_id, message)
+        return json_response(message)
+
+    def observe_message(self, channel_id, message):
+        """負荷試験で待っているメッセージ（承認ボタン・DM・実績）を記録"""
+        if channel_id in self.dm_channels:
+            waiter = self.dm_waiters.get(self.dm_channels[channel_id])
+            if waiter and not waiter.done():
+                waiter.set_result(time.perf_counter())
+            return
+
+        guild = self.guilds[self.channel_guild[channel_id]]
+        if channel_id == int(guild['channels']['achievements']['id']):
+            self.achievements += 1
+
+        for row in message['components']:
+            for component in row.get('components', []):
+                if component.get('custom_id', '').startswith('vending:approve:'):
+                    self.approval_queue.put_nowait((message, component['custom_id']))
+
+    async def get_message(self, request):
+        message = self.messages.get(int(request.match_info['message_id']))
+        if message is None:
+            return self.not_found()
+        return json_response(message)
+
+    async def edit_channel_message(self, request):
+        message = self.messages.get(int(request.match_info['message_id']))
+        if message is None or message['channel_id'] != request.match_info['channel_id']:
+            return self.not_found()
+        return json_response(self.edit_message(message, await self.read_body(request)))
+
+    async def delete_channel_message(self, request):
+        if self.messages.pop(int(request.match_info['message_id']), None) is None:
+            return self.not_found()
+        return web.Response(status=204)
+
+    async def create_dm(self, request):
+        body = await self.read_body(request)
+        user_id = int(body['recipient_id'])
+        channel_id = self.dm_by_user.get(user_id)
+        if channel_id is None:
+            channel_id = self.next_id()
+            self.dm_by_user[user_id] = channel_id
+            self.dm_channels[channel_id] = user_id
+        return json_response({
+            'id': str(channel_id),
+            'type': 1,
+            'last_message_id': None,
+            'recipients': [self.users.get(user_id) or self.make_user(f'user{user_id}')]
+        })
+
+    # ---- REST: インタラクション ----
+
+    async def interaction_callback(self, request):
+        pending = self.interactions.get(int(request.match_info['interaction_id']))
+        if pending is None or pending.token != request.match_info['interaction_token']:
+            return self.not_found('Unknown interaction', 10062)
+        if pending.response.done():
+            return json_response(
+                {'message': 'Interaction has already been acknowledged.', 'code': 40060}, status=400
+            )
+
+        body = await self.read_body(request)
+        response_type = body['type']
+        data = body.get('data') or {}
+        flags = data.get('flags') or 0
+        interaction = {
+            'id': str(pending.id),
+            'type': pending.type,
+            'response_message_loading': response_type == 5,
+            'response_message_ephemeral': bool(flags & 64)
+        }
+        result = {'interaction': interaction}
+
+        if response_type in (4, 5):
+            message = self.message_payload(pending.channel_id, data, message_type=20, interaction=pending)
+            pending.original_message = message
+            interaction['response_message_id'] = message['id']
+            result['resource'] = {'type': response_type, 'message': message}
+        elif response_type == 7 and pending.original_message is not None:
+            self.edit_message(pending.original_message, data)
+            result['resource'] = {'type': response_type, 'message': pending.original_message}
+
+        pending.response.set_result((response_type, data, pending.original_message))
+        if request.query.get('with_response') in ('1', 'true'):
+            return json_response(result)
+        return web.Response(status=204)
+
+    def pending_by_token(self, request):
+        if request.match_info['webhook_id'] != str(self.application_id):
+            return None
+        return self.interactions_by_token.get(request.match_info['webhook_token'])
+
+    async def create_followup(self, request):
+        pending = self.pending_by_token(request)
+        if pending is None:
+            return self.not_found('Unknown Webhook', 10015)
+        message = self.message_payload(pending.channel_id, await self.read_body(request), interaction=pending)
+        pending.followups.append(message)
+        if request.query.get('wait') in ('1', 'true'):
+            return json_response(message)
+        return web.Response(status=204)
+
+    def webhook_message(self, request):
+        pending = self.pending_by_token(request)
+        if pending is None:
+            return None
+        if request.match_info['message_id'] == '@original':
+            return pending.original_message
+        message = self.messages.get(int(request.match_info['message_id']))
+        if message is pending.original_message or message in pending.followups:
+            return message
+        return None
+
+    async def get_webhook_message(self, request):
+        message = self.webhook_message(request)
+        if message is None:
+            return self.not_found()
+        return json_response(message)
+
+    async def edit_webhook_message(self, request):
+        message = self.webhook_message(request)
+        if message is None:
+            return self.not_found()
+        return json_response(self.edit_message(message, await self.read_body(request)))
+
+    async def delete_webhook_message(self, request):
+        message = self.webhook_message(request)
+        if message is None:
+            return self.not_found()
+        self.messages.pop(int(message['id']), None)
+        return web.Response(status=204)
+
+    async def unhandled(self, request):
+        self.route_stats[f'{request.method} {request.path} (unhandled)']['requests'] += 1
+        return json_response({'message': '404: Not Found', 'code': 0}, status=404)
+
+    # ---- Gateway ----
+
+    async def gateway(self, request):
+        ws = web.WebSocketResponse(max_msg_size=0, autoping=True)
+        await ws.prepare(request)
+        session = GatewaySession(ws, secrets.token_hex(16))
+        await session.send(10, {'heartbeat_interval': HEARTBEAT_INTERVAL_MS})
+
+        try:
+            async for frame in ws:
+                if frame.type != WSMsgType.TEXT:
+                    continue
+                payload = json.loads(frame.data)
+                op = payload.get('op')
+                if op == 1:
+                    # 即座にACKするとdiscord.pyが送信時刻を記録する前に届き、遅延を誤検知する
+                    asyncio.get_running_loop().call_later(
+                        HEARTBEAT_ACK_DELAY, lambda: asyncio.ensure_future(session.send(11, None))
+                    )
+                elif op == 2:
+                    await self.identify(session, payload['d'])
+                elif op == 3:
+                    # on_readyでのステータス設定を準備完了の合図とする
+                    session.presence_set = True
+                    self.check_ready()
+                elif op == 6:
+                    if session not in self.sessions:
+                        self.sessions.append(session)
+                    await session.send(0, {}, 'RESUMED')
+                # プレゼンス更新(3)・メンバー要求(8)などは受け流す
+                self.gateway_events[f'op{op}'] += 1
+        finally:
+            if session in self.sessions:
+                self.sessions.remove(session)
+        return ws
+
+    async def identify(self, session, data):
+        session.shard = tuple(data.get('shard') or (0, 1))
+        session.identified = True
+        guild_ids = [guild_id for guild_id in self.guilds if session.owns(guild_id)]
+        await session.send(0, {
+            'v': 10,
+            'user': self.bot_user,
+            'guilds': [{'id': str(guild_id), 'unavailable': True} for guild_id in guild_ids],
+            'session_id': session.session_id,
+            'resume_gateway_url': f'ws://{self.args.host}:{self.args.port}/gateway',
+            'shard': list(session.shard),
+            'application': {'id': str(self.application_id), 'flags': 0},
+            'private_channels': [],
+            'relationships': [],
+            'presences': []
+        }, 'READY')
+        for guild_id in guild_ids:
+            await session.send(0, self.guild_create_payload(guild_id), 'GUILD_CREATE')
+        self.sessions.append(session)
+
+    def check_ready(self):
+        """全シャードの接続がステータスを設定したら準備完了とする
+
+        コマンド同期は接続前に行われるため、同期を準備完了の合図にはできない
+        """
+        shards = {session.shard for session in self.sessions if session.presence_set}
+        counts = {shard_count for _, shard_count in shards}
+        if len(counts) == 1 and len(shards) == counts.pop():
+            self.ready.set()
+
+    def session_for(self, guild_id):
+        for session in self.sessions:
+            if session.owns(guild_id):
+                return session
+        return None
+
+    async def dispatch_interaction(self, guild_id, channel_id, user, interaction_type, data, message=None, permissions='0'):
+        """INTERACTION_CREATEを送り、ボットの応答を待つ"""
+        session = self.session_for(guild_id)
+        if session is None:
+            raise RuntimeError(f'サーバー {guild_id} を担当するGatewayの接続がありません')
+
+        interaction_id = self.next_id()
+        token = secrets.token_urlsafe(48)
+        pending = PendingInteraction(interaction_id, token, interaction_type, guild_id, channel_id, user)
+        self.interactions[interaction_id] = pending
+        self.interactions_by_token[token] = pending
+
+        channel = self.guilds[guild_id]['channels']
+        channel = next(c for c in channel.values() if int(c['id']) == channel_id)
+        payload = {
+            'id': str(interaction_id),
+            'application_id': str(self.application_id),
+            'type': interaction_type,
+            'data': data,
+            'guild_id': str(guild_id),
+            'channel_id': str(channel_id),
+            'channel': channel,
+            'member': self.make_member(user, permissions),
+            'token': token,
+            'version': 1,
+            'locale': 'ja',
+            'guild_locale': 'ja',
+            'app_permissions': ALL_PERMISSIONS,
+            'entitlements': [],
+            'authorizing_integration_owners': {'0': str(guild_id)},
+            'context': 0,
+            'attachment_size_limit': 10 * 1024 * 1024
+        }
+        if message is not None:
+            payload['message'] = message
+
+        await session.send(0, payload, 'INTERACTION_CREATE')
+        self.gateway_events['INTERACTION_CREATE'] += 1
+        try:
+            # Discordと同じく3秒以内に応答がなければ失敗とする
+            return await asyncio.wait_for(pending.response, self.args.interaction_timeout)
+        finally:
+            self.interactions.pop(interaction_id, None)
+
+    # ---- 負荷試験 ----
+
+    def command_payload(self, name, options, guild_id):
+        command = next((c for c in self.commands if c['name'] == name), None)
+        data = {
+            'id': command['id'] if command else str(self.next_id()),
+            'name': name,
+            'type': 1,
+            'guild_id': str(guild_id),
+            'options': [],
+            'resolved': {'channels': {}}
+        }
+        for option_name, option_type, value in options:
+            data['options'].append({'name': option_name, 'type': option_type, 'value': value})
+            if option_type == 7:
+                channel = next(
+                    c for c in self.guilds[guild_id]['channels'].values() if c['id'] == value
+                )
+                data['resolved']['channels'][value] = {
+                    'id': channel['id'], 'name': channel['name'], 'type': channel['type'],
+                    'permissions': ALL_PERMISSIONS, 'parent_id': None, 'guild_id': channel['guild_id']
+                }
+        return data
+
+    @staticmethod
+    def modal_submit_data(modal, fill):
+        """ボットが返したモーダルの入力欄をすべて埋めた送信データを作る"""
+        components = []
+        for row in modal.get('components', []):
+            if row['type'] == 1:
+                components.append({'type': 1, 'components': [
+                    {'type': 4, 'custom_id': c['custom_id'], 'value': fill(c)} for c in row['components']
+                ]})
+            elif row['type'] == 18:
+                component = row['component']
+                components.append({'type': 18, 'component': {
+                    'type': component['type'], 'custom_id': component['custom_id'], 'value': fill(component)
+                }})
+        return {'custom_id': modal['custom_id'], 'components': components}
+
+    async def setup_guild(self, guild_id, products, stock):
+        """管理者として商品を登録し、販売機パネルを設置する"""
+        guild = self.guilds[guild_id]
+        panel_channel = int(guild['channels']['vending']['id'])
+        product_ids = []
+
+        for index in range(products):
+            product_id = f'item{index}'
+            response_type, modal, _ = await self.dispatch_interaction(
+                guild_id, panel_channel, self.admin, 2,
+                self.command_payload('add_product', [
+                    ('product_id', 3, product_id), ('name', 3, f'商品{index}'),
+                    ('price', 4, 500 + index), ('description', 3, '負荷試験用の商品')
+                ], guild_id),
+                permissions=ADMINISTRATOR
+            )
+            if response_type != 9:
+                raise RuntimeError(f'/add_product がモーダルを返しませんでした: {modal}')
+            lines = '\n'.join(f'{guild_id}-{product_id}-{n}' for n in range(stock))
+            await asyncio.sleep(self.args.think_time / 1000)
+            await self.dispatch_interaction(
+                guild_id, panel_channel, self.admin, 5,
+                self.modal_submit_data(modal, lambda component: lines),
+                permissions=ADMINISTRATOR
+            )
+            product_ids.append(product_id)
+
+        response_type, data, panel = await self.dispatch_interaction(
+            guild_id, panel_channel, self.admin, 2,
+            self.command_payload('vending_panel', [
+                ('admin_channel', 7, guild['channels']['admin']['id']),
+                ('achievement_channel', 7, guild['channels']['achievements']['id'])
+            ], guild_id),
+            permissions=ADMINISTRATOR
+        )
+        if panel is None:
+            raise RuntimeError(f'/vending_panel がパネルを送信しませんでした: {data}')
+        return panel, product_ids
+
+    async def purchase(self, guild_id, panel, product_id, samples, failures):
+        """購入者として商品を選択し、決済リンクを送信する"""
+        buyer = self.make_user(f'buyer{len(self.users)}')
+        self.users[int(buyer['id'])] = buyer
+        channel_id = int(panel['channel_id'])
+        custom_id = panel['components'][0]['components'][0]['custom_id']
+
+        started_at = time.perf_counter()
+        try:
+            response_type, modal, _ = await self.dispatch_interaction(
+                guild_id, channel_id, buyer, 3,
+                {'custom_id': custom_id, 'component_type': 3, 'values': [product_id]},
+                message=panel
+            )
+            samples['product_select'].append(time.perf_counter() - started_at)
+            if response_type != 9:
+                failures['product_select'] += 1
+                return
+
+            self.dm_waiters[int(buyer['id'])] = asyncio.get_running_loop().create_future()
+            await asyncio.sleep(self.args.think_time / 1000)
+            submitted_at = time.perf_counter()
+            await self.dispatch_interaction(
+                guild_id, channel_id, buyer, 5,
+                self.modal_submit_data(modal, lambda component: f'https://pay.paypay.ne.jp/{secrets.token_hex(8)}')
+            )
+            samples['payment_modal_submit'].append(time.perf_counter() - submitted_at)
+        except asyncio.TimeoutError:
+            failures['interaction_timeout'] += 1
+
+    async def approve_all(self, limit, samples, failures, approved_at):
+        """管理者チャンネルに届いた承認ボタンを順に押す"""
+        async def approve(message, custom_id):
+            async with limit:
+                guild_id = int(message['guild_id'])
+                started_at = time.perf_counter()
+                try:
+                    response_type, _, _ = await self.dispatch_interaction(
+                        guild_id, int(message['channel_id']), self.admin, 3,
+                        {'custom_id': custom_id, 'component_type': 2},
+                        message=message, permissions=ADMINISTRATOR
+                    )
+                except asyncio.TimeoutError:
+                    failures['interaction_timeout'] += 1
+                    return
+                samples['approve_order'].append(time.perf_counter() - started_at)
+                # 通知の「購入者」欄のメンションから、DMの届くユーザーを特定する
+                for embed in message['embeds']:
+                    for field in embed.get('fields', []):
+                        mention = MENTION_PATTERN.search(field['value'])
+                        if mention:
+                            approved_at[int(mention.group(1))] = started_at
+
+        tasks = set()
+        try:
+            while True:
+                message, custom_id = await self.approval_queue.get()
+                task = asyncio.create_task(approve(message, custom_id))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def run_load(self, buyers, concurrency, products, stock, timeout):
+        await asyncio.wait_for(self.ready.wait(), timeout)
+        for counter in self.route_stats.values():
+            counter.clear()
+        self.dm_waiters = {}
+        self.achievements = 0
+        samples = defaultdict(list)
+        failures = Counter()
+        phases = {}
+
+        started_at = time.perf_counter()
+        panels = await asyncio.gather(*(self.setup_guild(guild_id, products, stock) for guild_id in self.guilds))
+        phases['setup'] = time.perf_counter() - started_at
+
+        limit = asyncio.Semaphore(concurrency)
+        approved_at = {}
+        approver = asyncio.create_task(self.approve_all(limit, samples, failures, approved_at))
+
+        async def limited(index):
+            guild_id = list(self.guilds)[index % len(self.guilds)]
+            panel, product_ids = panels[index % len(self.guilds)]
+            async with limit:
+                await self.purchase(guild_id, panel, product_ids[index % len(product_ids)], samples, failures)
+
+        started_at = time.perf_counter()
+        await asyncio.gather(*(limited(index) for index in range(buyers)))
+        phases['purchase'] = time.perf_counter() - started_at
+
+        # すべての購入者にDMが届くまで待つ（承認は購入と並行して進む）
+        waiters = list(self.dm_waiters.values())
+        done, pending = await asyncio.wait(waiters, timeout=timeout) if waiters else (set(), set())
+        phases['until_last_delivery'] = time.perf_counter() - started_at
+        approver.cancel()
+        for waiter in pending:
+            waiter.cancel()
+        if pending:
+            failures['undelivered'] = len(pending)
+        samples['approve_to_dm'] = [
+            waiter.result() - approved_at[user_id]
+            for user_id, waiter in self.dm_waiters.items()
+            if waiter in done and user_id in approved_at
+        ]
+
+        total = phases['setup'] + phases['until_last_delivery']
+        return {
+            'meta': {'timestamp': time.time(), 'parameters': {
+                'buyers': buyers, 'concurrency': concurrency, 'products': products, 'stock': stock,
+                'guilds': len(self.guilds), 'latency_ms': self.args.latency, 'jitter_ms': self.args.jitter,
+                'rate_429': self.args.rate_429, 'rate_5xx': self.args.rate_5xx,
+                'think_time_ms': self.args.think_time
+            }},
+            'phases_seconds': phases,
+            'interactions': {name: summarize(values) for name, values in samples.items()},
+            'deliveries': len(done),
+            'achievement_posts': self.achievements,
+            'deliveries_per_second': round(len(done) / total, 2) if total else 0.0,
+            'failures': dict(failures),
+            'rest': self.rest_stats(),
+            'gateway': dict(self.gateway_events)
+        }
+
+    def rest_stats(self):
+        return {route: dict(counter) for route, counter in sorted(self.route_stats.items()) if counter}
+
+    # ---- 操作用エンドポイント ----
+
+    async def handle_load(self, request):
+        query = request.query
+        result = await self.run_load(
+            int(query.get('buyers', self.args.buyers)),
+            int(query.get('concurrency', self.args.concurrency)),
+            int(query.get('products', self.args.products)),
+            int(query.get('stock', self.args.stock)),
+            float(query.get('timeout', self.args.timeout))
+        )
+        return json_response(result)
+
+    async def handle_stats(self, request):
+        return json_response({
+            'rest': self.rest_stats(),
+            'gateway': dict(self.gateway_events),
+            'sessions': [{'shard': session.shard, 'sequence': session.sequence} for session in self.sessions],
+            'messages': len(self.messages)
+        })
+
+    def make_app(self):
+        app = web.Application(middlewares=[self.middleware], client_max_size=64 * 1024 * 1024)
+        routes = [
+            ('GET', '/users/@me', self.get_current_user),
+            ('GET', '/oauth2/applications/@me', self.get_application),
+            ('GET', '/applications/@me', self.get_application),
+            ('GET', '/gateway', self.get_gateway),
+            ('GET', '/gateway/bot', self.get_gateway),
+            ('POST', '/users/@me/channels', self.create_dm),
+            ('GET', '/users/{user_id}', self.get_user),
+            ('GET', '/applications/{application_id}/commands', self.get_commands),
+            ('PUT', '/applications/{application_id}/commands', self.put_commands),
+            ('GET', '/applications/{application_id}/guilds/{guild_id}/commands', self.get_commands),
+            ('PUT', '/applications/{application_id}/guilds/{guild_id}/commands', self.put_commands),
+            ('POST', '/channels/{channel_id}/messages', self.create_message),
+            ('GET', '/channels/{channel_id}/messages/{message_id}', self.get_message),
+            ('PATCH', '/channels/{channel_id}/messages/{message_id}', self.edit_channel_message),
+            ('DELETE', '/channels/{channel_id}/messages/{message_id}', self.delete_channel_message),
+            ('POST', '/interactions/{interaction_id}/{interaction_token}/callback', self.interaction_callback),
+            ('POST', '/webhooks/{webhook_id}/{webhook_token}', self.create_followup),
+            ('GET', '/webhooks/{webhook_id}/{webhook_token}/messages/{message_id}', self.get_webhook_message),
+            ('PATCH', '/webhooks/{webhook_id}/{webhook_token}/messages/{message_id}', self.edit_webhook_message),
+            ('DELETE', '/webhooks/{webhook_id}/{webhook_token}/messages/{message_id}', self.delete_webhook_message),
+        ]
+        for method, path, handler in routes:
+            app.router.add_route(method, API_PREFIX + path, handler)
+        app.router.add_route('*', API_PREFIX + '/{tail:.*}', self.unhandled)
+        app.router.add_get('/gateway', self.gateway)
+        app.router.add_post('/_mock/load', self.handle_load)
+        app.router.add_get('/_mock/stats', self.handle_stats)
+        return app
+
+def spawn_bot(args):
+    """モックに接続するボットを子プロセスとして起動"""
+    env = dict(
+        os.environ,
+        DISCORD_BOT_TOKEN='mock-token',
+        DISCORD_API_BASE=f'http://{args.host}:{args.port}{API_PREFIX}',
+        DISCORD_GATEWAY_URL=f'ws://{args.host}:{args.port}/gateway',
+        DATA_DIR=tempfile.mkdtemp(prefix='vending-mock-'),
+        PORT=str(args.bot_port),
+        CLUSTER_COUNT=str(args.bot_clusters),
+        # 負荷試験では注文が集中するため、サーバー単位の頻度制限は指定が無ければ無効にする
+        ORDER_RATE_PER_GUILD=os.environ.get('ORDER_RATE_PER_GUILD', '0')
+    )
+    main_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+    return subprocess.Popen([sys.executable, main_path], env=env, stdout=sys.stderr, stderr=sys.stderr)
+
+async def serve(args):
+    mock = MockDiscord(args)
+    runner = web.AppRunner(mock.make_app())
+    await runner.setup()
+    await web.TCPSite(runner, args.host, args.port).start()
+    print(f'モックDiscordを {mock.base_url} で開始しました', file=sys.stderr)
+
+    if not args.spawn_bot:
+        await asyncio.Event().wait()
+
+    bot_process = spawn_bot(args)
+
+    async def watch_bot():
+        while bot_process.poll() is None:
+            await asyncio.sleep(0.5)
+        raise RuntimeError(f'ボットが終了しました（終了コード {bot_process.returncode}）')
+
+    watcher = asyncio.create_task(watch_bot())
+    load = asyncio.create_task(
+        mock.run_load(args.buyers, args.concurrency, args.products, args.stock, args.timeout)
+    )
+    try:
+        await asyncio.wait((watcher, load), return_when=asyncio.FIRST_COMPLETED)
+        if not load.done():
+            load.cancel()
+            watcher.result()
+        return load.result()
+    finally:
+        watcher.cancel()
+        bot_process.terminate()
+        with contextlib.suppress(subprocess.TimeoutExpired):
+            bot_process.wait(timeout=10)
+        await runner.cleanup()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Discord REST API・Gatewayのローカルモック')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8787)
+    parser.add_argument('--guilds', type=int, default=1, help='サーバー数')
+    parser.add_argument('--recommended-shards', type=int, default=1, help='/gateway/botが返す推奨シャード数')
+    parser.add_argument('--latency', type=float, default=0.0, help='RESTの応答遅延（ミリ秒）')
+    parser.add_argument('--jitter', type=float, default=0.0, help='遅延に加える揺らぎの最大値（ミリ秒）')
+    parser.add_argument('--rate-429', type=float, default=0.0, help='429を注入する割合（0〜1）')
+    parser.add_argument('--rate-5xx', type=float, default=0.0, help='502を注入する割合（0〜1）')
+    # discord.pyはモーダル応答のHTTPレスポンスを受け取ってからモーダルを登録するため、
+    # 0にすると実際の利用ではあり得ない速さで送信され、取りこぼされることがある
+    parser.add_argument('--think-time', type=float, default=200.0, help='モーダルを開いてから送信するまでの時間（ミリ秒）')
+    parser.add_argument('--interaction-timeout', type=float, default=3.0, help='インタラクションの応答期限（秒）')
+    parser.add_argument('--spawn-bot', action='store_true', help='main.pyを起動して負荷試験を実行し、結果を出力して終了')
+    parser.add_argument('--bot-port', type=int, default=10001, help='起動したボットのWebサーバーのポート')
+    parser.add_argument('--bot-clusters', type=int, default=1, help='起動したボットのクラスター数（CLUSTER_COUNT）')
+    parser.add_argument('--buyers', type=int, default=500, help='購入者数')
+    parser.add_argument('--concurrency', type=int, default=100, help='同時に処理する購入・承認の数')
+    parser.add_argument('--products', type=int, default=5, help='サーバーごとの商品数')
+    parser.add_argument('--stock', type=int, default=1000, help='商品ごとの在庫数')
+    parser.add_argument('--timeout', type=float, default=300.0, help='準備・配送完了を待つ最大時間（秒）')
+    parser.add_argument('--output', help='結果のJSONの出力先（省略時は標準出力）')
+    return parser.parse_args(argv)
+
+def run_cli(argv=None):
+    args = parse_args(argv)
+    try:
+        result = asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        return 0
+    text = json.dumps(result, indent=2, ensure_ascii=False)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            output_file.write(text + '\n')
+    else:
+        print(text)
+    return 1 if result['failures'] else 0
+
+if __name__ == '__main__':
+    sys.exit(run_cli())
@@ -0,0 +1,54 @@
+"""テスト共通の設定
+
+mainの読み込み前に保存先を一時ディレクトリへ切り替える。ボットはモジュールに1つだけのため、
+終了・再起動をまたぐシナリオはrun_botで別プロセスとして実行する
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import textwrap
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('DATA_DIR', tempfile.mkdtemp(prefix='vending-test-'))
+
+# run_botのスクリプトの前に付ける共通部分
+PRELUDE = '''
+import asyncio, json, os, sys, time, types
+import main
+bot = main.bot
+
+def result(value):
+    print('RESULT ' + json.dumps(value, ensure_ascii=False), flush=True)
+
+async def start():
+    """起動時と同じ順にストレージを開いて操作ログを再生する"""
+    bot.storage.open()
+    await bot.replay_journal()
+
+def crash():
+    """保存せずに終了する（操作ログはsync済みの分だけ残る）"""
+    sys.stdout.flush()
+    os._exit(0)
+'''
+
+@pytest.fixture
+def run_bot(tmp_path):
+    """スクリプトを別プロセスのボットで実行し、result()に渡した値を返す
+
+    同じテストの中では保存先を共有するため、続けて呼ぶと再起動を模擬できる
+    """
+    def run(script):
+        env = dict(os.environ, DATA_DIR=str(tmp_path), LOG_LEVEL='WARNING')
+        completed = subprocess.run(
+            [sys.executable, '-c', PRELUDE + textwrap.dedent(script)],
+            cwd=ROOT, env=env, capture_output=True, text=True, timeout=120
+        )
+        assert completed.returncode == 0, completed.stderr[-4000:]
+        results = [line[len('RESULT '):] for line in completed.stdout.splitlines() if line.startswith('RESULT ')]
+        return json.loads(results[-1]) if results else None
+    return run
@@ -0,0 +1,139 @@
+"""DeliveryPipeline（商品DM配送）の再起動後の再開"""
+
+# DMの送信と履歴だけを持つ購入者の代わり
+FAKE_USER = '''
+    class FakeMessage:
+        def __init__(self, embed):
+            self.author = types.SimpleNamespace(id=1)
+            self.embeds = [embed]
+
+    class FakeUser:
+        def __init__(self, history=(), history_error=None):
+            self.sent = []
+            self.messages = list(history)
+            self.history_error = history_error
+            self.dm_channel = self
+
+        async def send(self, embed):
+            self.sent.append(embed)
+            self.messages.append(FakeMessage(embed))
+
+        async def history(self, limit):
+            if self.history_error:
+                raise self.history_error
+            for message in reversed(self.messages[-limit:]):
+                yield message
+
+    def delivered_embed(order_id, item):
+        embed = main.discord.Embed(title='📦 商品お届け')
+        embed.add_field(name='注文ID', value=f'#{order_id}')
+        embed.add_field(name='商品内容', value=item)
+        return embed
+
+    def add_delivering_order(order_id, item, **fields):
+        vm = bot.get_guild_vending_machine(1)
+        vm['products'].setdefault('p1', {'name': 'テスト商品', 'price': 100, 'description': '', 'stock': 0, 'reserved': 0, 'inventory': bot.open_inventory(1, 'p1')})
+        vm['orders'][order_id] = dict({
+            'user_id': '10', 'product_id': 'p1', 'price': 100, 'status': 'delivering', 'channel_id': 0,
+            'timestamp': time.time(), 'processed_by': '99', 'delivery_item': item
+        }, **fields)
+        bot.mark_dirty(1, 'order', order_id)
+
+    async def resume_and_wait(order_ids):
+        bot._connection.user = types.SimpleNamespace(id=1)
+        if not bot.delivery.workers:
+            bot.delivery.start()
+        await bot.delivery.resume([(1, order_id) for order_id in order_ids])
+        while bot.delivery.jobs:
+            await asyncio.sleep(0.01)
+
+    def order_summary(order_id):
+        order = bot.get_guild_vending_machine(1)['orders'][order_id]
+        return {'status': order['status'], 'unconfirmed': bool(order.get('delivery_unconfirmed'))}
+'''
+
+def run_scenario(run_bot, body):
+    return run_bot(FAKE_USER + body)
+
+def test_order_without_sending_marker_is_sent_once(run_bot):
+    result = run_scenario(run_bot, '''
+    async def scenario():
+        await start()
+        user = FakeUser()
+        bot.user_resolver.resolve = lambda user_id: asyncio.sleep(0, user)
+        add_delivering_order('1', 'secret-1')
+        await resume_and_wait(['1'])
+        # 完了済みの注文をもう一度再開しても送らない
+        await resume_and_wait(['1'])
+        result({'sent': len(user.sent), **order_summary('1')})
+    asyncio.run(scenario())
+    ''')
+    assert result == {'sent': 1, 'status': 'completed', 'unconfirmed': False}
+
+def test_sending_marker_with_delivered_dm_is_not_resent(run_bot):
+    result = run_scenario(run_bot, '''
+    async def scenario():
+        await start()
+        user = FakeUser(history=[FakeMessage(delivered_embed('1', 'secret-1'))])
+        bot.user_resolver.resolve = lambda user_id: asyncio.sleep(0, user)
+        add_delivering_order('1', 'secret-1', dm_started_at=time.time())
+        await resume_and_wait(['1'])
+        result({'sent': len(user.sent), **order_summary('1')})
+    asyncio.run(scenario())
+    ''')
+    assert result == {'sent': 0, 'status': 'completed', 'unconfirmed': False}
+
+def test_sending_marker_without_matching_dm_is_sent(run_bot):
+    # 別の注文・別の商品内容のDMは一致しない
+    result = run_scenario(run_bot, '''
+    async def scenario():
+        await start()
+        user = FakeUser(history=[FakeMessage(delivered_embed('1', 'other-item')), FakeMessage(delivered_embed('2', 'secret-1'))])
+        bot.user_resolver.resolve = lambda user_id: asyncio.sleep(0, user)
+        add_delivering_order('1', 'secret-1', dm_started_at=time.time())
+        await resume_and_wait(['1'])
+        result({'sent': len(user.sent), **order_summary('1')})
+    asyncio.run(scenario())
+    ''')
+    assert result == {'sent': 1, 'status': 'completed', 'unconfirmed': False}
+
+def test_sending_marker_with_unreadable_history_is_flagged(run_bot):
+    result = run_scenario(run_bot, '''
+    async def scenario():
+        await start()
+        user = FakeUser(history_error=RuntimeError('history unavailable'))
+        bot.user_resolver.resolve = lambda user_id: asyncio.sleep(0, user)
+        add_delivering_order('1', 'secret-1', dm_started_at=time.time())
+        await resume_and_wait(['1'])
+        result({'sent': len(user.sent), **order_summary('1')})
+    asyncio.run(scenario())
+    ''')
+    assert result == {'sent': 0, 'status': 'completed', 'unconfirmed': True}
+
+def test_sending_marker_survives_crash_and_prevents_resend(run_bot):
+    # DM送信の直後（完了を保存する前）に終了した場合
+    run_scenario(run_bot, '''
+    async def scenario():
+        await start()
+        add_delivering_order('1', 'secret-1')
+        await bot.flush_storage()
+
+        class CrashAfterSend(FakeUser):
+            async def send(self, embed):
+                crash()
+        bot.user_resolver.resolve = lambda user_id: asyncio.sleep(0, CrashAfterSend())
+        await resume_and_wait(['1'])
+    asyncio.run(scenario())
+    ''')
+    result = run_scenario(run_bot, '''
+    async def scenario():
+        await start()
+        order = bot.get_guild_vending_machine(1)['orders']['1']
+        marker = bool(order.get('dm_started_at'))
+        user = FakeUser(history=[FakeMessage(delivered_embed('1', 'secret-1'))])
+        bot.user_resolver.resolve = lambda user_id: asyncio.sleep(0, user)
+        await resume_and_wait(['1'])
+        result({'marker': marker, 'sent': len(user.sent), **order_summary('1')})
+    asyncio.run(scenario())
+    ''')
+    assert result == {'marker': True, 'sent': 0, 'status': 'completed', 'unconfirmed': False}
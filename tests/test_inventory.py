@@ -0,0 +1,104 @@
+"""InventoryQueue（追記専用ファイルの在庫キュー）の詰め直し・世代切り替え"""
+import asyncio
+import os
+
+import pytest
+
+import main
+
+@pytest.fixture
+def small_compaction(monkeypatch):
+    # 少ない件数で詰め直しが起きるようにする
+    monkeypatch.setattr(main, 'INVENTORY_COMPACT_MIN', 4)
+
+def open_queue(tmp_path, **kwargs):
+    return main.InventoryQueue(os.path.join(tmp_path, 'product'), **kwargs)
+
+def test_items_are_taken_in_order_and_survive_reopen(tmp_path):
+    queue = open_queue(tmp_path, reset=True)
+    queue.extend(['a', 'b', 'c'])
+    assert queue.popleft() == 'a'
+    state = queue.to_state()
+    queue.close()
+
+    reopened = open_queue(tmp_path, head=state['head'], front=state['front'])
+    assert list(reopened) == ['b', 'c']
+    assert len(reopened) == 2
+
+def test_appendleft_restores_taken_item(tmp_path):
+    queue = open_queue(tmp_path, reset=True)
+    queue.extend(['a', 'b'])
+    queue.appendleft(queue.popleft())
+    queue.appendleft('x')
+    assert list(queue) == ['x', 'a', 'b']
+
+def test_compaction_switches_generation(tmp_path, small_compaction):
+    queue = open_queue(tmp_path, reset=True)
+    queue.extend([f'item{n}' for n in range(10)])
+    for _ in range(5):
+        queue.popleft()
+
+    # 先頭から半分以上を取り出した時点で詰め直す
+    assert queue.base == 5
+    assert queue.head == 0
+    assert list(queue) == ['item5', 'item6', 'item7', 'item8', 'item9']
+    assert sorted(os.listdir(tmp_path)) == ['product.5.dat', 'product.5.idx', 'product.gen']
+    assert queue.popleft() == 'item5'
+    state = queue.to_state()
+    queue.close()
+
+    reopened = open_queue(tmp_path, head=state['head'], front=state['front'])
+    assert list(reopened) == ['item6', 'item7', 'item8', 'item9']
+
+def test_state_saved_before_compaction_maps_to_new_generation(tmp_path, small_compaction):
+    # 詰め直しの後、headを保存する前に終了した場合
+    queue = open_queue(tmp_path, reset=True)
+    queue.extend([f'item{n}' for n in range(10)])
+    for _ in range(4):
+        queue.popleft()
+    saved = queue.to_state()
+    queue.popleft()  # ここで詰め直しが起きる
+    assert queue.base == 5
+    queue.close()
+
+    # 詰め直しで消えた分（取り出し済み）は戻らず、残りの在庫はすべて残る
+    reopened = open_queue(tmp_path, head=saved['head'], front=saved['front'])
+    assert list(reopened) == ['item5', 'item6', 'item7', 'item8', 'item9']
+
+def test_empty_queue_is_truncated(tmp_path):
+    queue = open_queue(tmp_path, reset=True)
+    queue.extend(['a', 'b'])
+    queue.popleft()
+    queue.popleft()
+    assert queue.count == 0
+    assert not queue
+    queue.extend(['c'])
+    assert list(queue) == ['c']
+
+def test_snapshot_defers_compaction_until_closed(tmp_path, small_compaction):
+    queue = open_queue(tmp_path, reset=True)
+    queue.extend([f'item{n}' for n in range(10)])
+    with queue.snapshot() as items:
+        for _ in range(6):
+            queue.popleft()
+        assert queue.base == 0
+        assert list(items) == [f'item{n}' for n in range(10)]
+    # 閉じた時点でまとめて詰め直す
+    assert queue.base == 6
+    assert list(queue) == ['item6', 'item7', 'item8', 'item9']
+
+def test_extend_async_keeps_items_consistent_with_concurrent_pops(tmp_path, small_compaction):
+    async def scenario():
+        queue = open_queue(tmp_path, reset=True)
+        await queue.extend_async([f'item{n}' for n in range(10)])
+        task = asyncio.create_task(queue.extend_async([f'new{n}' for n in range(3)]))
+        await asyncio.sleep(0)
+        taken = [queue.popleft() for _ in range(8)]
+        await task
+        return queue, taken
+
+    queue, taken = asyncio.run(scenario())
+    assert taken == [f'item{n}' for n in range(8)]
+    assert list(queue) == ['item8', 'item9', 'new0', 'new1', 'new2']
+    # 追記の間は止めていた詰め直しが追記の後に行われる
+    assert queue.base == 8
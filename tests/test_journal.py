@@ -0,0 +1,92 @@
+"""操作ログ（OrderJournal）の再生とスナップショット"""
+
+# 保存済みの状態を作ってから、保存前の変更を操作ログだけに残して終了する
+SETUP = '''
+    async def scenario():
+        await start()
+        vm = bot.get_guild_vending_machine(1)
+        inventory = bot.open_inventory(1, 'p1')
+        inventory.extend([f'item{n}' for n in range(5)])
+        vm['products']['p1'] = {'name': 'テスト商品', 'price': 100, 'description': '', 'stock': 5, 'reserved': 0, 'inventory': inventory}
+        bot.mark_dirty(1, 'product', 'p1')
+        for order_id in ('1', '2', '3'):
+            vm['orders'][order_id] = {'user_id': '10', 'product_id': 'p1', 'price': 100, 'status': 'pending_payment', 'channel_id': 0, 'timestamp': time.time()}
+            bot.mark_dirty(1, 'order', order_id)
+        vm['next_order_id'] = 4
+        bot.mark_dirty(1)
+        await bot.flush_storage()
+
+        # ここからは保存されず、操作ログにだけ残る
+        bot.set_order_status(1, '1', 'completed')
+        bot.set_order_status(1, '2', 'cancelled')
+        vm['orders']['4'] = {'user_id': '11', 'product_id': 'p1', 'price': 100, 'status': 'pending_payment', 'channel_id': 0, 'timestamp': time.time()}
+        bot.mark_dirty(1, 'order', '4')
+        inventory.popleft()
+        vm['products']['p1']['stock'] -= 1
+        bot.mark_dirty(1, 'product', 'p1')
+        bot.sales.record(1, 'p1', 100)
+        await bot.journal.sync()
+        crash()
+    asyncio.run(scenario())
+'''
+
+# 再起動して再生した後の状態
+STATE = '''
+    async def scenario():
+        await start()
+        vm = bot.get_guild_vending_machine(1)
+        product = vm['products']['p1']
+        report = await bot.sales.report(1, 1)
+        result({
+            'statuses': {order_id: order['status'] for order_id, order in sorted(vm['orders'].items())},
+            'next_order_id': vm['next_order_id'],
+            'stock': product['stock'],
+            'inventory': list(product['inventory']),
+            'units': report['total']['units'],
+            'revenue': report['total']['revenue'],
+        })
+        {finish}
+    asyncio.run(scenario())
+'''
+
+EXPECTED = {
+    'statuses': {'1': 'completed', '2': 'cancelled', '3': 'pending_payment', '4': 'pending_payment'},
+    'next_order_id': 5,
+    'stock': 4,
+    'inventory': ['item1', 'item2', 'item3', 'item4'],
+    'units': 1,
+    'revenue': 100,
+}
+
+def test_replay_restores_unsaved_changes(run_bot):
+    run_bot(SETUP)
+    assert run_bot(STATE.replace('{finish}', 'crash()')) == EXPECTED
+
+def test_replay_is_idempotent_when_restarted_before_saving(run_bot):
+    # 再生後の保存より前に終了しても、同じイベントを二重に適用しない
+    run_bot(SETUP)
+    assert run_bot(STATE.replace('{finish}', 'crash()')) == EXPECTED
+    assert run_bot(STATE.replace('{finish}', 'crash()')) == EXPECTED
+
+def test_snapshot_after_replay_is_not_applied_again(run_bot):
+    # 再生した分を保存した後は、スナップショットの位置より前のイベントを読まない
+    run_bot(SETUP)
+    assert run_bot(STATE.replace('{finish}', 'await bot.flush_storage()')) == EXPECTED
+    assert run_bot(STATE.replace('{finish}', 'crash()')) == EXPECTED
+    assert run_bot(STATE.replace('{finish}', 'await bot.flush_storage()')) == EXPECTED
+
+def test_events_after_snapshot_are_replayed_on_top(run_bot):
+    run_bot(SETUP)
+    run_bot('''
+        async def scenario():
+            await start()
+            bot.set_order_status(1, '3', 'completed')
+            bot.sales.record(1, 'p1', 100)
+            await bot.journal.sync()
+            crash()
+        asyncio.run(scenario())
+    ''')
+    state = run_bot(STATE.replace('{finish}', 'crash()'))
+    assert state['statuses']['3'] == 'completed'
+    assert state['units'] == 2
+    assert state['revenue'] == 200
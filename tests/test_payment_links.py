@@ -0,0 +1,87 @@
+"""決済リンクの使い回し検出（BloomFilterとPaymentLinkIndex）"""
+import random
+
+import main
+
+def test_bloom_filter_has_no_false_negatives_after_growing():
+    bloom = main.BloomFilter(capacity=100, error_rate=0.01)
+    digests = [random.getrandbits(64) for _ in range(1000)]
+    for digest in digests:
+        bloom.add(digest)
+    # 容量を超えると層を追加する
+    assert len(bloom.layers) > 1
+    assert len(bloom) == 1000
+    assert all(digest in bloom for digest in digests)
+
+def test_bloom_filter_false_positive_rate_stays_near_target():
+    bloom = main.BloomFilter(capacity=1000, error_rate=0.01)
+    for _ in range(1000):
+        bloom.add(random.getrandbits(64))
+    false_positives = sum(random.getrandbits(64) in bloom for _ in range(10000))
+    assert false_positives < 300
+
+def test_equivalent_links_have_the_same_digest():
+    first = main.normalize_payment_link('https://Example.com/pay/abc')
+    second = main.normalize_payment_link('https://example.com/pay/abc')
+    assert first is not None
+    assert main.payment_link_digest(first) == main.payment_link_digest(second)
+
+def test_duplicate_link_is_detected_across_restart(run_bot):
+    first = run_bot('''
+        async def scenario():
+            await start()
+            link = main.normalize_payment_link('https://example.com/pay/abc')
+            results = [
+                await bot.payment_links.register(1, link, '1'),
+                await bot.payment_links.register(1, link, '1'),  # 同じ注文からの再送信
+                await bot.payment_links.register(1, link, '2'),
+                await bot.payment_links.register(2, link, '3'),  # 別のサーバー
+            ]
+            await bot.flush_storage()
+            result(results)
+        asyncio.run(scenario())
+    ''')
+    assert first == [None, None, '1', None]
+
+    # 再起動後は保存済みのハッシュ値からフィルターを作り直す
+    second = run_bot('''
+        async def scenario():
+            await start()
+            link = main.normalize_payment_link('https://example.com/pay/abc')
+            other = main.normalize_payment_link('https://example.com/pay/other')
+            result([
+                await bot.payment_links.register(1, link, '4'),
+                await bot.payment_links.register(1, other, '5'),
+            ])
+        asyncio.run(scenario())
+    ''')
+    assert second == ['1', None]
+
+def test_concurrent_registrations_allow_only_one_order(run_bot):
+    results = run_bot('''
+        async def scenario():
+            await start()
+            link = main.normalize_payment_link('https://example.com/pay/same')
+            result(await asyncio.gather(*(bot.payment_links.register(1, link, str(order_id)) for order_id in range(10))))
+        asyncio.run(scenario())
+    ''')
+    assert results.count(None) == 1
+    first = str(results.index(None))
+    assert all(result in (None, first) for result in results)
+
+def test_unflushed_registration_is_replayed_after_crash(run_bot):
+    run_bot('''
+        async def scenario():
+            await start()
+            await bot.payment_links.register(1, main.normalize_payment_link('https://example.com/pay/crash'), '7')
+            await bot.journal.sync()
+            crash()
+        asyncio.run(scenario())
+    ''')
+    duplicate_of = run_bot('''
+        async def scenario():
+            await start()
+            result(await bot.payment_links.register(1, main.normalize_payment_link('https://example.com/pay/crash'), '8'))
+        asyncio.run(scenario())
+    ''')
+    assert duplicate_of == '7'
@@ -0,0 +1,43 @@
+"""TimingWheel（注文の期限管理）"""
+import main
+
+def test_key_expires_once_its_deadline_passes():
+    wheel = main.TimingWheel(tick=1.0, slot_count=8)
+    start = wheel.current
+    wheel.schedule('order', start + 3)
+    assert wheel.advance(start + 2) == []
+    assert wheel.advance(start + 3) == ['order']
+    assert len(wheel) == 0
+    assert wheel.advance(start + 4) == []
+
+def test_cancel_and_reschedule():
+    wheel = main.TimingWheel(tick=1.0, slot_count=8)
+    start = wheel.current
+    wheel.schedule('cancelled', start + 2)
+    wheel.schedule('moved', start + 2)
+    wheel.cancel('cancelled')
+    wheel.schedule('moved', start + 5)  # 登録し直すと前の期限は消える
+    assert wheel.advance(start + 4) == []
+    assert wheel.advance(start + 5) == ['moved']
+
+def test_deadline_beyond_one_revolution_is_carried_over():
+    wheel = main.TimingWheel(tick=1.0, slot_count=8)
+    start = wheel.current
+    wheel.schedule('far', start + 20)
+    for now in range(start + 1, start + 20):
+        assert wheel.advance(now) == []
+    assert wheel.advance(start + 20) == ['far']
+
+def test_past_deadline_expires_on_next_tick():
+    wheel = main.TimingWheel(tick=1.0, slot_count=8)
+    start = wheel.current
+    wheel.schedule('late', start - 100)
+    assert wheel.advance(start + 1) == ['late']
+
+def test_large_jump_expires_everything_due():
+    wheel = main.TimingWheel(tick=1.0, slot_count=8)
+    start = wheel.current
+    for offset in range(1, 30):
+        wheel.schedule(offset, start + offset)
+    assert sorted(wheel.advance(start + 100)) == list(range(1, 30))
+    assert len(wheel) == 0